@@ -7,61 +7,64 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__))))
 from utils.custom_logger import CustomLogger
 
 from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
 
-from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
-from slowapi.util import get_remote_address
-
-from middlewares.auth_middleware import AuthMiddleware
-from middlewares.header_middleware import SecurityHeadersMiddleware
-from middlewares.notfound_middleware import NotFoundMiddleware
-from middlewares.logger_middleware import LoggerMiddleware
+from middlewares.pipeline_middleware import PipelineMiddleware
 
 from routes.auth_routes import router as auth_router
 from routes.user_routes import router as user_router
 from routes.iot_routes import router as iot_router
 from routes.app_routes import router as app_router
+from routes.health_routes import router as health_router
+
+from services.database import Database
+from services.index_service import IndexService
+from services.sensor_writer import SensorWriter
+from services.service_change_writer import ServiceChangeWriter
+from services.auth_service import AuthService
+from services.redis_client import RedisClient
+from services.message_bus import MessageBus
+from services.iot_service import IOTService
+from services.app_service import AppService
+
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 load_dotenv()
 
-app = FastAPI()
-
-limiter = Limiter(key_func=get_remote_address)
-app.state.limiter = limiter
-app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
-
-# Collect all route paths from routers
-route_prefixes = ['/auth', '/user', '/iot', '/app']
-route_paths = set()
-for router, prefix in [
-    (auth_router, '/auth'),
-    (user_router, '/user'),
-    (iot_router, '/iot'),
-    (app_router, '/app'),
-]:
-    for route in router.routes:
-        if hasattr(route, 'path'):
-            route_paths.add(prefix + route.path if not route.path.startswith('/') else prefix + route.path)
-route_paths.add('/')
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=[os.getenv("ALLOWED_ORIGINS", "*")],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"]
-)
-app.add_middleware(AuthMiddleware)
-app.add_middleware(SecurityHeadersMiddleware)
-app.add_middleware(NotFoundMiddleware, routes=list(route_paths))
-app.add_middleware(LoggerMiddleware)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if getattr(Database()._instance, "db", None) is not None:
+        if os.getenv("MONGODB_ENSURE_INDEXES", "True") != "False":
+            await IndexService()._ensure_indexes()
+        # Never serve registrations without the unique username index, whether or not it was just created
+        await IndexService()._verify_unique_indexes()
+        if os.getenv("MONGODB_VERIFY_INDEXES", "False") == "True":
+            await IndexService()._verify_indexes()
+
+    await SensorWriter()._start()
+    await ServiceChangeWriter()._start()
+    await AuthService()._start()
+    await IOTService()._start()
+
+    yield
+
+    await IOTService()._stop()
+    await AppService()._stop()
+    await MessageBus()._stop()
+    await AuthService()._stop()
+    await ServiceChangeWriter()._stop()
+    await SensorWriter()._stop()
+    await RedisClient()._close()
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(PipelineMiddleware)
 
 app.include_router(auth_router, prefix='/auth')
 app.include_router(user_router, prefix='/user')
 app.include_router(iot_router, prefix='/iot')
 app.include_router(app_router, prefix='/app')
+app.include_router(health_router)
 
 if __name__ == '__main__':
     CustomLogger()._get_logger().info("Starting backend server")
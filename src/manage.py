@@ -0,0 +1,87 @@
+import sys
+import os
+
+# Add the root path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__))))
+
+import argparse
+import asyncio
+
+from dotenv import load_dotenv
+load_dotenv()
+
+from utils.custom_logger import CustomLogger
+from services.database import Database
+from services.index_service import IndexService
+from services.sensor_storage import SensorStorage
+from services.services_status_storage import ServicesStatusStorage
+
+async def ensure_indexes(args) -> int:
+    result = await IndexService()._ensure_indexes()
+    return 1 if any(isinstance(created, str) for created in result.values()) else 0
+
+async def check_indexes(args) -> int:
+    try:
+        await IndexService()._verify_unique_indexes()
+        await IndexService()._verify_indexes()
+        return 0
+    except Exception:
+        return 1
+
+async def migrate_sensor_storage(args) -> int:
+    logger = CustomLogger()._get_logger()
+    copied = await Database()._instance.run(
+        SensorStorage()._migrate_to_timeseries,
+        args.batch_size,
+        logger.info
+    )
+    logger.info(f"Sensor storage migration done: {copied} readings copied, set SENSOR_STORAGE_MODE=timeseries to read them")
+    return 0
+
+async def migrate_history_timestamps(args) -> int:
+    logger = CustomLogger()._get_logger()
+    converted = await Database()._instance.run(
+        ServicesStatusStorage()._migrate_history_timestamps,
+        args.batch_size,
+        logger.info
+    )
+    logger.info(f"Action history migration done: {converted} timestamps converted to native datetimes")
+    return 0
+
+def add_batch_size_argument(parser):
+    parser.add_argument("--batch-size", type=int, default=10000, help="documents copied per round trip")
+
+# name -> (handler, help, arguments)
+COMMANDS = {
+    "ensure-indexes": (ensure_indexes, "Create the indexes of the index registry", None),
+    "check-indexes": (check_indexes, "Fail if a unique index is missing or a hot-path query is not served by an index", None),
+    "migrate-sensor-storage": (
+        migrate_sensor_storage,
+        "Copy environment_sensor readings into the time-series collection (resumable)",
+        add_batch_size_argument
+    ),
+    "migrate-history-timestamps": (
+        migrate_history_timestamps,
+        "Convert string action history timestamps into native datetimes and drop the superseded index (resumable)",
+        add_batch_size_argument
+    ),
+}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="SDAS server maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text, add_arguments) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text)
+        if add_arguments:
+            add_arguments(subparser)
+
+    args = parser.parse_args()
+
+    if getattr(Database()._instance, "db", None) is None:
+        CustomLogger()._get_logger().error("Database not available")
+        return 1
+
+    return asyncio.run(COMMANDS[args.command][0](args))
+
+if __name__ == '__main__':
+    sys.exit(main())
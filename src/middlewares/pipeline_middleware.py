@@ -0,0 +1,220 @@
+from utils.custom_logger import CustomLogger
+
+import math
+import os
+import time
+from typing import Iterable
+from colorama import Fore
+
+from starlette.requests import cookie_parser
+from starlette.responses import JSONResponse, Response
+
+from utils.route_matcher import RouteMatcher
+from utils.rate_limiter import get_rate_limit
+
+from services.auth_service import AuthService
+from services.rate_limit_service import RateLimitService
+
+class PipelineMiddleware:
+    '''
+        Pure ASGI middleware running, in order, the request logger, the unknown path check,
+        the CORS preflight answer, the security/CORS response headers, the session check and
+        the `@rate_limit` of the endpoint (per user, or per client IP on whitelisted paths).
+
+        Replaces the former `LoggerMiddleware`, `NotFoundMiddleware`, `SecurityHeadersMiddleware`,
+        `AuthMiddleware` and `CORSMiddleware` stack. Header blocks and fixed responses are built once.
+        WebSocket and lifespan scopes are passed through untouched.
+
+        Known paths come from a `RouteMatcher` compiled on the first request from the application's
+        route table (plus "/"), unless `routes` is given. FastAPI's documentation routes (/docs,
+        /redoc, /openapi.json) are left out and answered 404, like any unknown path.
+    '''
+    URL_WIDTH = 15
+    METHOD_WIDTH = 5
+
+    # FastAPI attributes holding the paths of its documentation routes
+    DOCS_URL_ATTRIBUTES = ("openapi_url", "docs_url", "redoc_url", "swagger_ui_oauth2_redirect_url")
+
+    METHOD_COLORS = {
+        "GET": Fore.BLUE,
+        "POST": Fore.GREEN,
+        "DELETE": Fore.RED,
+        "PUT": Fore.YELLOW,
+        "PATCH": Fore.MAGENTA,
+    }
+
+    def __init__(self, app, routes: Iterable[str] = None, auth_service=None, rate_limit_service=None):
+        self.app = app
+        self.routes: RouteMatcher = None
+        if routes is not None:
+            self.routes = RouteMatcher()
+            for path in routes:
+                self.routes.add(path, {})
+        self.whitelist = frozenset(["/auth/register", "/auth/login", "/auth/refresh", "/health"])
+        self.auth_service = auth_service or AuthService()
+        self.rate_limit_service = rate_limit_service or RateLimitService()
+        self.logger = CustomLogger()._get_logger()
+
+        cors_headers = {
+            "Access-Control-Allow-Origin": os.getenv("ALLOWED_ORIGINS", "*"),
+            "Access-Control-Allow-Credentials": "true",
+            "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type, Authorization, X-Requested-With, Accept",
+            "Access-Control-Expose-Headers": "Set-Cookie, X-Next-Cursor"
+        }
+        security_headers = {
+            "X-Content-Type-Options": "nosniff",
+            "X-Frame-Options": "DENY",
+            "X-XSS-Protection": "1; mode=block",
+            "Content-Security-Policy": "default-src 'self'",
+            **cors_headers
+        }
+        self.response_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in security_headers.items()]
+        self.response_header_names = frozenset(k for k, _ in self.response_headers)
+
+        self.preflight_response = Response(status_code=204, headers=cors_headers)
+        self.not_found_response = JSONResponse(
+            content={"message": "Not Found", "detail": "The requested resource was not found."},
+            status_code=404
+        )
+        self.welcome_response = JSONResponse(content={"message": "Welcome to the SDAS API!"}, status_code=200)
+        self.missing_session_response = JSONResponse(
+            content={"message": "Unauthorized", "detail": "Missing session token"},
+            status_code=401
+        )
+        self.invalid_session_response = JSONResponse(
+            content={"message": "Unauthorized", "detail": "Invalid or expired session token"},
+            status_code=401
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+
+        async def send_logged(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.__handle(scope, receive, send_logged)
+        finally:
+            self.__log(scope, status_code, (time.perf_counter() - start_time) * 1000)
+
+    async def __handle(self, scope, receive, send):
+        if self.routes is None:
+            app = scope["app"]
+            docs_paths = {getattr(app, name, None) for name in self.DOCS_URL_ATTRIBUTES} - {None}
+            self.routes = RouteMatcher.from_routes(route for route in app.routes if getattr(route, "path", None) not in docs_paths)
+            self.routes.add("/", {})
+
+        path = scope["path"]
+        routes_by_method = self.routes.get(path)
+        if routes_by_method is None:
+            await self.not_found_response(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            await self.preflight_response(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                headers = [(k, v) for k, v in message.get("headers", []) if k not in self.response_header_names]
+                headers.extend(self.response_headers)
+                message["headers"] = headers
+            await send(message)
+
+        # Skip authentication for whitelisted paths
+        if path in self.whitelist:
+            client_ip = scope["client"][0] if scope.get("client") else "unknown"
+            if await self.__check_rate_limit(scope, receive, send_with_headers, routes_by_method, f"ip:{client_ip}"):
+                await self.app(scope, receive, send_with_headers)
+            return
+
+        elif path == "/":
+            await self.welcome_response(scope, receive, send_with_headers)
+            return
+
+        # Check for session token in cookies
+        session_token = self.__get_session_token(scope)
+        if not session_token:
+            CustomLogger()._get_logger().warning(f"Missing session token: [{path}]")
+            await self.missing_session_response(scope, receive, send_with_headers)
+            return
+
+        user_id = await self.auth_service._validate_session(session_token)
+
+        if not user_id:
+            CustomLogger()._get_logger().warning(f"Invalid/expired session token: [{path}]")
+            await self.invalid_session_response(scope, receive, send_with_headers)
+            return
+
+        scope.setdefault("state", {})["user_id"] = str(user_id)
+
+        if await self.__check_rate_limit(scope, receive, send_with_headers, routes_by_method, f"uid:{user_id}"):
+            await self.app(scope, receive, send_with_headers)
+
+    async def __check_rate_limit(self, scope, receive, send, routes_by_method: dict, client_key: str) -> bool:
+        '''
+            Take a token of the endpoint's rate limit, answering 429 if none is left.
+
+            Returns:
+                bool: Whether the request may go on.
+        '''
+        route = routes_by_method.get(scope["method"])
+        limit = get_rate_limit(getattr(route, "endpoint", None))
+        if limit is None:
+            return True
+
+        allowed, retry_after = await self.rate_limit_service._hit(f"{scope['method']}:{route.path}:{client_key}", limit)
+        if allowed:
+            return True
+
+        CustomLogger()._get_logger().warning(f"Rate limit exceeded: [{scope['path']}] {client_key}")
+        response = JSONResponse(
+            content={"message": "Too Many Requests", "detail": f"Rate limit exceeded: {limit}"},
+            status_code=429,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+        await response(scope, receive, send)
+        return False
+
+    def __get_session_token(self, scope) -> str:
+        for key, value in scope["headers"]:
+            if key == b"cookie":
+                return cookie_parser(value.decode("latin-1")).get("session_token")
+        return None
+
+    def __log(self, scope, status_code: int, process_time: float):
+        method = scope["method"]
+        url = scope["path"]
+        client_ip = scope["client"][0] if scope.get("client") else "unknown"
+
+        colored_method = f"{self.METHOD_COLORS.get(method, Fore.CYAN)}{method:{self.METHOD_WIDTH}}{Fore.RESET}"
+
+        # Color formatting for status code
+        status_color = (
+            Fore.GREEN if status_code < 300
+            else Fore.YELLOW if status_code < 400
+            else Fore.RED
+        )
+        colored_status = f"{status_color}{status_code}{Fore.RESET}"
+
+        log_message = (
+            f"{colored_status} {Fore.CYAN}| "
+            f"{colored_method} {Fore.WHITE}{url:{self.URL_WIDTH}} {Fore.CYAN}| "
+            f"{Fore.MAGENTA}{client_ip} {Fore.YELLOW}+{int(process_time)}ms{Fore.RESET}"
+        )
+
+        if status_code < 400:
+            self.logger.info(log_message)
+        elif status_code < 500:
+            self.logger.warning(log_message)
+        else:
+            self.logger.error(log_message)
@@ -4,6 +4,7 @@ class IotCommand(Enum):
     FIELD_DEVICE_ID = "device_id"
     FIELD_COMMAND_ID = "command_id"
     FIELD_COMMAND = "command"
+    FIELD_COMMANDS = "commands"
     FIELD_TARGET = "target"
     FIELD_VALUE = "value"
 
@@ -12,12 +13,22 @@ class IotCommandResponse(Enum):
     FIELD_COMMAND_ID = "command_id"
     FIELD_STATUS = "status"
     FIELD_MESSAGE = "message"
+    FIELD_RESULTS = "results"
+    FIELD_UNCHANGED = "unchanged"   # Set by the server on commands skipped by the device twin
 
 class IotNotification(Enum):
     FIELD_DEVICE_ID = "device_id"
     FIELD_SERVICE_TYPE = "service_type"
     FIELD_DESCRIPTION = "description"
     FIELD_TIMESTAMP = "timestamp"
+    FIELD_VALUE = "value"
+
+class IotTelemetry(Enum):
+    FIELD_DEVICE_ID = "device_id"
+    FIELD_READINGS = "readings"
+    FIELD_SENSOR_TYPE = "sensor_type"
+    FIELD_VALUE = "value"
+    FIELD_TIMESTAMP = "timestamp"
 
 class SensorTypes(Enum):
     FIELD_TEMP = "temp"
@@ -48,6 +48,8 @@ class ServicesStatusDocument(Enum):
                         FIELD_LUX_THRESHOLD
                         ]
 
+    FIELD_HISTORY = 'history'   # Recent action history, "embedded" services status mode only
+
 class ActionHistoryDocument(Enum):
     FIELD_UID = 'uid'
 
@@ -62,4 +64,14 @@ class EnvironmentSensorDocument(Enum):
 
     FIELD_SENSOR_TYPE = "sensor_type"
     FIELD_VALUE = "value"
-    FIELD_TIMESTAMP = "timestamp"
\ No newline at end of file
+    FIELD_TIMESTAMP = "timestamp"
+
+    # Time-series layout: uid and sensor_type live in the bucket's meta field
+    FIELD_META = "meta"
+
+class MigrationDocument(Enum):
+    FIELD_NAME = '_id'
+    FIELD_LAST_ID = 'last_id'
+    FIELD_MIGRATED = 'migrated'
+    FIELD_SKIPPED = 'skipped'
+    FIELD_UPDATED_AT = 'updated_at'
\ No newline at end of file
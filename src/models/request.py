@@ -1,5 +1,6 @@
 from enum import Enum
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
+from datetime import datetime
 from typing import Literal, Optional
     
 class UserRequest(BaseModel):
@@ -15,6 +16,27 @@ class UserInfoRequest(BaseModel):
     
 class SensorDataRequest(BaseModel):
     sensor_types: list[Literal["temp", "humid", "lux", "dis"]] = Field(..., min_items=1, max_items=4)
+    fields: Optional[list[Literal["_id", "uid", "value", "timestamp"]]] = Field(None, min_items=1, max_items=4)
+
+class SensorHistoryRequest(BaseModel):
+    interval: float = Field(10, gt=0, le=86400)     # Seconds per point
+    points: int = Field(20, ge=1, le=500)
+    aggregate: Literal["last", "avg", "min", "max"] = "last"
+
+class ActionHistoryRequest(BaseModel):
+    cursor: Optional[str] = None                    # next_cursor of the previous page
+    page_size: int = Field(15, ge=1, le=100)
+    service_type: Optional[Literal["air_cond_service", "drowsiness_service", "headlight_service", "distance_service", "temp_threshold", "humid_threshold", "distance_threshold", "lux_threshold", "drowsiness_threshold", "system", "alarm_service", "air_cond_temp", "headlight_brightness"]] = None
+    since: Optional[datetime] = None                # Inclusive
+    until: Optional[datetime] = None                # Exclusive
+
+    @field_validator("since", "until")
+    @classmethod
+    def to_local_time(cls, value: Optional[datetime]) -> Optional[datetime]:
+        # Actions are stored with naive server local timestamps
+        if value is not None and value.tzinfo is not None:
+            return value.astimezone().replace(tzinfo=None)
+        return value
 
 class ServiceMode(str, Enum):
     AUTO = "auto"
@@ -33,14 +55,43 @@ class ControlServiceRequest(BaseModel):
     service_type: Literal["air_cond_service", "drowsiness_service", "headlight_service", "distance_service", "temp_threshold", "humid_threshold", "distance_threshold", "lux_threshold", "drowsiness_threshold", "system", "alarm_service"]
     value: str = Field(..., pattern=r"^(on|off|0|[1-9][0-9]*\.?[0-9]*)$")
 
+class ControlServicesRequest(BaseModel):
+    commands: list[ControlServiceRequest] = Field(..., min_items=1, max_items=10)
+
+    @field_validator("commands")
+    @classmethod
+    def check_commands(cls, commands: list[ControlServiceRequest]) -> list[ControlServiceRequest]:
+        service_types = [command.service_type for command in commands]
+        if "system" in service_types:
+            raise ValueError("system can not be batched, use /iot/on or /iot/off")
+        if len(set(service_types)) != len(service_types):
+            raise ValueError("each service_type can be set once per batch")
+        return commands
+
+class IOTCommandResult(BaseModel):
+    command_id: str
+    status: str
+    message: Optional[str] = None
+
 class IOTDataResponse(BaseModel):
     device_id: str
     command_id: str
     status: str
     message: Optional[str] = None
+    results: Optional[list[IOTCommandResult]] = None    # Per command of a batch
 
 class IOTNotification(BaseModel):
     device_id: str
     service_type: Literal["air_cond_service", "drowsiness_service", "headlight_service", "distance_service", "temp_threshold", "humid_threshold", "distance_threshold", "lux_threshold", "drowsiness_threshold", "system", "alarm_service"]
     description: str
-    timestamp: str
\ No newline at end of file
+    timestamp: str
+    value: Optional[str] = Field(None, pattern=r"^(on|off|0|[1-9][0-9]*\.?[0-9]*)$")   # New value of a service the device changed by itself
+
+class IOTReading(BaseModel):
+    sensor_type: Literal["temp", "humid", "lux", "dis"]
+    value: float
+    timestamp: Optional[datetime] = None    # Time of the server receiving the frame when omitted
+
+class IOTTelemetry(BaseModel):
+    device_id: str
+    readings: list[IOTReading] = Field(..., min_items=1, max_items=100)
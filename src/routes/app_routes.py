@@ -1,26 +1,48 @@
 from utils.custom_logger import CustomLogger
+from utils.rate_limiter import rate_limit
+
+from datetime import datetime
 
 from fastapi import APIRouter, Request, Depends
 from fastapi.responses import JSONResponse
-from slowapi import Limiter
-from slowapi.util import get_remote_address
+from pydantic import ValidationError
 
 from services.app_service import AppService
-from models.request import SensorDataRequest
+from models.common import SensorTypes
+from models.request import ActionHistoryRequest, SensorDataRequest, SensorHistoryRequest
 
 router = APIRouter()
-limiter = Limiter(key_func=get_remote_address)
 
 def get_user_id(request: Request) -> str: 
     return request.state.user_id
 
 @router.get("/events")
-@limiter.limit("20/minute")
-async def notification_stream(request: Request, uid: str = Depends(get_user_id)):
-    """Stream notifications to the client via SSE."""
-    CustomLogger()._get_logger().info(f"SSE connect SUCCESS: {{ userId: \"{uid}\" }}")
+@rate_limit("20/minute")
+async def notification_stream(
+    request: Request,
+    live: str = None,               # Optional comma-separated sensor types to receive live readings for
+    live_interval: float = None,    # Optional minimum seconds between two reading events
+    last_event_id: str = None,      # Optional replay start for clients that can not set the Last-Event-ID header
+    uid: str = Depends(get_user_id)
+):
+    """Stream notifications (and optionally live sensor readings) to the client via SSE."""
+    live_sensor_types = [s.strip() for s in live.split(',') if s.strip()] if live else []
+    sensor_type_values = [sensor_type.value for sensor_type in SensorTypes]
+    if any(sensor_type not in sensor_type_values for sensor_type in live_sensor_types):
+        CustomLogger()._get_logger().warning(f"SSE connect FAIL: {{ userId: \"{uid}\" }} invalid live sensor types \"{live}\"")
+        return JSONResponse(
+            content={"message": "Bad request", "detail": f"live must be a comma-separated list of {', '.join(sensor_type_values)}"},
+            status_code=422
+        )
+
+    CustomLogger()._get_logger().info(f"SSE connect SUCCESS: {{ userId: \"{uid}\", live: {live_sensor_types} }}")
     try:
-        return await AppService()._get_notification_stream(uid)
+        return await AppService()._get_notification_stream(
+            uid,
+            live_sensor_types,
+            live_interval,
+            last_event_id=request.headers.get("last-event-id") or last_event_id
+        )
     except Exception as e:
         CustomLogger()._get_logger().warning(f"SSE connect FAIL: {{ userId: \"{uid}\" }} {e.args[0]}")
         return JSONResponse(
@@ -32,6 +54,7 @@ async def notification_stream(request: Request, uid: str = Depends(get_user_id))
 async def get_sensor_data(
     request: Request,
     sensor_types: str,  # Receive as comma-separated string
+    fields: str = None,  # Optional comma-separated projection, e.g. "value,timestamp"
     uid: str = Depends(get_user_id)
 ):
     if not sensor_types:
@@ -44,9 +67,10 @@ async def get_sensor_data(
     try:
         # Split the comma-separated string and create the request object
         sensor_types_list = [s.strip() for s in sensor_types.split(',')]
-        request = SensorDataRequest(sensor_types=sensor_types_list)
+        fields_list = [f.strip() for f in fields.split(',')] if fields else None
+        request = SensorDataRequest(sensor_types=sensor_types_list, fields=fields_list)
         
-        data = AppService()._get_sensors_data(uid, request)
+        data = await AppService()._get_sensors_data(uid, request)
 
         sensor_types_str = ', '.join(request.sensor_types)
         CustomLogger()._get_logger().info(f"Get sensor_data SUCCESS: {{ userId: \"{uid}\", sensor_types: \"{sensor_types_str}\" }}")
@@ -63,13 +87,14 @@ async def get_sensor_data(
         )
 
 @router.get("/services_status")
-@limiter.limit("20/minute")
-async def get_services_status(request: Request, uid = Depends(get_user_id)):
+@rate_limit("20/minute")
+async def get_services_status(request: Request, history: bool = False, uid = Depends(get_user_id)):
     """
     Endpoint to get all services config information includes status and value.
+    With `history=true`, the recent action history is included as `history`.
     """
     try:
-        service_config_data = AppService()._get_services_status(uid)
+        service_config_data = await AppService()._get_services_status(uid, include_history=history)
         CustomLogger()._get_logger().info(f"Get services_status SUCCESS: {{ userId: \"{uid}\", result: {service_config_data} }}")
 
         return JSONResponse(
@@ -92,15 +117,44 @@ async def get_services_status(request: Request, uid = Depends(get_user_id)):
             )
     
 @router.get("/action_history")
-@limiter.limit("20/minute")
-async def get_all_action_history(request: Request, uid = Depends(get_user_id)):
+@rate_limit("20/minute")
+async def get_all_action_history(
+    request: Request,
+    cursor: str = None,             # X-Next-Cursor of the previous page
+    page_size: int = 15,
+    service_type: str = None,
+    since: datetime = None,         # Inclusive
+    until: datetime = None,         # Exclusive
+    uid = Depends(get_user_id)
+):
+    """
+    Endpoint to get a page of the action history, newest first.
+    The cursor of the next page is returned in the X-Next-Cursor header, absent on the last page.
+    """
+    try:
+        history_request = ActionHistoryRequest(cursor=cursor, page_size=page_size, service_type=service_type, since=since, until=until)
+    except ValidationError as e:
+        CustomLogger()._get_logger().warning(f"Get all action_history FAIL: {{ userId: \"{uid}\" }} invalid query")
+        return JSONResponse(
+            content={"message": "Bad request", "detail": e.errors(include_url=False, include_context=False)},
+            status_code=422
+        )
+
     try:
-        data = AppService()._get_all_action_history(uid)
-        CustomLogger()._get_logger().info(f"Get all action_history SUCCESS: {{ userId: \"{uid}\" }}")
+        data, next_cursor = await AppService()._get_all_action_history(uid, history_request)
+        CustomLogger()._get_logger().info(f"Get all action_history SUCCESS: {{ userId: \"{uid}\", count: {len(data)} }}")
 
         return JSONResponse(
             content=data,
-            status_code=200
+            status_code=200,
+            headers={"X-Next-Cursor": next_cursor} if next_cursor else None
+        )
+
+    except ValueError as e:
+        CustomLogger()._get_logger().warning(f"Get all action_history FAIL: {{ userId: \"{uid}\" }} {e.args[0]}")
+        return JSONResponse(
+            content={"message": "Bad request", "detail": e.args[0]},
+            status_code=400
         )
     
     except Exception as e:
@@ -123,14 +177,29 @@ async def send_mock_notification(uid = Depends(get_user_id)):
         CustomLogger()._get_logger().warning(f"Send mock notification FAIL: {{ userId: \"{uid}\" }} {e.args[0]}")
 
 @router.get("/all_sensor_data")
-@limiter.limit("20/minute")
-async def get_all_sensor_data(request: Request, uid: str = Depends(get_user_id)):
+@rate_limit("20/minute")
+async def get_all_sensor_data(
+    request: Request,
+    interval: float = 10,       # Seconds between two points
+    points: int = 20,           # Number of points per sensor type
+    aggregate: str = "last",    # last | avg | min | max
+    uid: str = Depends(get_user_id)
+):
     """
-    Endpoint to get all sensor data for a specific user.
+    Endpoint to get downsampled sensor history for a specific user.
     """
     try:
-        data = AppService()._get_all_sensor_data(uid)
-        CustomLogger()._get_logger().info(f"Get all sensor_data SUCCESS: {{ userId: \"{uid}\" }}")
+        history_request = SensorHistoryRequest(interval=interval, points=points, aggregate=aggregate)
+    except ValidationError as e:
+        CustomLogger()._get_logger().warning(f"Get all sensor_data FAIL: {{ userId: \"{uid}\" }} invalid query")
+        return JSONResponse(
+            content={"message": "Bad request", "detail": e.errors(include_url=False, include_context=False)},
+            status_code=422
+        )
+
+    try:
+        data = await AppService()._get_all_sensor_data(uid, history_request)
+        CustomLogger()._get_logger().info(f"Get all sensor_data SUCCESS: {{ userId: \"{uid}\", interval: {interval}, points: {points}, aggregate: \"{aggregate}\" }}")
         return JSONResponse(
             content=data,
             status_code=200
@@ -1,9 +1,8 @@
 from utils.custom_logger import CustomLogger
+from utils.rate_limiter import rate_limit
 
 from fastapi import APIRouter, Depends, Request, Response
 from starlette.responses import JSONResponse
-from slowapi import Limiter
-from slowapi.util import get_remote_address
 
 from pymongo.errors import PyMongoError
 
@@ -12,13 +11,12 @@ from services.auth_service import AuthService
 from models.request import UserRequest
 
 router = APIRouter()
-limiter = Limiter(key_func=get_remote_address)
 
 @router.post("/register")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def register(request: Request, user: UserRequest):
     try:
-        AuthService()._register(user)
+        await AuthService()._register(user)
         CustomLogger()._get_logger().info(f"Register SUCCESS: {{ username: \"{user.username}\"}}")
 
         return JSONResponse(
@@ -38,6 +36,12 @@ async def register(request: Request, user: UserRequest):
                 content={"message": "Register fail", "detail": e.args[0]},
                 status_code=409
             )
+        elif e.args[0] == "Server busy":
+            return JSONResponse(
+                content={"message": e.args[0], "detail": "Too many concurrent requests, retry later"},
+                status_code=503,
+                headers={"Retry-After": "1"}
+            )
         else:
             return JSONResponse(
                 content={"message": "Internal server error ", "detail": e.args[0]},
@@ -45,10 +49,10 @@ async def register(request: Request, user: UserRequest):
             )
 
 @router.post("/login")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def login(request: Request, response: Response, user: UserRequest):
     try:
-        userId, (session_token, refresh_token) = AuthService()._authenticate(user)
+        userId, (session_token, refresh_token) = await AuthService()._authenticate(user)
         CustomLogger()._get_logger().info(f"Login SUCCESS: {{ userId: \"{userId}\" }}")
 
         response = JSONResponse(
@@ -66,6 +70,12 @@ async def login(request: Request, response: Response, user: UserRequest):
                 content={"message": e.args[0], "detail": "Invalid username or password"},
                 status_code=401
             )
+        elif e.args[0] == "Server busy":
+            return JSONResponse(
+                content={"message": e.args[0], "detail": "Too many concurrent requests, retry later"},
+                status_code=503,
+                headers={"Retry-After": "1"}
+            )
         else:
             return JSONResponse(
                 content={"message": "Internal server error ", "detail": e.args[0]},
@@ -76,7 +86,7 @@ def get_user_id(request: Request) -> str:
     return request.state.user_id
 
 @router.patch("/refresh")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def refresh(request: Request, response: Response):
     input_refresh_token = request.cookies.get("refresh_token")
     if not input_refresh_token:
@@ -87,7 +97,7 @@ async def refresh(request: Request, response: Response):
         )
 
     try:
-        user_id, new_session_token = AuthService()._refresh_session(response, input_refresh_token)
+        user_id, new_session_token = await AuthService()._refresh_session(response, input_refresh_token)
 
         if new_session_token:
             CustomLogger()._get_logger().info(f"Refresh SUCCESS: {{ userId: \"{user_id}\" }}")
@@ -114,7 +124,7 @@ async def refresh(request: Request, response: Response):
         )
 
 @router.post("/logout")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def logout(request: Request, response: Response, uid: str = Depends(get_user_id)):
     session_token = request.cookies.get("session_token")
     refresh_token = request.cookies.get("refresh_token")
@@ -127,7 +137,7 @@ async def logout(request: Request, response: Response, uid: str = Depends(get_us
         )
 
     try:
-        result = AuthService()._delete_session(session_token, refresh_token)
+        result = await AuthService()._delete_session(session_token, refresh_token)
         if result:
             CustomLogger()._get_logger().info(f"Logout SUCCESS: {{ userId: \"{uid}\" }}")
             response = JSONResponse(
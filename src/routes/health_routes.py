@@ -0,0 +1,35 @@
+import os
+
+from fastapi import APIRouter, Request
+from starlette.responses import JSONResponse
+
+from services.database import Database
+from services.auth_service import AuthService
+from services.rate_limit_service import RateLimitService
+from services.sensor_writer import SensorWriter
+from services.service_change_writer import ServiceChangeWriter
+from services.message_bus import MessageBus
+from services.app_service import AppService
+
+router = APIRouter()
+
+def get_worker_stats() -> dict:
+    '''Counters of the pools, executors and buffers of this worker.'''
+    return {
+        "mongo_executor": Database()._instance.get_executor_stats(),
+        "redis_pool": AuthService()._get_redis_pool_stats(),
+        "password_executor": AuthService()._get_password_executor_stats(),
+        "session_cache": AuthService()._get_session_cache_stats(),
+        "rate_limit": RateLimitService()._get_stats(),
+        "sensor_writer": SensorWriter()._get_stats(),
+        "service_change_writer": ServiceChangeWriter()._get_stats(),
+        "sse_buffers": AppService()._get_buffer_stats(),
+    }
+
+@router.get("/health")
+async def health(request: Request):
+    """Liveness of the worker that answered, with its counters when HEALTH_STATS is enabled."""
+    content = {"status": "ok", "worker_id": MessageBus().worker_id}
+    if os.getenv("HEALTH_STATS", "False") == "True":
+        content["stats"] = get_worker_stats()
+    return JSONResponse(content=content, status_code=200)
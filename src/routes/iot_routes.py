@@ -1,16 +1,14 @@
 from utils.custom_logger import CustomLogger
+from utils.rate_limiter import rate_limit
 
 from fastapi import APIRouter, Request, Depends, WebSocket
 from fastapi.responses import JSONResponse
-from slowapi import Limiter
-from slowapi.util import get_remote_address
 
 from services.iot_service import IOTService
 from services.user_service import UserService
-from models.request import ControlServiceRequest
+from models.request import ControlServiceRequest, ControlServicesRequest
 
 router = APIRouter()
-limiter = Limiter(key_func=get_remote_address)
 
 def get_user_id(request: Request) -> str: 
     return request.state.user_id
@@ -27,7 +25,7 @@ async def websocket_endpoint(websocket: WebSocket, device_id: str = None):
         await websocket.close(code=1008, reason="WebSocket is required")
         return
     
-    check_user = UserService()._check_user_exist(device_id)
+    check_user = await UserService()._check_user_exist(device_id)
     if not check_user:
         CustomLogger()._get_logger().warning(f"Websocket connect FAIL: {{ deviceId: \"{device_id}\" }} user not found")
         await websocket.close(code=1008, reason="User not found for device ID")
@@ -41,7 +39,7 @@ async def websocket_endpoint(websocket: WebSocket, device_id: str = None):
         await websocket.close(code=1011, reason="Internal server error")
 
 @router.post('/on')
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def turn_on(request: Request, uid: str = Depends(get_user_id)):
     if request is None:
         CustomLogger()._get_logger().warning("Invalid request")
@@ -61,7 +59,7 @@ async def turn_on(request: Request, uid: str = Depends(get_user_id)):
         return JSONResponse(content={"message": "Failed to start system", "detail": str(e.args[0])}, status_code=500)
 
 @router.post('/off')
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def turn_off(request: Request, uid: str = Depends(get_user_id)):
     if request is None:
         CustomLogger()._get_logger().warning("Invalid request")
@@ -81,7 +79,7 @@ async def turn_off(request: Request, uid: str = Depends(get_user_id)):
         return JSONResponse(content={"message": "Failed to stop system", "detail": str(e.args[0])}, status_code=500)
 
 @router.patch("/service")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def control_service(request: Request, control_service_request: ControlServiceRequest, uid = Depends(get_user_id)):
     """
     Send control commands to IoT system websocket.
@@ -108,4 +106,34 @@ async def control_service(request: Request, control_service_request: ControlServ
             content={"message": "Failed to control service", "detail": str(e.args[0])},
             status_code=500
         )
- 
\ No newline at end of file
+
+@router.patch("/services")
+@rate_limit("20/minute")
+async def control_services(request: Request, control_services_request: ControlServicesRequest, uid = Depends(get_user_id)):
+    """
+    Send several control commands to IoT system websocket in one frame.
+    """
+    try:
+        results = await IOTService()._control_iot_services(
+            device_id=uid,
+            commands=[(command.service_type, command.value) for command in control_services_request.commands]
+        )
+        failed = [result for result in results if result["status"] != "success"]
+        CustomLogger()._get_logger().info(f"Control services SUCCESS: {{ commands: {len(results)}, failed: {len(failed)}, userId: \"{uid}\" }}")
+
+        if failed:
+            return JSONResponse(
+                content={"message": "Some service control requests failed", "results": results},
+                status_code=207
+            )
+        return JSONResponse(
+            content={"message": "Service control requests processed successfully", "results": results},
+            status_code=200
+        )
+
+    except Exception as e:
+        CustomLogger()._get_logger().warning(f"Failed to control services: {e.args[0]}")
+        return JSONResponse(
+            content={"message": "Failed to control services", "detail": str(e.args[0])},
+            status_code=500
+        )
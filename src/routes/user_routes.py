@@ -1,25 +1,23 @@
 from utils.custom_logger import CustomLogger
+from utils.rate_limiter import rate_limit
 
-from fastapi import APIRouter, Request, Depends, File, UploadFile
+from fastapi import APIRouter, Request, Depends
 from fastapi.responses import JSONResponse, StreamingResponse
-from slowapi import Limiter
-from slowapi.util import get_remote_address
 
 from services.user_service import UserService
 
 from models.request import UserInfoRequest
 
 router = APIRouter()
-limiter = Limiter(key_func=get_remote_address)
 
 def get_user_id(request: Request) -> str: 
     return request.state.user_id
 
 @router.get("/")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def get_user_info(request: Request, uid: str = Depends(get_user_id)):
     try:
-        user_data = UserService()._get_user_info(uid)
+        user_data = await UserService()._get_user_info(uid)
         CustomLogger()._get_logger().info(f"Get user_data SUCCESS: {{ userId: \"{uid}\" }}")
 
         return JSONResponse(
@@ -48,10 +46,10 @@ async def get_user_info(request: Request, uid: str = Depends(get_user_id)):
             )
     
 @router.patch("/")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def update_user_info(request: Request, user_info_request: UserInfoRequest, uid: str = Depends(get_user_id)):
     try:
-        UserService()._update_user_info(uid, user_info_request)
+        await UserService()._update_user_info(uid, user_info_request)
         CustomLogger()._get_logger().info(f"Update user_data SUCCESS: {{ userId: \"{uid}\", data: {user_info_request} }}")
 
         return JSONResponse(
@@ -79,10 +77,10 @@ async def update_user_info(request: Request, user_info_request: UserInfoRequest,
             )
     
 @router.delete("/")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def delete_user_info(request: Request, uid: str = Depends(get_user_id)):
     try:
-        UserService()._delete_user_account(uid)
+        await UserService()._delete_user_account(uid)
         CustomLogger()._get_logger().info(f"Delete user SUCCESS: {{ userId: \"{uid}\" }}")
         
         response = JSONResponse(
@@ -100,10 +98,10 @@ async def delete_user_info(request: Request, uid: str = Depends(get_user_id)):
         )
         
 @router.get("/avatar")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def get_user_avatar(request: Request, uid: str = Depends(get_user_id)):
     try:
-        file = UserService()._get_avatar(uid)
+        file = await UserService()._get_avatar(uid)
         CustomLogger()._get_logger().info(f"Get user_avatar SUCCESS: {{ userId: \"{uid}\", data: {file}}}")
 
         return StreamingResponse(file, media_type=file.content_type)
@@ -126,9 +124,16 @@ async def get_user_avatar(request: Request, uid: str = Depends(get_user_id)):
         )
 
 @router.put("/avatar")
-@limiter.limit("20/minute")
-async def update_user_avatar(request: Request, file: UploadFile = File(...), uid: str = Depends(get_user_id)):
+@rate_limit("20/minute")
+async def update_user_avatar(request: Request, uid: str = Depends(get_user_id)):
+    """
+    Endpoint to replace the user's avatar with the "file" part of a multipart form.
+    The body is parsed here rather than through a `File` parameter, which would receive all of it
+    before AVATAR_MAX_SIZE could be applied.
+    """
+    file = None
     try:
+        file = await UserService()._read_avatar_upload(request.headers, request.stream())
         result = await UserService()._update_avatar(uid, file)
         CustomLogger()._get_logger().info(f"Update user_avatar SUCCESS: {{ userId: \"{uid}\", result: {result}}}")
         
@@ -145,16 +150,35 @@ async def update_user_avatar(request: Request, file: UploadFile = File(...), uid
                 content={"message": e.args[0], "detail": "Can not find any document with the uid that extracted from cookie's session"},
                 status_code=404
             )
+        elif e.args[0] == "Avatar too large":
+            return JSONResponse(
+                content={"message": e.args[0], "detail": f"The avatar must not exceed {UserService.AVATAR_MAX_SIZE} bytes"},
+                status_code=413
+            )
+        elif e.args[0] == "Unsupported avatar type":
+            return JSONResponse(
+                content={"message": e.args[0], "detail": "The avatar must be a PNG, JPEG, GIF or WebP image"},
+                status_code=415
+            )
+        elif e.args[0] == "Invalid avatar form":
+            return JSONResponse(
+                content={"message": e.args[0], "detail": "The avatar must be sent as the \"file\" part of a multipart form"},
+                status_code=422
+            )
         return JSONResponse(
             content={"message": "Internal server error ", "detail": e.args[0]},
             status_code=500
         )
 
+    finally:
+        if file is not None:
+            await file.close()
+
 @router.delete("/avatar")
-@limiter.limit("20/minute")
+@rate_limit("20/minute")
 async def delete_user_avatar(request: Request, uid: str = Depends(get_user_id)):
     try:
-        UserService()._delete_avatar(uid)
+        await UserService()._delete_avatar(uid)
         CustomLogger()._get_logger().info(f"Delete user_avatar SUCCESS: {{ userId: \"{uid}\" }}")
 
         return JSONResponse(
@@ -1,20 +1,43 @@
 import asyncio
+import base64
 import json
-from typing import Dict
+import os
+import time
+from typing import Dict, Optional
 
 import datetime
 
+from bson import ObjectId
 from fastapi.responses import StreamingResponse
 from models.common import SensorTypes
 from utils.custom_logger import CustomLogger
 from services.database import Database
+from services.sensor_storage import SensorStorage
+from services.message_bus import MessageBus
+from services.service_change_writer import ServiceChangeWriter
+from services.services_status_storage import ServicesStatusStorage
+from services.device_twin import DeviceTwins
+from utils.ring_buffer import RingBuffer
 
-from models.request import SensorDataRequest
+from models.request import ActionHistoryRequest, SensorDataRequest, SensorHistoryRequest
 from models.mongo_doc import ActionHistoryDocument, EnvironmentSensorDocument, ServicesStatusDocument
 
+class ClientTopic:
+    '''
+        Events of one client on this worker, shared by all of its open streams.
+    '''
+    def __init__(self, max_size: int, policy: str):
+        self.buffer = RingBuffer(max_size, policy)  # (kind, event_id, payload) items
+        self.subscribers = 0                        # open notification streams
+        self.live_subscribers = 0                   # open streams with live readings
+        self.readings_subscribed = False
+        self.lock = asyncio.Lock()                  # Orders this client's bus (un)subscriptions
+
 class AppService:
     _instance = None
 
+    HEARTBEAT_FRAME = b": heartbeat\n\n"
+
     def __new__(cls):
         if not cls._instance:
             cls._instance = super(AppService, cls).__new__(cls)
@@ -22,38 +45,348 @@ class AppService:
         return cls._instance
 
     def _init_instance(self):
-        self.client_queues: Dict[str, asyncio.Queue] = {}  # client_id -> Queue
-        self._lock = asyncio.Lock()  # Protect queue creation/removal
+        self.client_topics: Dict[str, ClientTopic] = {}    # client_id -> topic
+        self.stream_cursors: Dict[str, str] = {}            # client_id -> id of the last notification read from the bus
+        self.readings_idle_until: Dict[str, float] = {}     # client_id -> loop time until which its readings are not published
+
+        self.LIVE_MIN_INTERVAL = float(os.getenv("SSE_LIVE_MIN_INTERVAL", 1.0))  # seconds between two reading events
+        self.NOTIFICATION_STREAM_MAXLEN = int(os.getenv("NOTIFICATION_STREAM_MAXLEN", 100))
+        self.NOTIFICATION_STREAM_TTL = float(os.getenv("NOTIFICATION_STREAM_TTL", 86400))  # seconds
+        self.NOTIFICATION_READ_BLOCK = 1.0  # seconds, also the delay before a new stream's uid is read
+
+        # Topics of clients without an open stream are kept SSE_BUFFER_TTL seconds for a reconnect
+        self.SSE_BUFFER_SIZE = int(os.getenv("SSE_BUFFER_SIZE", 100))
+        self.SSE_BUFFER_POLICY = os.getenv("SSE_BUFFER_POLICY", RingBuffer.POLICY_DROP_OLDEST)
+        self.SSE_BUFFER_TTL = float(os.getenv("SSE_BUFFER_TTL", 60))  # seconds
+        RingBuffer(1, self.SSE_BUFFER_POLICY)  # Fail on an invalid policy at startup
+
+        self.__buffer_stats = {
+            "dropped": 0,
+            "coalesced": 0,
+            "evicted_buffers": 0,
+            "evicted_events": 0,
+            "readings_skipped": 0,
+        }
+
+        # Comment frames sent on idle streams so proxies do not close them
+        self.SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))  # seconds
+
+        self.__streams_changed = asyncio.Event()
+        self.__reader_task: asyncio.Task = None
+        self.__sweeper_task: asyncio.Task = None
+        self.__heartbeat_task: asyncio.Task = None
+
+    async def _stop(self):
+        for task in (self.__reader_task, self.__sweeper_task, self.__heartbeat_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.__reader_task = None
+        self.__sweeper_task = None
+        self.__heartbeat_task = None
+
+    def _get_buffer_stats(self) -> dict:
+        return {
+            **self.__buffer_stats,
+            "buffers": len(self.client_topics),
+            "buffered_events": sum(len(topic.buffer) for topic in self.client_topics.values()),
+            "subscribers": sum(topic.subscribers for topic in self.client_topics.values()),
+        }
+
+    def __publish(self, client_id: str, kind: str, payload, key: str = None, event_id: str = None):
+        topic = self.client_topics.get(client_id)
+        if topic is None:
+            return
+
+        # A full buffer drops readings, which the next ones supersede, before any notification
+        result = topic.buffer.put((kind, event_id, payload), key=key, volatile=kind == "reading")
+        if result == RingBuffer.PUT_DROPPED:
+            self.__buffer_stats["dropped"] += 1
+        elif result == RingBuffer.PUT_COALESCED:
+            self.__buffer_stats["coalesced"] += 1
+
+    def __encode_notification(self, data: str, event_id: str = None) -> bytes:
+        # Encoded once per event, every stream of the client sends these same bytes
+        if event_id is None:
+            return f"data: {data}\n\n".encode()
+        return f"id: {event_id}\ndata: {data}\n\n".encode()
+
+    async def __send_heartbeats(self):
+        # One timer for every stream: wakes the topics with open streams, idle streams then send a comment frame
+        while True:
+            await asyncio.sleep(self.SSE_HEARTBEAT_INTERVAL)
+            for topic in list(self.client_topics.values()):
+                if topic.subscribers:
+                    topic.buffer.wake()
+
+    def __parse_event_id(self, event_id: str):
+        '''
+            Bus stream entry id "<ms>-<seq>" as a comparable tuple, None if malformed.
+        '''
+        try:
+            ms, seq = event_id.split("-")
+            return int(ms), int(seq)
+        except (AttributeError, ValueError):
+            return None
+
+    async def __sweep_buffers(self):
+        # Evict the topics of clients that closed their last stream more than SSE_BUFFER_TTL seconds ago,
+        # and the expired idle marks of readings
+        while True:
+            await asyncio.sleep(max(1.0, self.SSE_BUFFER_TTL / 2))
+
+            now = asyncio.get_running_loop().time()
+            for client_id, idle_until in list(self.readings_idle_until.items()):
+                if idle_until <= now:
+                    del self.readings_idle_until[client_id]
+
+            expired_before = time.monotonic() - self.SSE_BUFFER_TTL
+            for client_id, topic in list(self.client_topics.items()):
+                if not topic.subscribers and not topic.lock.locked() and topic.buffer.last_activity < expired_before:
+                    del self.client_topics[client_id]
+                    self.__buffer_stats["evicted_buffers"] += 1
+                    self.__buffer_stats["evicted_events"] += len(topic.buffer)
+
+    def __get_notification_stream_key(self, client_id: str) -> str:
+        return f"events:{client_id}"
+
+    def __get_readings_channel(self, client_id: str) -> str:
+        return f"readings:{client_id}"
 
     async def _add_notification(self, client_id: str, notification: dict):
-        """Add a notification to the client's queue."""
-        async with self._lock:
-            if client_id not in self.client_queues:
-                self.client_queues[client_id] = asyncio.Queue()
-            await self.client_queues[client_id].put(notification)
-            CustomLogger()._get_logger().info(f"Queued notification for client \"{client_id}\": {notification}")
-
-    async def _get_notification_stream(self, client_id: str):
-        """Stream notifications as SSE events."""
+        """
+        Publish a notification to every open stream of the client, on any worker.
+
+        The notification is serialized once and appended to the client's `events:{client_id}` bus
+        stream; each worker's reader encodes it once more into the SSE frame its streams share.
+        """
+        data = json.dumps(notification)
+        fields = {"data": data}
+        if notification.get("service_type"):
+            fields["key"] = notification["service_type"]  # Coalescing key of the SSE buffers
+
+        try:
+            await MessageBus()._append(
+                self.__get_notification_stream_key(client_id),
+                fields,
+                maxlen=self.NOTIFICATION_STREAM_MAXLEN,
+                ttl=self.NOTIFICATION_STREAM_TTL
+            )
+        except Exception as e:
+            # Streams on this worker still get it
+            CustomLogger()._get_logger().warning(f"Notification bus error: {{ userId: \"{client_id}\" }} {e}")
+            self.__publish(client_id, "notification", self.__encode_notification(data), key=fields.get("key"))
+
+        CustomLogger()._get_logger().info(f"Queued notification for client \"{client_id}\": {notification}")
+
+    async def _add_readings(self, client_id: str, readings: list):
+        """
+        Forward freshly ingested readings to the client's live streams, on any worker.
+
+        A publish no worker received marks the client idle: its readings are dropped without a bus
+        round trip for SSE_LIVE_MIN_INTERVAL seconds, then the next publish probes again. A live
+        stream opened on another worker meanwhile gets its first reading event at most that late,
+        which its rate allows anyway.
+        """
+        loop = asyncio.get_running_loop()
+        idle_until = self.readings_idle_until.get(client_id)
+        if idle_until is not None and loop.time() < idle_until:
+            self.__buffer_stats["readings_skipped"] += 1
+            return
+
+        try:
+            delivered = await MessageBus()._publish(self.__get_readings_channel(client_id), {"readings": readings})
+        except Exception as e:
+            CustomLogger()._get_logger().warning(f"Notification bus error: {{ userId: \"{client_id}\" }} readings not published {e}")
+            return
+
+        if delivered:
+            self.readings_idle_until.pop(client_id, None)
+        else:
+            self.readings_idle_until[client_id] = loop.time() + self.LIVE_MIN_INTERVAL
+
+    async def __deliver_readings(self, client_id: str, readings: list):
+        self.__publish(client_id, "reading", readings)
+
+    async def __read_notifications(self):
+        # One reader per worker, following the bus stream of every client with an open stream here
+        while True:
+            if not self.stream_cursors:
+                self.__streams_changed.clear()
+                await self.__streams_changed.wait()
+                continue
+
+            streams = {self.__get_notification_stream_key(client_id): cursor for client_id, cursor in self.stream_cursors.items()}
+            try:
+                result = await MessageBus()._read(streams, block=self.NOTIFICATION_READ_BLOCK)
+            except Exception as e:
+                CustomLogger()._get_logger().warning(f"Notification bus read FAIL: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for stream, entries in result:
+                client_id = stream[len(self.__get_notification_stream_key("")):]
+                if client_id not in self.stream_cursors:
+                    continue  # Last stream closed during the read
+                for entry_id, fields in entries:
+                    self.stream_cursors[client_id] = entry_id
+                    self.__publish(
+                        client_id,
+                        "notification",
+                        self.__encode_notification(fields["data"], entry_id),
+                        key=fields.get("key"),
+                        event_id=entry_id
+                    )
+
+    async def __open_stream(self, client_id: str, live: bool) -> ClientTopic:
+        topic = self.client_topics.get(client_id)
+        if topic is None:
+            topic = self.client_topics[client_id] = ClientTopic(self.SSE_BUFFER_SIZE, self.SSE_BUFFER_POLICY)
+
+        topic.subscribers += 1
+        if live:
+            topic.live_subscribers += 1
+
+        # Only the bus (un)subscriptions of this client are ordered, other clients are not held up
+        async with topic.lock:
+            if topic.subscribers and client_id not in self.stream_cursors:
+                try:
+                    cursor = await MessageBus()._last_id(self.__get_notification_stream_key(client_id))
+                except Exception as e:
+                    CustomLogger()._get_logger().warning(f"Notification bus error: {{ userId: \"{client_id}\" }} {e}")
+                    cursor = f"{int(time.time() * 1000)}-0"
+                if topic.subscribers:
+                    self.stream_cursors[client_id] = cursor
+                    self.__streams_changed.set()
+
+            if topic.live_subscribers and not topic.readings_subscribed:
+                await MessageBus()._subscribe(
+                    self.__get_readings_channel(client_id),
+                    lambda message: self.__deliver_readings(client_id, message["readings"])
+                )
+                topic.readings_subscribed = True
+                # A device connected to this worker publishes again at once
+                self.readings_idle_until.pop(client_id, None)
+
+        if self.__reader_task is None or self.__reader_task.done():
+            self.__reader_task = asyncio.create_task(self.__read_notifications())
+        if self.__sweeper_task is None or self.__sweeper_task.done():
+            self.__sweeper_task = asyncio.create_task(self.__sweep_buffers())
+        if self.__heartbeat_task is None or self.__heartbeat_task.done():
+            self.__heartbeat_task = asyncio.create_task(self.__send_heartbeats())
+
+        return topic
+
+    async def __close_stream(self, client_id: str, topic: ClientTopic, live: bool):
+        topic.subscribers -= 1
+        if live:
+            topic.live_subscribers -= 1
+        if not topic.subscribers:
+            self.stream_cursors.pop(client_id, None)
+
+        async with topic.lock:
+            if not topic.live_subscribers and topic.readings_subscribed:
+                await MessageBus()._unsubscribe(self.__get_readings_channel(client_id))
+                topic.readings_subscribed = False
+
+    async def _get_notification_stream(self, client_id: str, live_sensor_types: list = None, live_interval: float = None, last_event_id: str = None):
+        """
+        Stream notifications as SSE events.
+
+        Every open stream of a client gets every notification: streams read the client's topic at
+        their own cursor and send the frame encoded once for all of them.
+
+        Notifications carry their bus stream entry id as SSE event id. With `last_event_id` (the
+        `Last-Event-ID` of a reconnecting client), the notifications after it that are still in the
+        bus stream are replayed first. Idle streams get a comment frame every SSE_HEARTBEAT_INTERVAL.
+
+        With `live_sensor_types`, the stream also carries `reading` events with the latest values of
+        those sensors. Only values that changed since the previous reading event are sent, and at
+        most one reading event is sent every `live_interval` seconds (never below SSE_LIVE_MIN_INTERVAL).
+        """
+        live_sensor_types = set(live_sensor_types or [])
+        live_interval = max(live_interval or self.LIVE_MIN_INTERVAL, self.LIVE_MIN_INTERVAL)
+        replay_after = last_event_id if self.__parse_event_id(last_event_id) else None
+
         async def event_generator():
-            async with self._lock:
-                if client_id not in self.client_queues:
-                    self.client_queues[client_id] = asyncio.Queue()
+            topic = await self.__open_stream(client_id, bool(live_sensor_types))
+            buffer = topic.buffer
+
+            loop = asyncio.get_running_loop()
+            last_sent = {}          # sensor_type -> value in the previous reading event
+            pending = {}            # sensor_type -> newest changed reading not sent yet
+            next_reading_at = 0.0
+            last_event = None       # id of the newest notification sent, as a tuple
+            cursor = buffer.last_seq
+            wakeups_seen = buffer.wakeups
 
             try:
+                if replay_after:
+                    try:
+                        entries = await MessageBus()._range(
+                            self.__get_notification_stream_key(client_id),
+                            replay_after,
+                            count=self.NOTIFICATION_STREAM_MAXLEN
+                        )
+                    except Exception as e:
+                        CustomLogger()._get_logger().warning(f"Notification replay FAIL: {{ userId: \"{client_id}\" }} {e}")
+                        entries = []
+
+                    for entry_id, fields in entries:
+                        yield self.__encode_notification(fields["data"], entry_id)
+                        last_event = self.__parse_event_id(entry_id)
+                    CustomLogger()._get_logger().info(f"Replayed notifications: {{ userId: \"{client_id}\", after: \"{replay_after}\", count: {len(entries)} }}")
+
                 while True:
-                    notification = await self.client_queues[client_id].get()
-                    yield f"data: {json.dumps(notification)}\n\n"
-                    CustomLogger()._get_logger().info(f"Sent notification: {{ userId: \"{client_id}\", notification: {notification} }} ")
-                    self.client_queues[client_id].task_done()
+                    timeout = max(0.0, next_reading_at - loop.time()) if pending else None
+                    try:
+                        entry = await buffer.read(cursor, timeout, wakeups_seen=wakeups_seen)
+                    except asyncio.TimeoutError:
+                        entry = None
+
+                    kind, event_id, payload = None, None, None
+                    if entry is not None:
+                        cursor, (kind, event_id, payload) = entry
+                    elif wakeups_seen != buffer.wakeups:
+                        wakeups_seen = buffer.wakeups
+                        yield self.HEARTBEAT_FRAME
+
+                    if kind == "reading":
+                        for reading in payload:
+                            sensor_type = reading[EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value]
+                            if sensor_type not in live_sensor_types:
+                                continue
+                            if last_sent.get(sensor_type) == reading[EnvironmentSensorDocument.FIELD_VALUE.value]:
+                                pending.pop(sensor_type, None)
+                            else:
+                                pending[sensor_type] = reading
+
+                    elif kind == "notification":
+                        event = self.__parse_event_id(event_id)
+                        if event is not None and last_event is not None and event <= last_event:
+                            continue  # Already replayed
+                        if event is not None:
+                            last_event = event
+                        yield payload
+                        wakeups_seen = buffer.wakeups
+
+                    if pending and loop.time() >= next_reading_at:
+                        yield f"event: reading\ndata: {json.dumps(list(pending.values()))}\n\n".encode()
+                        for sensor_type, reading in pending.items():
+                            last_sent[sensor_type] = reading[EnvironmentSensorDocument.FIELD_VALUE.value]
+                        pending.clear()
+                        next_reading_at = loop.time() + live_interval
 
             except asyncio.CancelledError:
-                async with self._lock:
-                    if client_id in self.client_queues and self.client_queues[client_id].empty():
-                        del self.client_queues[client_id]
                 CustomLogger()._get_logger().info(f"Closed notification stream: {{ userId: \"{client_id}\" }}")
                 raise
 
+            finally:
+                await self.__close_stream(client_id, topic, bool(live_sensor_types))
+
         return StreamingResponse(
             event_generator(),
             media_type="text/event-stream",
@@ -82,12 +415,14 @@ class AppService:
 
         return init_services_status_data
 
-    def _get_newest_sensor_data(self, uid: str = None, sensor_type: str = None) -> dict:
+    async def _get_newest_sensor_data(self, uid: str = None, sensor_type: str = None) -> dict:
         """Get the newest sensor data for a specific user and sensor type."""
-        data = Database()._instance.get_env_sensor_collection().find_one(
+        storage = SensorStorage()
+        data = await Database()._instance.run(
+            storage._get_collection().find_one,
             {
-                EnvironmentSensorDocument.FIELD_UID.value: uid,
-                EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: sensor_type
+                storage._field(EnvironmentSensorDocument.FIELD_UID): uid,
+                storage._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE): sensor_type
             },
             sort=[(EnvironmentSensorDocument.FIELD_TIMESTAMP.value, -1)]  # Sort by timestamp in descending order
         )
@@ -95,27 +430,99 @@ class AppService:
         if data and data['_id']:
             data['_id'] = str(data['_id'])
 
+        return self._serialize_sensor_data(storage._flatten(data))
+
+    def _serialize_sensor_data(self, data: dict) -> dict:
+        """Make a reading JSON serializable, native datetimes become ISO strings."""
+        if data and isinstance(data.get(EnvironmentSensorDocument.FIELD_TIMESTAMP.value), datetime.datetime):
+            data[EnvironmentSensorDocument.FIELD_TIMESTAMP.value] = data[EnvironmentSensorDocument.FIELD_TIMESTAMP.value].isoformat()
         return data
 
-    def _get_sensors_data(self, uid: str = None, request: SensorDataRequest = None) -> list:
-        """Get the newest sensor data for multiple sensor types."""
+    def _build_newest_sensor_data_pipeline(self, uid: str = None, sensor_types: list = None, fields: list = None) -> list:
+        """Aggregation returning the newest document per sensor type for a user, optionally projected to `fields`."""
+        storage = SensorStorage()
+        pipeline = [
+            {
+                "$match": {
+                    storage._field(EnvironmentSensorDocument.FIELD_UID): uid,
+                    storage._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE): {"$in": sensor_types}
+                }
+            },
+            # Same key order as the (uid, sensor_type, timestamp desc) index so $group/$first can walk it
+            {
+                "$sort": {
+                    storage._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE): 1,
+                    EnvironmentSensorDocument.FIELD_TIMESTAMP.value: -1
+                }
+            },
+            {
+                "$group": {
+                    "_id": f"${storage._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE)}",
+                    "doc": {"$first": "$$ROOT"}
+                }
+            },
+            {"$replaceRoot": {"newRoot": "$doc"}},
+            *storage._get_flatten_stages()
+        ]
+
+        if fields:
+            projection = {field: 1 for field in fields}
+            projection[EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value] = 1
+            if '_id' not in fields:
+                projection['_id'] = 0
+            pipeline.append({"$project": projection})
+
+        return pipeline
+
+    async def _get_sensors_data(self, uid: str = None, request: SensorDataRequest = None) -> list:
+        """Get the newest sensor data for multiple sensor types in a single round trip."""
         sensor_types = request.sensor_types
 
-        data = []
-        for sensor_type in sensor_types:
-            newest_data = self._get_newest_sensor_data(uid, sensor_type)
-            if newest_data:
-                newest_data[EnvironmentSensorDocument.FIELD_TIMESTAMP.value] = newest_data[EnvironmentSensorDocument.FIELD_TIMESTAMP.value]
-                data.append(newest_data)
+        newest_data = await Database()._instance.run(
+            lambda: list(SensorStorage()._get_collection().aggregate(
+                self._build_newest_sensor_data_pipeline(uid, sensor_types, request.fields)
+            ))
+        )
 
-        return data
+        by_type = {}
+        for doc in newest_data:
+            if '_id' in doc:
+                doc['_id'] = str(doc['_id'])
+            by_type[doc[EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value]] = self._serialize_sensor_data(doc)
+
+        # Keep the order the sensor types were requested in
+        return [by_type[sensor_type] for sensor_type in sensor_types if sensor_type in by_type]
     
-    def _get_services_status(self, uid: str = None):
-        """Get services status from the database by user id."""
-        services_status = Database()._instance.get_services_status_collection().find_one({'uid': uid})
+    async def _get_services_status(self, uid: str = None, include_history: bool = False):
+        """
+        Get services status from the database by user id.
+
+        With `include_history`, the recent action history comes along as `history`; in the "embedded"
+        services status mode both are read with the same find_one. Without it, the status of a device
+        connected to this worker is served by its twin once loaded.
+        """
+        twin = DeviceTwins()._get(uid)
+        if twin is not None and twin.loaded and not include_history:
+            return twin.get_status()
+
+        storage = ServicesStatusStorage()
+        projection = None
+        if storage._is_embedded() and not include_history:
+            projection = {ServicesStatusDocument.FIELD_HISTORY.value: 0}
+
+        services_status = await Database()._instance.run(
+            Database()._instance.get_services_status_collection().find_one,
+            {'uid': uid},
+            projection
+        )
         
         if not services_status:
             raise Exception("Service config not find")
+
+        # Changes still in the write-behind buffer are newer than the stored document
+        services_status.update(ServiceChangeWriter()._get_pending_status(uid))
+        if twin is not None and not twin.loaded:
+            twin.load(services_status)
         
         data = {}
         for key in ServicesStatusDocument.ALL_SERVICE_FIELDS.value:
@@ -124,85 +531,254 @@ class AppService:
         for key in ServicesStatusDocument.ALL_VALUE_FIELDS.value:
             data[key] = services_status[key]
 
+        if include_history:
+            if storage._is_embedded():
+                action_history, _ = await self.__page_embedded_history(uid, storage._get_history(services_status), ActionHistoryRequest())
+            else:
+                action_history, _ = await self._get_all_action_history(uid)
+            data[ServicesStatusDocument.FIELD_HISTORY.value] = action_history
+
         return data
     
-    def _toggle_all_service_status(self, uid: str, is_turning_on: bool, session):
-        data = {
+    def _build_toggle_all_service_fields(self, is_turning_on: bool) -> dict:
+        """`services_status` fields set when the whole system is turned on or off."""
+        return {
             ServicesStatusDocument.FIELD_SYSTEM_STATUS.value: "on" if is_turning_on else "off",
             ServicesStatusDocument.FIELD_AIR_COND_SERVICE.value: "on" if is_turning_on else "off",
             ServicesStatusDocument.FIELD_DISTANCE_SERVICE.value: "on" if is_turning_on else "off",
             ServicesStatusDocument.FIELD_DROWSINESS_SERVICE.value: "on" if is_turning_on else "off",
             ServicesStatusDocument.FIELD_HEADLIGHT_SERVICE.value: "on" if is_turning_on else "off",
         }
-        if (not is_turning_on):
-            data[ServicesStatusDocument.FIELD_AIR_COND_TEMP.value] = 0
-            data[ServicesStatusDocument.FIELD_HEADLIGHT_BRIGHTNESS.value] = 0
-            
 
-        Database()._instance.get_services_status_collection().update_one(
-            { 'uid': uid },
-            {
-                "$set": {
-                    ServicesStatusDocument.FIELD_SYSTEM_STATUS.value: "on" if is_turning_on else "off",
-                    ServicesStatusDocument.FIELD_AIR_COND_SERVICE.value: "on" if is_turning_on else "off",
-                    ServicesStatusDocument.FIELD_DISTANCE_SERVICE.value: "on" if is_turning_on else "off",
-                    ServicesStatusDocument.FIELD_DROWSINESS_SERVICE.value: "on" if is_turning_on else "off",
-                    ServicesStatusDocument.FIELD_HEADLIGHT_SERVICE.value: "on" if is_turning_on else "off",
-                }
-            },
-            session=session
-        )
-    
-    def _get_all_action_history(self, uid: str = None):
-        action_history = Database()._instance.get_action_history_collection().find(
-            {
-                ActionHistoryDocument.FIELD_UID.value: uid
-            },
-            sort=[(ActionHistoryDocument.FIELD_TIMESTAMP.value, -1)],  # Sort by timestamp in descending order
-            limit=15
-        )
+    def _encode_action_history_cursor(self, action: dict) -> Optional[str]:
+        """Cursor of the page after `action`, None for an action without a native timestamp or _id."""
+        timestamp = action.get(ActionHistoryDocument.FIELD_TIMESTAMP.value)
+        if not isinstance(timestamp, datetime.datetime) or '_id' not in action:
+            return None
+        return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{action['_id']}".encode()).decode()
+
+    def _decode_action_history_cursor(self, cursor: str) -> tuple:
+        """(timestamp, _id) of the last action of the previous page."""
+        try:
+            timestamp, action_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return datetime.datetime.fromisoformat(timestamp), ObjectId(action_id)
+        except Exception as e:
+            raise ValueError("Invalid cursor") from e
+
+    def _build_action_history_query(self, uid: str = None, request: ActionHistoryRequest = None) -> dict:
+        """
+        Newest-first page of a user's action history, keyset paginated on (timestamp, _id).
+
+        The page after a cursor starts strictly below the cursor's (timestamp, _id), so every page is
+        one index range scan however deep it is. One more action than the page size is read to tell
+        whether there is a next page.
+        """
+        request = request or ActionHistoryRequest()
+        query_filter = {
+            ActionHistoryDocument.FIELD_UID.value: uid
+        }
+
+        if request.service_type:
+            query_filter[ActionHistoryDocument.FIELD_SERVICE_TYPE.value] = request.service_type
+
+        time_range = {}
+        if request.since:
+            time_range["$gte"] = request.since
+        if request.until:
+            time_range["$lt"] = request.until
+        if time_range:
+            query_filter[ActionHistoryDocument.FIELD_TIMESTAMP.value] = time_range
+
+        if request.cursor:
+            timestamp, action_id = self._decode_action_history_cursor(request.cursor)
+            query_filter["$or"] = [
+                {ActionHistoryDocument.FIELD_TIMESTAMP.value: {"$lt": timestamp}},
+                {ActionHistoryDocument.FIELD_TIMESTAMP.value: timestamp, "_id": {"$lt": action_id}}
+            ]
+
+        return {
+            "filter": query_filter,
+            "sort": [(ActionHistoryDocument.FIELD_TIMESTAMP.value, -1), ("_id", -1)],  # Newest first
+            "limit": request.page_size + 1
+        }
+
+    def __matches_action_history_request(self, action: dict, request: ActionHistoryRequest) -> bool:
+        timestamp = action.get(ActionHistoryDocument.FIELD_TIMESTAMP.value)
+        if request.service_type and action.get(ActionHistoryDocument.FIELD_SERVICE_TYPE.value) != request.service_type:
+            return False
+        if request.since and timestamp < request.since:
+            return False
+        if request.until and timestamp >= request.until:
+            return False
+        return True
+
+    def __merge_pending_actions(self, uid: str, action_history: list, request: ActionHistoryRequest, has_more: bool) -> tuple:
+        """
+        Page of actions newest first, on the first page the ones still in the write-behind buffer on
+        top, and the cursor of the next page.
+        """
+        pending = []
+        if not request.cursor:
+            stored_ids = {action['_id'] for action in action_history if '_id' in action}
+            pending = [
+                dict(action) for action in reversed(ServiceChangeWriter()._get_pending_actions(uid))
+                if action.get('_id') not in stored_ids and self.__matches_action_history_request(action, request)
+            ]
+
+        actions = pending + action_history
+        page = actions[:request.page_size]
+        next_cursor = None
+        if page and (has_more or len(actions) > request.page_size):
+            next_cursor = self._encode_action_history_cursor(page[-1])
 
         data = []
-        for action in action_history:
-            action['_id'] = str(action['_id'])
-            action[ActionHistoryDocument.FIELD_TIMESTAMP.value] = action[ActionHistoryDocument.FIELD_TIMESTAMP.value]
+        for action in page:
+            action = dict(action)
             action.pop(ActionHistoryDocument.FIELD_UID.value, None)
             action.pop('_id', None)
+            if isinstance(action.get(ActionHistoryDocument.FIELD_TIMESTAMP.value), datetime.datetime):
+                action[ActionHistoryDocument.FIELD_TIMESTAMP.value] = action[ActionHistoryDocument.FIELD_TIMESTAMP.value].isoformat()
             data.append(action)
 
-        return data
+        return data, next_cursor
+
+    async def _get_all_action_history(self, uid: str = None, request: ActionHistoryRequest = None) -> tuple:
+        """
+        Page of a user's action history, newest first.
+
+        In the "embedded" services status mode, an unfiltered first page that fits the embedded
+        history is read from the status document, completed from the archive if the embedded history
+        is shorter; other pages come from the `action_history` archive.
+
+        Returns:
+            tuple: (actions, cursor of the next page or None).
+
+        Raises:
+            ValueError: If the cursor is invalid.
+        """
+        request = request or ActionHistoryRequest()
+        storage = ServicesStatusStorage()
+        unfiltered = not (request.cursor or request.service_type or request.since or request.until)
+
+        if storage._is_embedded() and unfiltered and request.page_size <= storage.history_size:
+            services_status = await Database()._instance.run(
+                Database()._instance.get_services_status_collection().find_one,
+                {'uid': uid},
+                {ServicesStatusDocument.FIELD_HISTORY.value: 1}
+            )
+            return await self.__page_embedded_history(uid, storage._get_history(services_status or {}), request)
+
+        action_history = await self.__find_action_history(uid, request)
+        return self.__merge_pending_actions(uid, action_history, request, len(action_history) > request.page_size)
+
+    async def __find_action_history(self, uid: str, request: ActionHistoryRequest) -> list:
+        query = self._build_action_history_query(uid, request)
+        return await Database()._instance.run(
+            lambda: list(Database()._instance.get_action_history_collection().find(**query))
+        )
+
+    async def __page_embedded_history(self, uid: str, embedded_history: list, request: ActionHistoryRequest) -> tuple:
+        """
+        Unfiltered first page from the embedded history, newest first.
+
+        Status documents written before the "embedded" mode have no or a short `history` array, the
+        older actions of their user are only in the archive: a history shorter than the page is
+        completed from `action_history`.
+        """
+        if len(embedded_history) >= request.page_size:
+            # Older actions are only archived
+            return self.__merge_pending_actions(uid, embedded_history, request, True)
+
+        archived = await self.__find_action_history(uid, request)
+        archived_ids = {action['_id'] for action in archived}
+        # Actions pushed to the embedded history but not archived yet are the newest
+        action_history = [action for action in embedded_history if action.get('_id') not in archived_ids] + archived
+        return self.__merge_pending_actions(uid, action_history, request, len(action_history) > request.page_size)
     
-    def _get_all_sensor_data(self, uid: str = None) -> dict:
-        """Get 20 newest data for each sensor type: temp, humid, dis, lux."""
-        result = {}
-        min_interval = datetime.timedelta(seconds=10)
+    def _build_sensor_history_pipeline(self, uid: str, sensor_types: list, interval: float, points: int, aggregate: str, now: datetime.datetime) -> list:
+        """
+        Aggregation that downsamples the last `points * interval` seconds of readings on the database side.
 
-        for sensor_type in SensorTypes:
-            cursor = Database()._instance.get_env_sensor_collection().find(
+        Readings are grouped into `points` buckets of `interval` seconds counted back from `now`
+        (bucket 0 is the newest); each bucket reduces its readings with `aggregate`. One $facet
+        branch per sensor type keeps everything in a single round trip.
+        """
+        storage = SensorStorage()
+        interval_ms = int(interval * 1000)
+        since = now - datetime.timedelta(milliseconds=interval_ms * points)
+
+        value_field = f"${EnvironmentSensorDocument.FIELD_VALUE.value}"
+        accumulators = {
+            "last": {"$first": value_field},  # Input is sorted newest first
+            "avg": {"$avg": value_field},
+            "min": {"$min": value_field},
+            "max": {"$max": value_field},
+        }
+
+        return [
+            {
+                "$match": {
+                    storage._field(EnvironmentSensorDocument.FIELD_UID): uid,
+                    storage._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE): {"$in": sensor_types},
+                    # Timestamps may be native dates or ISO strings, a range only matches values of its own type
+                    "$or": [
+                        {EnvironmentSensorDocument.FIELD_TIMESTAMP.value: {"$gte": since}},
+                        {EnvironmentSensorDocument.FIELD_TIMESTAMP.value: {"$gte": since.isoformat()}}
+                    ]
+                }
+            },
+            {"$sort": {EnvironmentSensorDocument.FIELD_TIMESTAMP.value: -1}},
+            {
+                "$project": {
+                    "_id": 0,
+                    EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: f"${storage._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE)}",
+                    EnvironmentSensorDocument.FIELD_VALUE.value: 1,
+                    "ts": {"$toDate": f"${EnvironmentSensorDocument.FIELD_TIMESTAMP.value}"}
+                }
+            },
+            {
+                "$facet": {
+                    sensor_type: [
+                        {"$match": {EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: sensor_type}},
+                        {
+                            "$bucket": {
+                                "groupBy": {"$floor": {"$divide": [{"$subtract": [now, "$ts"]}, interval_ms]}},
+                                "boundaries": list(range(points + 1)),
+                                "default": "outside",
+                                "output": {
+                                    EnvironmentSensorDocument.FIELD_VALUE.value: accumulators[aggregate],
+                                    EnvironmentSensorDocument.FIELD_TIMESTAMP.value: {"$max": "$ts"}
+                                }
+                            }
+                        },
+                        {"$match": {"_id": {"$ne": "outside"}}}
+                    ]
+                    for sensor_type in sensor_types
+                }
+            }
+        ]
+
+    async def _get_all_sensor_data(self, uid: str = None, request: SensorHistoryRequest = None) -> dict:
+        """Get downsampled history for each sensor type: temp, humid, dis, lux, newest point first."""
+        request = request or SensorHistoryRequest()
+        sensor_types = [sensor_type.value for sensor_type in SensorTypes]
+
+        pipeline = self._build_sensor_history_pipeline(
+            uid, sensor_types, request.interval, request.points, request.aggregate, datetime.datetime.now()
+        )
+        facets = await Database()._instance.run(
+            lambda: next(SensorStorage()._get_collection().aggregate(pipeline), {})
+        )
+
+        result = {}
+        for sensor_type in sensor_types:
+            result[sensor_type] = [
                 {
-                    EnvironmentSensorDocument.FIELD_UID.value: uid,
-                    EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: sensor_type.value
-                },
-                sort=[(EnvironmentSensorDocument.FIELD_TIMESTAMP.value, -1)],
-                limit=100
-            )
-            data = []
-            last_timestamp = None
-            for doc in cursor:
-                doc.pop('_id', None)
-                doc.pop('uid', None)
-                if EnvironmentSensorDocument.FIELD_TIMESTAMP.value in doc:
-                    ts = doc[EnvironmentSensorDocument.FIELD_TIMESTAMP.value]
-                    # Convert to datetime if needed
-                    if isinstance(ts, str):
-                        ts = datetime.datetime.fromisoformat(ts)
-                    if last_timestamp is None or (last_timestamp - ts) >= min_interval:
-                        doc[EnvironmentSensorDocument.FIELD_TIMESTAMP.value] = ts.isoformat()
-                        data.append(doc)
-                        last_timestamp = ts
-                if len(data) >= 20:
-                    break
-            result[sensor_type.value] = data
+                    EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: sensor_type,
+                    EnvironmentSensorDocument.FIELD_VALUE.value: bucket[EnvironmentSensorDocument.FIELD_VALUE.value],
+                    EnvironmentSensorDocument.FIELD_TIMESTAMP.value: bucket[EnvironmentSensorDocument.FIELD_TIMESTAMP.value].isoformat()
+                }
+                for bucket in facets.get(sensor_type, [])
+            ]
 
         return result
-    
\ No newline at end of file
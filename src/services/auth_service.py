@@ -1,13 +1,17 @@
+import asyncio
 import os
 from typing import Optional, Tuple
 
 from fastapi import Response
 from passlib.context import CryptContext
 import secrets
-from pymongo.errors import PyMongoError
-import redis
+from pymongo.errors import DuplicateKeyError
+from utils.custom_logger import CustomLogger
+from utils.ttl_cache import TTLCache
+from utils.bounded_executor import BoundedExecutor
 
 from services.database import Database
+from services.redis_client import RedisClient
 from services.app_service import AppService
 from services.user_service import UserService
 
@@ -17,11 +21,25 @@ from models.mongo_doc import UserDocument
 class AuthService:
     _instance = None
 
-    __pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
-
     FIELD_SESSION_TTL = 3600 # 1 hour
     FIELD_REFRESH_TTL = 604800 # 7 days
 
+    SESSION_INVALIDATION_CHANNEL = "session:invalidate"
+
+    # Returns {uid, ttl} of a session, pushing its expiry back only once less than ARGV[1] seconds are left
+    __VALIDATE_SESSION_SCRIPT = """
+        local uid = redis.call('GET', KEYS[1])
+        if not uid then
+            return {}
+        end
+        local ttl = redis.call('TTL', KEYS[1])
+        if ttl < tonumber(ARGV[1]) then
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+            ttl = tonumber(ARGV[2])
+        end
+        return {uid, ttl}
+    """
+
     def __new__(cls):
         if not cls._instance:
             cls._instance = super(AuthService, cls).__new__(cls)
@@ -36,27 +54,118 @@ class AuthService:
 
         self.SAMESITE_MODE = os.getenv("SAME_SITE")
 
-        self.__redis = redis.Redis(
-            host=os.getenv("REDIS_HOST"),
-            port=os.getenv("REDIS_PORT"),
-            decode_responses=True,
-            username="default",
-            password=os.getenv("REDIS_PASSWORD"),
+        # Hashes below BCRYPT_ROUNDS are deprecated and rehashed on the next successful login
+        self.__pwd_context = CryptContext(
+            schemes=['bcrypt'],
+            deprecated='auto',
+            bcrypt__rounds=int(os.getenv("BCRYPT_ROUNDS", 12)),
+            bcrypt__min_rounds=int(os.getenv("BCRYPT_ROUNDS", 12)),
+            bcrypt__max_rounds=int(os.getenv("BCRYPT_ROUNDS", 12))
         )
-        
-    def _hash_pw(self, password: str) -> str:
+        # bcrypt releases the GIL, so a thread pool keeps the hashing off the event loop;
+        # logins beyond the queue wait at most BCRYPT_QUEUE_TIMEOUT seconds before "Server busy"
+        self.__password_executor = BoundedExecutor(
+            name="bcrypt",
+            max_workers=int(os.getenv("BCRYPT_WORKERS", os.cpu_count() or 1)),
+            max_queue=int(os.getenv("BCRYPT_QUEUE", 64)),
+            queue_timeout=float(os.getenv("BCRYPT_QUEUE_TIMEOUT", 2))
+        )
+
+        self.__redis = RedisClient()._get_client()
+        self.__validate_session_script = self.__redis.register_script(AuthService.__VALIDATE_SESSION_SCRIPT)
+
+        self.SESSION_REFRESH_THRESHOLD = int(os.getenv("SESSION_REFRESH_THRESHOLD", 900))  # seconds
+
+        # Recently validated session tokens, only used while the invalidation listener runs
+        self.__session_cache = TTLCache(
+            max_size=int(os.getenv("SESSION_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("SESSION_CACHE_TTL", 30))
+        )
+        self.__session_cache_enabled = False
+        # Bumped by every eviction, a validation that raced one does not cache its result
+        self.__session_cache_generation = 0
+        self.__invalidation_task: asyncio.Task = None
+
+    async def _start(self):
+        '''
+            Start listening to the session invalidations published by every worker's `_delete_session`.
+        '''
+        if self.__invalidation_task is None:
+            self.__invalidation_task = asyncio.create_task(self.__listen_invalidations())
+
+    async def _stop(self):
+        if self.__invalidation_task is not None:
+            self.__invalidation_task.cancel()
+            try:
+                await self.__invalidation_task
+            except asyncio.CancelledError:
+                pass
+            self.__invalidation_task = None
+
+    async def __listen_invalidations(self):
+        # The local session cache is only enabled while subscribed: a missed invalidation could
+        # otherwise keep a logged out token valid on this worker.
+        while True:
+            pubsub = self.__redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.SESSION_INVALIDATION_CHANNEL)
+                self.__session_cache_enabled = True
+
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self.__evict_session(message["data"])
+
+            except Exception as e:
+                CustomLogger()._get_logger().warning(f"Session cache disabled, invalidation subscription lost: {e}")
+
+            finally:
+                self.__session_cache_enabled = False
+                self.__session_cache_generation += 1
+                self.__session_cache.clear()
+                await pubsub.aclose()
+
+            await asyncio.sleep(5)
+
+    def __evict_session(self, session_token: str):
+        self.__session_cache_generation += 1
+        self.__session_cache.delete(session_token)
+
+    def _get_session_cache_stats(self) -> dict:
+        return {**self.__session_cache.stats(), "enabled": self.__session_cache_enabled}
+
+    def _get_redis_pool_stats(self) -> dict:
+        return RedisClient()._get_pool_stats()
+
+    def _get_password_executor_stats(self) -> dict:
+        return self.__password_executor.stats()
+
+    async def _hash_pw(self, password: str) -> str:
         if not password:
             return None
         else:
-            return AuthService.__pwd_context.hash(password)
-    
-    def _verify_pw(self, hashed_pw: str, password: str) -> bool:
+            return await self.__password_executor.run(self.__pwd_context.hash, password)
+
+    async def _verify_pw(self, hashed_pw: str, password: str) -> bool:
+        valid, _ = await self._verify_and_update_pw(hashed_pw, password)
+        return valid
+
+    async def _verify_and_update_pw(self, hashed_pw: str, password: str) -> Tuple[bool, Optional[str]]:
+        '''
+            Verify a password against its hash.
+
+            Returns:
+                Tuple[bool, Optional[str]]: Whether the password matches, and a new hash if the stored one
+                uses a deprecated cost factor.
+
+            Raises:
+                Exception: "Server busy" if the password pool stays saturated.
+        '''
         if not hashed_pw or not password:
-            return False
+            return False, None
         else:
-            return AuthService.__pwd_context.verify(password, hashed_pw)
+            return await self.__password_executor.run(self.__pwd_context.verify_and_update, password, hashed_pw)
     
-    def _register(self, user_request: UserRequest) -> None:
+    async def _register(self, user_request: UserRequest) -> None:
         '''
         Register a new user in the database.
 
@@ -67,17 +176,18 @@ class AuthService:
             None
 
         Raises:
-            Exception: If the username already exists.
+            Exception: If the username already exists, or "Server busy" if the password pool stays saturated.
             PyMongoError: If there is an error during the database transaction.
         '''
 
-        if Database()._instance.get_user_collection().find_one({UserDocument.FIELD_USERNAME.value: user_request.username}):
-            raise Exception("Username already exists")
-        
-        hashed_pw = self._hash_pw(user_request.password)
+        # Duplicate usernames are rejected by the unique username index, no pre-check round trip needed
+        hashed_pw = await self._hash_pw(user_request.password)
         
         init_user_data = UserService()._create_init_user_data(user_request.username, hashed_pw)
 
+        await Database()._instance.run(self.__insert_new_user, init_user_data)
+
+    def __insert_new_user(self, init_user_data: dict) -> None:
         session = Database()._instance.client.start_session()
         try:
             with session.start_transaction():
@@ -93,11 +203,12 @@ class AuthService:
                     session=session
                 )
 
-        except PyMongoError as e:
-            session.abort_transaction()
-            raise e
+        except DuplicateKeyError:
+            raise Exception("Username already exists")
+        finally:
+            session.end_session()
     
-    def _authenticate(self, user_request: UserRequest) -> Tuple[Optional[str], Tuple[Optional[str], Optional[str]]]:
+    async def _authenticate(self, user_request: UserRequest) -> Tuple[Optional[str], Tuple[Optional[str], Optional[str]]]:
         '''
         Authenticate a user using the provided UserRequest object.
 
@@ -108,32 +219,51 @@ class AuthService:
             Tuple[Optional[str], Tuple[Optional[str], Optional[str]]]: A tuple containing the user ID, session token, and refresh token.
 
         Raises:
-            Exception: If the credentials are invalid or if the user_request object is not provided.
+            Exception: If the credentials are invalid or if the user_request object is not provided,
+                or "Server busy" if the password pool stays saturated.
         '''
 
-        user = Database()._instance.get_user_collection().find_one({
-            UserDocument.FIELD_USERNAME.value: user_request.username
-        })
-        if not (user and self._verify_pw(user[UserDocument.FIELD_PASSWORD.value], user_request.password)):
+        user = await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
+            {UserDocument.FIELD_USERNAME.value: user_request.username}
+        )
+        if not user:
             raise Exception("Invalid credentials")
-        
+
+        valid, new_hash = await self._verify_and_update_pw(user[UserDocument.FIELD_PASSWORD.value], user_request.password)
+        if not valid:
+            raise Exception("Invalid credentials")
+
         userId = str(user['_id'])
-        session_token, refresh_token = self.__create_session(userId)
+        if new_hash:
+            await self.__rehash_password(user['_id'], user[UserDocument.FIELD_PASSWORD.value], new_hash)
+
+        session_token, refresh_token = await self.__create_session(userId)
         return userId, (session_token, refresh_token)
     
-    def __create_session(self, uid: str) -> Tuple[Optional[str], Optional[str]]:
+    async def __rehash_password(self, _id, old_hash: str, new_hash: str) -> None:
+        # Only replace the hash that was verified, a concurrent password change wins
+        try:
+            await Database()._instance.run(
+                Database()._instance.get_user_collection().update_one,
+                {"_id": _id, UserDocument.FIELD_PASSWORD.value: old_hash},
+                {"$set": {UserDocument.FIELD_PASSWORD.value: new_hash}}
+            )
+        except Exception as e:
+            CustomLogger()._get_logger().warning(f"Password rehash FAIL: {{ userId: \"{_id}\" }} {e}")
+
+    async def __create_session(self, uid: str) -> Tuple[Optional[str], Optional[str]]:
         session_token = secrets.token_hex(16)
         refresh_token = secrets.token_hex(32)
 
-        try:
-            self.__redis.setex(f"session:{session_token}", self.FIELD_SESSION_TTL, uid)
-            self.__redis.setex(f"refresh:{refresh_token}", self.FIELD_REFRESH_TTL, uid)
+        async with self.__redis.pipeline(transaction=False) as pipe:
+            pipe.setex(f"session:{session_token}", self.FIELD_SESSION_TTL, uid)
+            pipe.setex(f"refresh:{refresh_token}", self.FIELD_REFRESH_TTL, uid)
+            await pipe.execute()
 
-            return session_token, refresh_token
-        except Exception as e:
-            raise e
+        return session_token, refresh_token
 
-    def _validate_session(self, session_token: str) -> Optional[str]:
+    async def _validate_session(self, session_token: str) -> Optional[str]:
         """Validate the session token and return the user ID if valid.
 
         Args:
@@ -142,14 +272,28 @@ class AuthService:
         Returns:
             Optional[str]: user ID if the session is valid, None otherwise.
         """
-        user_id = self.__redis.get(f"session:{session_token}")
-        if user_id:
-            self.__redis.expire(f"session:{session_token}", self.FIELD_SESSION_TTL)
-            return str(user_id)
-        
-        return None
+        if self.__session_cache_enabled:
+            user_id = self.__session_cache.get(session_token)
+            if user_id:
+                return user_id
+
+        # An invalidation handled while the script runs may concern this token, whose result is then stale
+        generation = self.__session_cache_generation
+        result = await self.__validate_session_script(
+            keys=[f"session:{session_token}"],
+            args=[self.SESSION_REFRESH_THRESHOLD, self.FIELD_SESSION_TTL]
+        )
+        if not result:
+            return None
+
+        user_id, ttl = str(result[0]), int(result[1])
+        if self.__session_cache_enabled and generation == self.__session_cache_generation:
+            # Never cache a session longer than Redis keeps it
+            self.__session_cache.set(session_token, user_id, ttl=ttl)
+
+        return user_id
     
-    def _refresh_session(self, response: Response, refresh_token: str) -> Tuple[Optional[str], Optional[str]]:
+    async def _refresh_session(self, response: Response, refresh_token: str) -> Tuple[Optional[str], Optional[str]]:
         """Refresh the session token using the refresh token.
 
         Args:
@@ -159,15 +303,15 @@ class AuthService:
         Returns:
             Optional[str]: _description_
         """
-        user_id = self.__redis.get(f"refresh:{refresh_token}")
+        user_id = await self.__redis.get(f"refresh:{refresh_token}")
         if user_id:
             new_session_token = secrets.token_hex(16)
-            self.__redis.setex(f"session:{new_session_token}", self.FIELD_SESSION_TTL, user_id)
+            await self.__redis.setex(f"session:{new_session_token}", self.FIELD_SESSION_TTL, user_id)
 
             return user_id, new_session_token
         return None
     
-    def _delete_session(self, session_token: str, refresh_token: str) -> bool:
+    async def _delete_session(self, session_token: str, refresh_token: str) -> bool:
         """
         Delete the session and refresh tokens from Redis.
 
@@ -178,14 +322,22 @@ class AuthService:
         Returns:
             bool: _description_
         """
-        deleted = False
+        if not session_token and not refresh_token:
+            return False
+
+        async with self.__redis.pipeline(transaction=False) as pipe:
+            if session_token:
+                pipe.delete(f"session:{session_token}")
+                pipe.publish(self.SESSION_INVALIDATION_CHANNEL, session_token)
+            if refresh_token:
+                pipe.delete(f"refresh:{refresh_token}")
+            results = await pipe.execute()
+
         if session_token:
-            if self.__redis.delete(f"session:{session_token}"):
-                deleted = True
-        if refresh_token:
-            if self.__redis.delete(f"refresh:{refresh_token}"):
-                deleted = True
-        return deleted
+            self.__evict_session(session_token)
+            del results[1]  # Subscriber count of the publish
+
+        return any(results)
     
     def _add_session_to_cookie(self, response: Response, session_token: str, refresh_token: str) -> dict:
         """Set the session and refresh tokens in cookies of client.
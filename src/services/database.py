@@ -1,9 +1,12 @@
 from utils.custom_logger import CustomLogger
+from utils.bounded_executor import BoundedExecutor
 
 import os
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, IndexModel, MongoClient
 import gridfs
 
+from models.mongo_doc import ActionHistoryDocument, EnvironmentSensorDocument, ServicesStatusDocument, UserDocument
+
 class Database:
     FIELD_MONGO_URL = "mongo_url"
     FIELD_DB_NAME = "db_name"
@@ -11,8 +14,62 @@ class Database:
     FIELD_USER_COLLECTION = "user"
     FIELD_USER_CONFIG_COLLECTION = "user_config"
     FIELD_ENV_SENSOR_COLLECTION = "environment_sensor"
+    FIELD_ENV_SENSOR_TS_COLLECTION = "environment_sensor_ts"
     FIELD_SERVICES_STATUS_COLLECTION = "services_status"
     FIELD_ACTION_HISTORY_COLLECTION = "action_history"
+    FIELD_MIGRATION_COLLECTION = "migration"
+
+    # Time-series collections, created before their indexes since create_indexes would make a plain collection
+    TIMESERIES_COLLECTIONS = {
+        FIELD_ENV_SENSOR_TS_COLLECTION: {
+            "timeField": EnvironmentSensorDocument.FIELD_TIMESTAMP.value,
+            "metaField": EnvironmentSensorDocument.FIELD_META.value,
+            "granularity": "seconds"
+        },
+    }
+
+    # Indexes the hot queries rely on, applied at startup and by `python src/manage.py ensure-indexes`
+    INDEXES = {
+        FIELD_USER_COLLECTION: [
+            IndexModel([(UserDocument.FIELD_USERNAME.value, ASCENDING)], name="username_unique", unique=True),
+        ],
+        FIELD_ENV_SENSOR_COLLECTION: [
+            IndexModel([
+                (EnvironmentSensorDocument.FIELD_UID.value, ASCENDING),
+                (EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value, ASCENDING),
+                (EnvironmentSensorDocument.FIELD_TIMESTAMP.value, DESCENDING)
+            ], name="uid_sensor_type_timestamp"),
+        ],
+        FIELD_ENV_SENSOR_TS_COLLECTION: [
+            IndexModel([
+                (f"{EnvironmentSensorDocument.FIELD_META.value}.{EnvironmentSensorDocument.FIELD_UID.value}", ASCENDING),
+                (f"{EnvironmentSensorDocument.FIELD_META.value}.{EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value}", ASCENDING),
+                (EnvironmentSensorDocument.FIELD_TIMESTAMP.value, DESCENDING)
+            ], name="meta_uid_sensor_type_timestamp"),
+        ],
+        FIELD_SERVICES_STATUS_COLLECTION: [
+            IndexModel([(ServicesStatusDocument.FIELD_UID.value, ASCENDING)], name="uid"),
+        ],
+        FIELD_ACTION_HISTORY_COLLECTION: [
+            # Keyset pagination of the history, with and without a service_type filter
+            IndexModel([
+                (ActionHistoryDocument.FIELD_UID.value, ASCENDING),
+                (ActionHistoryDocument.FIELD_TIMESTAMP.value, DESCENDING),
+                ("_id", DESCENDING)
+            ], name="uid_timestamp_id"),
+            IndexModel([
+                (ActionHistoryDocument.FIELD_UID.value, ASCENDING),
+                (ActionHistoryDocument.FIELD_SERVICE_TYPE.value, ASCENDING),
+                (ActionHistoryDocument.FIELD_TIMESTAMP.value, DESCENDING),
+                ("_id", DESCENDING)
+            ], name="uid_service_type_timestamp_id"),
+        ],
+    }
+
+    # Indexes a registry index replaced, dropped by the migration that made them obsolete
+    SUPERSEDED_INDEXES = {
+        FIELD_ACTION_HISTORY_COLLECTION: ["uid_timestamp"],  # by uid_timestamp_id
+    }
 
     _instance = None
     _cache_data = {}
@@ -27,6 +84,13 @@ class Database:
         pass
 
     def _init_database(self):
+        # pymongo is synchronous, every call from a coroutine goes through this pool
+        self.executor = BoundedExecutor(
+            name="mongo",
+            max_workers=int(os.getenv("MONGODB_EXECUTOR_WORKERS", 16)),
+            max_queue=int(os.getenv("MONGODB_EXECUTOR_QUEUE", 256))
+        )
+
         mongodb_url = os.getenv("MONGODB_URL")
         db_name = os.getenv("MONGODB_DB_NAME")
         if mongodb_url is None or db_name is None:
@@ -34,7 +98,11 @@ class Database:
             return
 
         try:
-            self.client = MongoClient(mongodb_url)
+            self.client = MongoClient(
+                mongodb_url,
+                maxPoolSize=int(os.getenv("MONGODB_MAX_POOL_SIZE", 100)),
+                minPoolSize=int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+            )
             self.db = self.client[db_name]
             self.fs = gridfs.GridFS(self.db, os.getenv("MONGOBD_AVATAR_COL"))
             self._instance = self
@@ -44,6 +112,71 @@ class Database:
             CustomLogger()._get_logger().error(f"Failed to connect with database: {e}")
             self._instance = None
 
+    async def run(self, fn, *args, **kwargs):
+        '''
+            Run a blocking pymongo/GridFS call in the database executor so it does not stall the event loop.
+        '''
+        return await self.executor.run(fn, *args, **kwargs)
+
+    def get_executor_stats(self) -> dict:
+        return self.executor.stats()
+
+    def ensure_indexes(self, collection_names: list = None) -> dict:
+        '''
+            Create every index of the registry that does not exist yet, for `collection_names` or all
+            registered collections. Blocking, run it through `run`.
+
+            Returns:
+                dict: collection name -> created index names, or the error message if creation failed.
+        '''
+        result = {}
+        for collection_name, indexes in self.INDEXES.items():
+            if collection_names is not None and collection_name not in collection_names:
+                continue
+
+            try:
+                self.ensure_timeseries_collection(collection_name)
+                result[collection_name] = self.db.get_collection(collection_name).create_indexes(indexes)
+            except Exception as e:
+                CustomLogger()._get_logger().error(f"Failed to create indexes on \"{collection_name}\": {e}")
+                result[collection_name] = str(e)
+        return result
+
+    def drop_superseded_indexes(self, collection_name: str) -> list:
+        '''
+            Drop the superseded indexes of `collection_name` still present, once the registry indexes
+            replacing them exist. Blocking, run it through `run`.
+
+            Returns:
+                list: names of the dropped indexes.
+
+            Raises:
+                Exception: If the registry indexes could not be created, nothing is dropped then.
+        '''
+        created = self.ensure_indexes([collection_name]).get(collection_name)
+        if isinstance(created, str):
+            raise Exception(f"Indexes of \"{collection_name}\" not created: {created}")
+
+        collection = self.db.get_collection(collection_name)
+        existing = collection.index_information()
+        dropped = []
+        for name in self.SUPERSEDED_INDEXES.get(collection_name, []):
+            if name in existing:
+                collection.drop_index(name)
+                dropped.append(name)
+        return dropped
+
+    def ensure_timeseries_collection(self, collection_name: str):
+        '''
+            Create `collection_name` as a time-series collection if it is one and does not exist yet.
+        '''
+        options = self.TIMESERIES_COLLECTIONS.get(collection_name)
+        if options is None or collection_name in self.db.list_collection_names(filter={"name": collection_name}):
+            return
+
+        self.db.create_collection(collection_name, timeseries=options)
+        CustomLogger()._get_logger().info(f"Created time-series collection \"{collection_name}\"")
+
 # User region
     def get_user_collection(self):
         return self.db.get_collection(self.FIELD_USER_COLLECTION)
@@ -55,10 +188,16 @@ class Database:
 # IOT region
     def get_env_sensor_collection(self):
         return self.db.get_collection(self.FIELD_ENV_SENSOR_COLLECTION)
+
+    def get_env_sensor_ts_collection(self):
+        return self.db.get_collection(self.FIELD_ENV_SENSOR_TS_COLLECTION)
     
     def get_services_status_collection(self):
         return self.db.get_collection(self.FIELD_SERVICES_STATUS_COLLECTION)
     
     def get_action_history_collection(self):
         return self.db.get_collection(self.FIELD_ACTION_HISTORY_COLLECTION)
-# End IOT region
\ No newline at end of file
+# End IOT region
+
+    def get_migration_collection(self):
+        return self.db.get_collection(self.FIELD_MIGRATION_COLLECTION)
\ No newline at end of file
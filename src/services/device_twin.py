@@ -0,0 +1,86 @@
+from typing import Dict, Optional
+
+from models.mongo_doc import ServicesStatusDocument
+
+class DeviceTwin:
+    '''
+        In-memory state of a connected device, in `services_status` fields.
+
+        `reported` is the state the device confirmed on this connection, through a successful command
+        or a notification carrying a value; `desired` is the state last requested from it. `version`
+        increases with every change of `reported`. The stored status is loaded into `stored` when the
+        device connects: it answers status reads, but a device may have rebooted to its defaults since,
+        so only `reported` decides that a command would change nothing. Until `loaded`, the stored
+        status must be read instead.
+    '''
+    def __init__(self):
+        self.desired: dict = {}
+        self.reported: dict = {}
+        self.stored: dict = {}
+        self.version = 0
+        self.loaded = False
+
+    def load(self, services_status: dict):
+        for field in ServicesStatusDocument.ALL_SERVICE_FIELDS.value + ServicesStatusDocument.ALL_VALUE_FIELDS.value:
+            if field in services_status:
+                self.stored[field] = services_status[field]
+                # Fields requested while the stored status was being read are newer
+                self.desired.setdefault(field, services_status[field])
+        self.loaded = True
+
+    def is_unchanged(self, fields: dict) -> bool:
+        '''
+            True if the device already reported every field with this value on this connection, a
+            command setting them would change nothing.
+        '''
+        return all(field in self.reported and self.reported[field] == value for field, value in fields.items())
+
+    def request(self, fields: dict):
+        self.desired.update(fields)
+
+    def report(self, fields: dict):
+        self.desired.update(fields)
+        if any(self.reported.get(field) != value for field, value in fields.items()):
+            self.reported.update(fields)
+            self.version += 1
+
+    def reject(self, fields: dict):
+        # The device kept its state, the reported one or else the stored one
+        for field in fields:
+            if field in self.reported:
+                self.desired[field] = self.reported[field]
+            elif field in self.stored:
+                self.desired[field] = self.stored[field]
+            else:
+                self.desired.pop(field, None)
+
+    def get_status(self) -> dict:
+        return {
+            field: self.reported.get(field, self.stored.get(field))
+            for field in ServicesStatusDocument.ALL_SERVICE_FIELDS.value + ServicesStatusDocument.ALL_VALUE_FIELDS.value
+        }
+
+class DeviceTwins:
+    '''
+        Twins of the devices connected to this worker, by device id.
+    '''
+    _instance = None
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(DeviceTwins, cls).__new__(cls)
+            cls._instance._init_instance()
+        return cls._instance
+
+    def _init_instance(self):
+        self.twins: Dict[str, DeviceTwin] = {}
+
+    def _add(self, device_id: str) -> DeviceTwin:
+        twin = self.twins[device_id] = DeviceTwin()
+        return twin
+
+    def _get(self, device_id: str) -> Optional[DeviceTwin]:
+        return self.twins.get(device_id)
+
+    def _remove(self, device_id: str):
+        self.twins.pop(device_id, None)
@@ -0,0 +1,151 @@
+from utils.custom_logger import CustomLogger
+
+from services.database import Database
+from services.app_service import AppService
+from services.sensor_storage import SensorStorage
+
+from models.common import SensorTypes
+from models.mongo_doc import ActionHistoryDocument, ServicesStatusDocument, UserDocument
+from models.request import ActionHistoryRequest
+
+from bson import ObjectId
+from datetime import datetime
+
+class IndexService:
+    # Plan stages that mean the query is answered from an index
+    INDEX_STAGES = {"IXSCAN", "DISTINCT_SCAN", "IDHACK", "EXPRESS_IXSCAN", "COUNT_SCAN"}
+
+    async def _ensure_indexes(self) -> dict:
+        '''
+            Apply the index registry of `Database.INDEXES`.
+        '''
+        collection_names = list(Database.INDEXES.keys())
+        if not SensorStorage()._is_timeseries():
+            # Only create the time-series collection once it is used (or migrated to)
+            collection_names.remove(Database.FIELD_ENV_SENSOR_TS_COLLECTION)
+
+        result = await Database()._instance.run(Database()._instance.ensure_indexes, collection_names)
+        CustomLogger()._get_logger().info(f"Ensured indexes: {result}")
+        return result
+
+    async def _verify_indexes(self) -> dict:
+        '''
+            Explain every hot-path query of AppService/AuthService and check it is served by an index.
+
+            Returns:
+                dict: query name -> winning plan stages.
+
+            Raises:
+                Exception: If any hot-path query falls back to a collection scan.
+        '''
+        report = await Database()._instance.run(self.__explain_hot_queries)
+
+        failures = [name for name, stages in report.items() if "COLLSCAN" in stages or not (stages & self.INDEX_STAGES)]
+        if failures:
+            CustomLogger()._get_logger().error(f"Index check FAIL: {failures} not served by an index, plans: {report}")
+            raise Exception(f"Queries not using an index: {', '.join(failures)}")
+
+        CustomLogger()._get_logger().info(f"Index check SUCCESS: {list(report.keys())}")
+        return report
+
+    async def _verify_unique_indexes(self) -> None:
+        '''
+            Check every unique index of `Database.INDEXES` exists. Registration has no username pre-check,
+            duplicate usernames are only rejected by the unique username index.
+
+            Raises:
+                Exception: If a unique index is missing, e.g. on a fresh database with MONGODB_ENSURE_INDEXES off.
+        '''
+        missing = await Database()._instance.run(self.__find_missing_unique_indexes)
+        if missing:
+            CustomLogger()._get_logger().error(f"Unique index check FAIL: {missing} missing, run 'manage.py ensure-indexes'")
+            raise Exception(f"Unique indexes missing: {', '.join(missing)}")
+
+    def __find_missing_unique_indexes(self) -> list:
+        missing = []
+        for collection_name, indexes in Database.INDEXES.items():
+            unique_indexes = [index.document for index in indexes if index.document.get("unique")]
+            if not unique_indexes:
+                continue
+
+            # Matched on the key, an index created by hand under another name counts
+            existing = Database()._instance.db.get_collection(collection_name).index_information().values()
+            for index in unique_indexes:
+                key = list(index["key"].items())
+                if not any(info.get("unique") and list(info.get("key", [])) == key for info in existing):
+                    missing.append(f"{collection_name}.{index['name']}")
+        return missing
+
+    def _get_hot_queries(self) -> dict:
+        '''
+            Hot-path queries, built with the same helpers the services use. The values never match real
+            documents, only the query shape matters for the plan.
+        '''
+        uid = "index-check"
+        sensor_types = [sensor_type.value for sensor_type in SensorTypes]
+
+        return {
+            "user.find_by_username": {
+                "collection": Database.FIELD_USER_COLLECTION,
+                "filter": {UserDocument.FIELD_USERNAME.value: uid}
+            },
+            "services_status.find_by_uid": {
+                "collection": Database.FIELD_SERVICES_STATUS_COLLECTION,
+                "filter": {ServicesStatusDocument.FIELD_UID.value: uid}
+            },
+            "action_history.newest": {
+                "collection": Database.FIELD_ACTION_HISTORY_COLLECTION,
+                **AppService()._build_action_history_query(uid)
+            },
+            "action_history.page_by_service_type": {
+                "collection": Database.FIELD_ACTION_HISTORY_COLLECTION,
+                **AppService()._build_action_history_query(uid, ActionHistoryRequest(
+                    service_type=ServicesStatusDocument.FIELD_HEADLIGHT_SERVICE.value,
+                    cursor=AppService()._encode_action_history_cursor({
+                        ActionHistoryDocument.FIELD_TIMESTAMP.value: datetime.now(),
+                        "_id": ObjectId()
+                    })
+                ))
+            },
+            "environment_sensor.newest_per_type": {
+                "collection": SensorStorage()._get_collection_name(),
+                "pipeline": AppService()._build_newest_sensor_data_pipeline(uid, sensor_types)
+            },
+        }
+
+    def __explain_hot_queries(self) -> dict:
+        report = {}
+        for name, query in self._get_hot_queries().items():
+            collection = Database()._instance.db.get_collection(query["collection"])
+
+            if "pipeline" in query:
+                explain = Database()._instance.db.command(
+                    "aggregate", query["collection"], pipeline=query["pipeline"], explain=True
+                )
+            else:
+                explain = collection.find(
+                    query["filter"],
+                    sort=query.get("sort"),
+                    limit=query.get("limit", 0)
+                ).explain()
+
+            report[name] = self.__collect_winning_stages(explain)
+        return report
+
+    def __collect_winning_stages(self, node, in_winning_plan: bool = False, stages: set = None) -> set:
+        if stages is None:
+            stages = set()
+
+        if isinstance(node, dict):
+            if in_winning_plan and "stage" in node:
+                stages.add(node["stage"])
+            for key, value in node.items():
+                if key == "rejectedPlans":
+                    continue
+                self.__collect_winning_stages(value, in_winning_plan or key == "winningPlan", stages)
+
+        elif isinstance(node, list):
+            for item in node:
+                self.__collect_winning_stages(item, in_winning_plan, stages)
+
+        return stages
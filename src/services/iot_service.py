@@ -1,22 +1,44 @@
 from utils.custom_logger import CustomLogger
 
 import asyncio
+import os
 from datetime import datetime
 import uuid
 
-from services.database import Database
+from bson import ObjectId
+
 from services.app_service import AppService
+from services.sensor_storage import SensorStorage
+from services.sensor_writer import SensorWriter
+from services.service_change_writer import ServiceChangeWriter
+from services.device_twin import DeviceTwins
+from services.message_bus import MessageBus
 
-from models.request import IOTDataResponse, IOTNotification
-from models.common import IotCommand, IotCommandResponse, IotNotification
-from models.mongo_doc import ActionHistoryDocument, ServicesStatusDocument
+from models.request import IOTDataResponse, IOTNotification, IOTTelemetry
+from models.common import IotCommand, IotCommandResponse, IotNotification, IotTelemetry
+from models.mongo_doc import ActionHistoryDocument, EnvironmentSensorDocument, ServicesStatusDocument
 
 from typing import Dict
 from fastapi import WebSocket, WebSocketDisconnect
 
 class IOTService:
+    '''
+        Device WebSocket connections and their commands.
+
+        Each device socket is owned by the worker it connected to, recorded in the message bus
+        device registry (`device:{device_id}` -> worker id, refreshed while connected). A command for a
+        device owned by another worker is forwarded on that worker's `iot:worker:{worker_id}` channel
+        and its reply correlated by request id.
+
+        Device state takes no lock: the event loop runs one coroutine at a time, so every check and
+        update made between two awaits is atomic. A connecting device is claimed in
+        `connecting_iot_systems` before the first await of its handshake, so handshakes of different
+        devices run concurrently while a duplicate connection is still rejected.
+    '''
     _instance = None
 
+    COMMAND_TIMEOUT = 5.0  # seconds
+
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(IOTService, cls).__new__(cls)
@@ -28,29 +50,110 @@ class IOTService:
         self.pending_commands: Dict[str, Dict[str, asyncio.Event]] = {}   # device_id -> [command_id: Event]
         self.command_responses: Dict[str, Dict[str, any]] = {}            # device_id -> [command_id: response]
 
-        self.device_locks: Dict[str, asyncio.Lock] = {}                   # device_id -> lock
-        self.global_lock = asyncio.Lock()                                 # Lock for global state (device list)
+        self.connecting_iot_systems: set = set()                          # device_id of handshakes in progress
+
+        self.worker_id = MessageBus().worker_id
+        self.forwarded_commands: Dict[str, asyncio.Future] = {}           # request_id -> reply of the owning worker
+        self.registry_ttl = float(os.getenv("DEVICE_REGISTRY_TTL", 15))  # seconds
+        self.registry_task: asyncio.Task = None
+
+    async def _start(self):
+        '''
+            Listen for commands forwarded by other workers and keep the registry entries of the
+            devices connected to this worker alive.
+        '''
+        await MessageBus()._subscribe(self.__get_worker_channel(self.worker_id), self.__on_worker_message)
+        if self.registry_task is None:
+            self.registry_task = asyncio.create_task(self.__refresh_registry())
+
+    async def _stop(self):
+        await MessageBus()._unsubscribe(self.__get_worker_channel(self.worker_id))
+        if self.registry_task is not None:
+            self.registry_task.cancel()
+            try:
+                await self.registry_task
+            except asyncio.CancelledError:
+                pass
+            self.registry_task = None
+
+        for device_id in list(self.connected_iot_systems.keys()):
+            await self.__unregister_device(device_id)
+
+    def __get_worker_channel(self, worker_id: str) -> str:
+        return f"iot:worker:{worker_id}"
+
+    def __get_registry_key(self, device_id: str) -> str:
+        return f"device:{device_id}"
+
+    async def __register_device(self, device_id: str) -> bool:
+        '''
+            Claim the device in the registry.
+
+            Returns:
+                bool: False if another worker owns a connection of the device.
+        '''
+        try:
+            key = self.__get_registry_key(device_id)
+            if await MessageBus()._set(key, self.worker_id, ttl=self.registry_ttl, only_if_absent=True):
+                return True
+            return await MessageBus()._get(key) == self.worker_id
+
+        except Exception as e:
+            # Without the registry the device is still reachable from this worker
+            CustomLogger()._get_logger().warning(f"Device registry error: {{ deviceId: \"{device_id}\" }} {e}")
+            return True
+
+    async def __unregister_device(self, device_id: str):
+        try:
+            await MessageBus()._delete(self.__get_registry_key(device_id), if_value=self.worker_id)
+        except Exception as e:
+            CustomLogger()._get_logger().warning(f"Device registry error: {{ deviceId: \"{device_id}\" }} {e}")
+
+    async def __refresh_registry(self):
+        while True:
+            await asyncio.sleep(self.registry_ttl / 3)
+            try:
+                await MessageBus()._set_many(
+                    {self.__get_registry_key(device_id): self.worker_id for device_id in self.connected_iot_systems},
+                    ttl=self.registry_ttl
+                )
+            except Exception as e:
+                CustomLogger()._get_logger().warning(f"Device registry refresh FAIL: {e}")
 
     async def _add_connected_iot_system(self, device_id: str, websocket: WebSocket):
-        async with self.global_lock:
-            if device_id in self.connected_iot_systems:
+        if device_id in self.connected_iot_systems or device_id in self.connecting_iot_systems:
+            await websocket.close(code=1008, reason="Device already connected")
+            return False
+
+        self.connecting_iot_systems.add(device_id)
+        try:
+            if not await self.__register_device(device_id):
                 await websocket.close(code=1008, reason="Device already connected")
                 return False
 
-            self.device_locks[device_id] = asyncio.Lock()
-            async with self.device_locks[device_id]:
+            try:
                 await websocket.accept()
-                self.connected_iot_systems[device_id] = [websocket, "established"]
-                self.pending_commands[device_id] = {}
-                self.command_responses[device_id] = {}
+            except Exception:
+                await self.__unregister_device(device_id)
+                raise
+
+            self.pending_commands[device_id] = {}
+            self.command_responses[device_id] = {}
+            self.connected_iot_systems[device_id] = [websocket, "established"]
+            DeviceTwins()._add(device_id)
             return True
 
+        finally:
+            self.connecting_iot_systems.discard(device_id)
+
     async def _establish_connection(self, device_id: str, websocket: WebSocket):
         if not await self._add_connected_iot_system(device_id, websocket):
             CustomLogger()._get_logger().warning(f"Websocket connect FAIL: {{ deviceId: \"{device_id}\" }} already connected")
             return
 
         CustomLogger()._get_logger().info(f"Websocket connect SUCCESS: {{ deviceId: \"{device_id}\" }}")
+        # Loaded while the first frames are handled, the twin keeps the fields reported meanwhile
+        twin_load = asyncio.create_task(self.__load_twin(device_id))
         try:
             while True:
                 data = await websocket.receive_json()
@@ -72,22 +175,63 @@ class IOTService:
                         
                         command_id = data[IotCommandResponse.FIELD_COMMAND_ID.value]
                         
-                        async with self.device_locks.get(device_id, asyncio.Lock()):
-                            if device_id in self.pending_commands and command_id in self.pending_commands[device_id]:
-                                # Store response and signal Event
-                                self.command_responses[device_id][command_id] = data
-                                self.pending_commands[device_id][command_id].set()
+                        if device_id in self.pending_commands and command_id in self.pending_commands[device_id]:
+                            # Store response and signal Event
+                            self.command_responses[device_id][command_id] = data
+                            self.pending_commands[device_id][command_id].set()
 
-                                CustomLogger()._get_logger().info(f"Websocket command response: {{ deviceId: \"{device_id}\", command_id \"{command_id}\", status \"{iot_data.status}\" }}")
+                            CustomLogger()._get_logger().info(f"Websocket command response: {{ deviceId: \"{device_id}\", command_id \"{command_id}\", status \"{iot_data.status}\" }}")
 
-                            else:
-                                CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} unknown command ID \"{command_id}\"")
-                                await websocket.send_json({"error": "Unknown command ID"})
+                        else:
+                            CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} unknown command ID \"{command_id}\"")
+                            await websocket.send_json({"error": "Unknown command ID"})
 
                     except Exception as e:
                         CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} invalid response {e}")
                         await websocket.send_json({"error": "Invalid response"})
 
+                elif IotTelemetry.FIELD_READINGS.value in data:
+                    # Data is a batch of sensor readings
+                    try:
+                        telemetry = IOTTelemetry(**data)
+
+                        if telemetry.device_id != device_id:
+                            CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} deviceId mismatch")
+                            await websocket.send_json({"error": "Device ID mismatch"})
+                            continue
+
+                        received_at = datetime.now()
+                        documents = [
+                            SensorStorage()._to_document(
+                                uid=device_id,
+                                sensor_type=reading.sensor_type,
+                                value=reading.value,
+                                timestamp=reading.timestamp or received_at
+                            )
+                            for reading in telemetry.readings
+                        ]
+
+                        if not SensorWriter()._enqueue(documents):
+                            CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} telemetry dropped, writer buffer full")
+                            await websocket.send_json({"error": "Telemetry dropped"})
+
+                        await AppService()._add_readings(
+                            client_id=device_id,
+                            readings=[
+                                {
+                                    IotTelemetry.FIELD_SENSOR_TYPE.value: reading.sensor_type,
+                                    IotTelemetry.FIELD_VALUE.value: reading.value,
+                                    # Same local time as stored
+                                    IotTelemetry.FIELD_TIMESTAMP.value: document[EnvironmentSensorDocument.FIELD_TIMESTAMP.value].isoformat()
+                                }
+                                for reading, document in zip(telemetry.readings, documents)
+                            ]
+                        )
+
+                    except Exception as e:
+                        CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} invalid telemetry {e}")
+                        await websocket.send_json({"error": "Invalid telemetry"})
+
                 elif IotNotification.FIELD_DESCRIPTION.value in data:
                     # Data is a notification
                     try:
@@ -100,6 +244,10 @@ class IOTService:
 
                         CustomLogger()._get_logger().info(f"Websocket notification: {{ deviceId: \"{device_id}\", service_type \"{iot_notification.service_type}\", notification \"{iot_notification.description}\" }}")
 
+                        if iot_notification.value is not None:
+                            # The device changed a service by itself, e.g. in auto mode
+                            await self.__report_service_change(device_id, iot_notification.service_type, iot_notification.value)
+
                         await AppService()._add_notification(
                             client_id=device_id,
                             notification={
@@ -123,141 +271,387 @@ class IOTService:
                     IotNotification.FIELD_TIMESTAMP.value: datetime.now().isoformat()
                 }
             )
-            session = Database()._instance.client.start_session()
             try:
-                with session.start_transaction():
-                    AppService()._toggle_all_service_status(device_id, False, session)
-                    self.write_action_history(
-                        uid=device_id,
-                        service_type="system",
-                        value="off",
-                        session=session
-                    )
+                await self._record_service_changes(device_id, [("system", "off")])
             except Exception as e:
-                session.abort_transaction()
                 CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} failed to update database {e}")
-            finally:
-                session.end_session()
 
         except Exception as e:
             CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} {e}")
 
         finally:
+            twin_load.cancel()
             await self._cleanup_device(device_id)
 
+    async def __load_twin(self, device_id: str):
+        # Reading the stored status loads the twin of a device connected to this worker
+        try:
+            await AppService()._get_services_status(device_id)
+        except Exception as e:
+            CustomLogger()._get_logger().warning(f"Device twin load FAIL: {{ deviceId: \"{device_id}\" }} {e}")
+
     async def _cleanup_device(self, device_id: str):
         """Clean up device state on disconnect."""
-        async with self.global_lock:
-            if device_id in self.connected_iot_systems:
-                async with self.device_locks.get(device_id, asyncio.Lock()):
-                    del self.connected_iot_systems[device_id]
-                    if device_id in self.pending_commands:
-                        for event in self.pending_commands[device_id].values():
-                            event.set()
-                        del self.pending_commands[device_id]
-                    if device_id in self.command_responses:
-                        del self.command_responses[device_id]
-                # Remove device-specific lock
-                if device_id in self.device_locks:
-                    del self.device_locks[device_id]
+        if device_id not in self.connected_iot_systems:
+            return
+
+        # Unregistered while still listed as connected, so a reconnect can not claim it in between
+        await self.__unregister_device(device_id)
+
+        self.connected_iot_systems.pop(device_id, None)
+        DeviceTwins()._remove(device_id)
+        for event in self.pending_commands.pop(device_id, {}).values():
+            event.set()
+        self.command_responses.pop(device_id, None)
+
+    def __get_write_type(self, target: str, value: str) -> str:
+        # Numeric values of the on/off services are stored in their own status field
+        if (value not in ['on', 'off']):
+            if (target == ServicesStatusDocument.FIELD_AIR_COND_SERVICE.value):
+                return ServicesStatusDocument.FIELD_AIR_COND_TEMP.value
+
+            elif (target == ServicesStatusDocument.FIELD_HEADLIGHT_SERVICE.value):
+                return ServicesStatusDocument.FIELD_HEADLIGHT_BRIGHTNESS.value
+        return target
 
     async def _control_iot_system(self, device_id: str, target: str, value: str):
-        async with self.global_lock:
-            if device_id not in self.connected_iot_systems:
-                CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} not connected")
-                raise Exception("Device not connected")
+        try:
+            if device_id in self.connected_iot_systems:
+                response = await self.__send_command(device_id, target, value)
+            else:
+                response = await self.__forward_command(device_id, target, value)
+
+            if response.get(IotCommandResponse.FIELD_STATUS.value) != "success":
+                raise Exception(response.get(IotCommandResponse.FIELD_MESSAGE.value))
+            if response.get(IotCommandResponse.FIELD_UNCHANGED.value):
+                return
+
+            try:
+                await self._record_service_changes(device_id, [(self.__get_write_type(target, value), value)])
+            except Exception as e:
+                CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} failed to update database {e}")
+
+        except Exception as e:
+            CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} fail to control iot system {e}")
+            raise e
+
+    async def _control_iot_services(self, device_id: str, commands: list) -> list:
+        '''
+            Send several service commands to a device in one frame, then record the successful ones in
+            one database write.
+
+            The device gets `{"command_id": <batch id>, "commands": [{"command_id", "target", "value"}]}`
+            and answers with one response for the batch id, whose `results` hold a
+            `{"command_id", "status", "message"}` per command. A batch status other than "success"
+            rejects every command. Commands setting a state the device already reported on this
+            connection are not sent, they succeed with `unchanged` set.
+
+            Args:
+                commands: (target, value) pairs, applied by the device in this order.
 
+            Returns:
+                list: {"service_type", "value", "status", "message"} per command, in order.
+
+            Raises:
+                Exception: If the device is not connected, rejects the batch or does not answer in time.
+        '''
         try:
-            command_id = str(uuid.uuid4())
-            data = {
-                IotCommand.FIELD_COMMAND.value: {
-                    IotCommand.FIELD_TARGET.value: target,
-                    IotCommand.FIELD_VALUE.value: value
-                },
-                IotCommand.FIELD_COMMAND_ID.value: command_id
-            }
+            if device_id in self.connected_iot_systems:
+                results = await self.__send_commands(device_id, commands)
+            else:
+                results = await self.__forward_commands(device_id, commands)
+
+            changes = [
+                (self.__get_write_type(result["service_type"], result["value"]), result["value"])
+                for result in results if result["status"] == "success" and not result.get(IotCommandResponse.FIELD_UNCHANGED.value)
+            ]
+            if changes:
+                try:
+                    await self._record_service_changes(device_id, changes)
+                except Exception as e:
+                    CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} failed to update database {e}")
+
+            return results
+
+        except Exception as e:
+            CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} fail to control iot services {e}")
+            raise e
 
-            async with self.device_locks.get(device_id, asyncio.Lock()):
-                self.pending_commands[device_id][command_id] = asyncio.Event()
+    async def __send_frame(self, device_id: str, command_id: str, data: dict, description: str) -> dict:
+        '''
+            Send a command frame to a device connected to this worker and wait for the response to
+            `command_id`.
 
-            websocket = self.connected_iot_systems[device_id][0]
-            await websocket.send_json(data)
+            Raises:
+                Exception: If the device is not connected, or does not answer within COMMAND_TIMEOUT.
+        '''
+        connection = self.connected_iot_systems.get(device_id)
+        if connection is None:
+            CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} not connected")
+            raise Exception("Device not connected")
+
+        event = self.pending_commands[device_id][command_id] = asyncio.Event()
+        try:
+            await connection[0].send_json(data)
 
-            CustomLogger()._get_logger().info(f"Websocket command sent: {{ deviceId: \"{device_id}\", command_id \"{command_id}\", target \"{target}\", command \"{value}\" }}")
+            CustomLogger()._get_logger().info(f"Websocket command sent: {{ deviceId: \"{device_id}\", command_id \"{command_id}\", {description} }}")
 
             try:
-                await asyncio.wait_for(self.pending_commands[device_id][command_id].wait(), timeout=5.0)
+                await asyncio.wait_for(event.wait(), timeout=self.COMMAND_TIMEOUT)
 
             except asyncio.TimeoutError:
                 CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} command timeout")
-                async with self.device_locks.get(device_id, asyncio.Lock()):
-                    await self._cleanup_command(device_id, command_id)
                 raise Exception("Timeout waiting for response")
 
-            async with self.device_locks.get(device_id, asyncio.Lock()):
-                if command_id in self.command_responses[device_id]:
-                    response = self.command_responses[device_id][command_id]
-                    await self._cleanup_command(device_id, command_id)
-
-                    if response.get(IotCommandResponse.FIELD_STATUS.value) == "success":
-                        if target == "system":
-                            self.connected_iot_systems[device_id][1] = value
-                            session = Database()._instance.client.start_session()
-                            try:
-                                with session.start_transaction():
-                                    AppService()._toggle_all_service_status(device_id, value == "on", session)
-                                    self.write_action_history(
-                                        uid=device_id,
-                                        service_type=target,
-                                        value=value,
-                                        session=session
-                                    )
-                            except Exception as e:
-                                CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} failed to update database {e}")
-                            finally:
-                                session.end_session()
+            response = self.command_responses.get(device_id, {}).get(command_id)
+            if not response:
+                raise Exception("No response received")
 
-                        else:
-                            # TODO: update db
-                            write_type = target
-                            if (value not in ['on', 'off']):
-                                if (target == ServicesStatusDocument.FIELD_AIR_COND_SERVICE.value):
-                                    write_type = ServicesStatusDocument.FIELD_AIR_COND_TEMP.value
-
-                                elif (target == ServicesStatusDocument.FIELD_HEADLIGHT_SERVICE.value):
-                                    write_type = ServicesStatusDocument.FIELD_HEADLIGHT_BRIGHTNESS.value
-
-                            session = Database()._instance.client.start_session()
-                            try:
-                                with session.start_transaction():
-                                    self.update_services_status(
-                                        uid=device_id,
-                                        service_type=write_type,
-                                        value=value,
-                                        session=session
-                                    )
-                                    self.write_action_history(
-                                        uid=device_id,
-                                        service_type=write_type,
-                                        value=value,
-                                        session=session
-                                    )
-                            except Exception as e:
-                                CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} failed to update database {e}")
-                            finally:
-                                session.end_session()
-                    
-                    else:
-                        raise Exception(response.get(IotCommandResponse.FIELD_MESSAGE.value))
-                    
-                else:
-                    raise Exception("No response received")
+            return response
+
+        finally:
+            await self._cleanup_command(device_id, command_id)
+
+    async def __send_command(self, device_id: str, target: str, value: str) -> dict:
+        '''
+            Send a command to a device connected to this worker and wait for its response.
+
+            Raises:
+                Exception: If the device is not connected, or does not answer within COMMAND_TIMEOUT.
+        '''
+        connection = self.connected_iot_systems.get(device_id)
+        twin = DeviceTwins()._get(device_id)
+        fields = self.__get_twin_fields(target, value)
+        # The twin exists while the device is connected
+        if twin is not None and fields is not None and twin.is_unchanged(fields):
+            CustomLogger()._get_logger().info(f"Websocket command skipped: {{ deviceId: \"{device_id}\", target \"{target}\", command \"{value}\" }} unchanged")
+            return self.__build_unchanged_response(device_id)
+
+        command_id = str(uuid.uuid4())
+        data = {
+            IotCommand.FIELD_COMMAND.value: {
+                IotCommand.FIELD_TARGET.value: target,
+                IotCommand.FIELD_VALUE.value: value
+            },
+            IotCommand.FIELD_COMMAND_ID.value: command_id
+        }
+
+        self.__request_twin(twin, fields)
+        try:
+            response = await self.__send_frame(device_id, command_id, data, f"target \"{target}\", command \"{value}\"")
+        except Exception:
+            self.__settle_twin(twin, fields, False)
+            raise
+        self.__settle_twin(twin, fields, response.get(IotCommandResponse.FIELD_STATUS.value) == "success")
+
+        if response.get(IotCommandResponse.FIELD_STATUS.value) == "success" and target == "system" \
+                and self.connected_iot_systems.get(device_id) is connection:
+            connection[1] = value
+
+        return response
+
+    async def __send_commands(self, device_id: str, commands: list) -> list:
+        '''
+            Send a batch of commands to a device connected to this worker in one frame.
+
+            Returns:
+                list: {"service_type", "value", "status", "message"} per command, in order.
+
+            Raises:
+                Exception: If the device is not connected, rejects the batch or does not answer in time.
+        '''
+        twin = DeviceTwins()._get(device_id)
+        fields = [self.__get_twin_fields(target, value) for target, value in commands]
+        unchanged = [twin is not None and item_fields is not None and twin.is_unchanged(item_fields) for item_fields in fields]
+
+        batch_id = str(uuid.uuid4())
+        command_ids = [str(uuid.uuid4()) for _ in commands]
+        sent = [index for index in range(len(commands)) if not unchanged[index]]
+        data = {
+            IotCommand.FIELD_COMMANDS.value: [
+                {
+                    IotCommand.FIELD_COMMAND_ID.value: command_ids[index],
+                    IotCommand.FIELD_TARGET.value: commands[index][0],
+                    IotCommand.FIELD_VALUE.value: commands[index][1]
+                }
+                for index in sent
+            ],
+            IotCommand.FIELD_COMMAND_ID.value: batch_id
+        }
+
+        item_responses = {}
+        if sent:
+            for index in sent:
+                self.__request_twin(twin, fields[index])
+            try:
+                response = await self.__send_frame(device_id, batch_id, data, f"commands {len(sent)}")
+                if response.get(IotCommandResponse.FIELD_STATUS.value) != "success":
+                    raise Exception(response.get(IotCommandResponse.FIELD_MESSAGE.value))
+            except Exception:
+                for index in sent:
+                    self.__settle_twin(twin, fields[index], False)
+                raise
+
+            item_responses = {
+                item.get(IotCommandResponse.FIELD_COMMAND_ID.value): item
+                for item in response.get(IotCommandResponse.FIELD_RESULTS.value) or []
+            }
+        else:
+            CustomLogger()._get_logger().info(f"Websocket commands skipped: {{ deviceId: \"{device_id}\", commands {len(commands)} }} unchanged")
+
+        results = []
+        for index, (command_id, (target, value)) in enumerate(zip(command_ids, commands)):
+            if unchanged[index]:
+                results.append({
+                    "service_type": target,
+                    "value": value,
+                    "status": "success",
+                    "message": "Unchanged",
+                    IotCommandResponse.FIELD_UNCHANGED.value: True
+                })
+                continue
+
+            item = item_responses.get(command_id)
+            status = item.get(IotCommandResponse.FIELD_STATUS.value) if item else "error"
+            self.__settle_twin(twin, fields[index], status == "success")
+            results.append({
+                "service_type": target,
+                "value": value,
+                "status": status,
+                "message": item.get(IotCommandResponse.FIELD_MESSAGE.value) if item else "No response received"
+            })
+        return results
+
+    def __get_twin_fields(self, target: str, value: str):
+        # None if the value can not be stored, the device then decides alone
+        try:
+            return self._build_status_fields([(self.__get_write_type(target, value), value)])
+        except ValueError:
+            return None
+
+    def __build_unchanged_response(self, device_id: str) -> dict:
+        return {
+            IotCommandResponse.FIELD_DEVICE_ID.value: device_id,
+            IotCommandResponse.FIELD_STATUS.value: "success",
+            IotCommandResponse.FIELD_MESSAGE.value: "Unchanged",
+            IotCommandResponse.FIELD_UNCHANGED.value: True
+        }
 
+    def __request_twin(self, twin, fields: dict):
+        if twin is not None and fields is not None:
+            twin.request(fields)
+
+    def __settle_twin(self, twin, fields: dict, success: bool):
+        if twin is None or fields is None:
+            return
+        if success:
+            twin.report(fields)
+        else:
+            twin.reject(fields)
+
+    async def __report_service_change(self, device_id: str, service_type: str, value: str):
+        '''
+            Apply a service change the device reported by itself to its twin, and record it.
+        '''
+        write_type = self.__get_write_type(service_type, value)
+        twin = DeviceTwins()._get(device_id)
+        fields = self.__get_twin_fields(service_type, value)
+        if twin is not None and fields is not None:
+            if twin.is_unchanged(fields):
+                return
+            twin.report(fields)
+
+        try:
+            await self._record_service_changes(device_id, [(write_type, value)])
         except Exception as e:
-            CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} fail to control iot system {e}")
-            async with self.device_locks.get(device_id, asyncio.Lock()):
-                await self._cleanup_command(device_id, command_id)
-            raise e
+            CustomLogger()._get_logger().error(f"Websocket error: {{ deviceId: \"{device_id}\" }} failed to update database {e}")
+
+    async def __forward_command(self, device_id: str, target: str, value: str) -> dict:
+        '''
+            Send a command to a device connected to another worker, through that worker.
+
+            Raises:
+                Exception: If no worker owns the device, or the owner's reply does not arrive in time.
+        '''
+        return await self.__forward(
+            device_id,
+            {"type": "command", "target": target, "value": value},
+            f"target \"{target}\", command \"{value}\""
+        )
+
+    async def __forward_commands(self, device_id: str, commands: list) -> list:
+        '''
+            Send a batch of commands to a device connected to another worker, through that worker.
+
+            Raises:
+                Exception: If no worker owns the device, the device rejects the batch, or the owner's
+                    reply does not arrive in time.
+        '''
+        return await self.__forward(
+            device_id,
+            {"type": "batch", "commands": [[target, value] for target, value in commands]},
+            f"commands {len(commands)}"
+        )
+
+    async def __forward(self, device_id: str, message: dict, description: str):
+        owner = await MessageBus()._get(self.__get_registry_key(device_id))
+        if owner is None or owner == self.worker_id:
+            CustomLogger()._get_logger().warning(f"Websocket error: {{ deviceId: \"{device_id}\" }} not connected")
+            raise Exception("Device not connected")
+
+        request_id = str(uuid.uuid4())
+        reply = asyncio.get_running_loop().create_future()
+        self.forwarded_commands[request_id] = reply
+        try:
+            delivered = await MessageBus()._publish(self.__get_worker_channel(owner), {
+                **message,
+                "request_id": request_id,
+                "reply_to": self.worker_id,
+                "device_id": device_id
+            })
+            if not delivered:
+                # The owner is gone without cleaning up, drop its entry so the device can reconnect anywhere
+                await self.__unregister_stale_owner(device_id, owner)
+                raise Exception("Device not connected")
+
+            CustomLogger()._get_logger().info(f"Command forwarded: {{ deviceId: \"{device_id}\", worker \"{owner}\", {description} }}")
+
+            try:
+                reply_message = await asyncio.wait_for(reply, timeout=self.COMMAND_TIMEOUT + 1)
+            except asyncio.TimeoutError:
+                raise Exception("Timeout waiting for response")
+
+            if "error" in reply_message:
+                raise Exception(reply_message["error"])
+            return reply_message["response"]
+
+        finally:
+            self.forwarded_commands.pop(request_id, None)
+
+    async def __unregister_stale_owner(self, device_id: str, owner: str):
+        try:
+            await MessageBus()._delete(self.__get_registry_key(device_id), if_value=owner)
+        except Exception as e:
+            CustomLogger()._get_logger().warning(f"Device registry error: {{ deviceId: \"{device_id}\" }} {e}")
+
+    async def __on_worker_message(self, message: dict):
+        if message.get("type") in ("command", "batch"):
+            # Command forwarded by another worker for a device connected here
+            try:
+                if message["type"] == "command":
+                    response = await self.__send_command(message["device_id"], message["target"], message["value"])
+                else:
+                    response = await self.__send_commands(message["device_id"], message["commands"])
+                reply = {"type": "reply", "request_id": message["request_id"], "response": response}
+            except Exception as e:
+                reply = {"type": "reply", "request_id": message["request_id"], "error": str(e.args[0]) if e.args else str(e)}
+
+            await MessageBus()._publish(self.__get_worker_channel(message["reply_to"]), reply)
+
+        elif message.get("type") == "reply":
+            reply = self.forwarded_commands.get(message.get("request_id"))
+            if reply is not None and not reply.done():
+                reply.set_result(message)
 
     async def _cleanup_command(self, device_id: str, command_id: str):
         """Clean up command state."""
@@ -267,29 +661,40 @@ class IOTService:
         if device_id in self.command_responses and command_id in self.command_responses[device_id]:
             del self.command_responses[device_id][command_id]
 
-    def update_services_status(self, uid: str, service_type: str, value: str, session):
-        if (service_type in (ServicesStatusDocument.ALL_VALUE_FIELDS.value)):
-            value = int(value)
-                
-        Database()._instance.get_services_status_collection().update_one(
-            { ServicesStatusDocument.FIELD_UID.value: uid },
+    async def _record_service_changes(self, uid: str, changes: list):
+        '''
+            Apply service changes, (service_type, value) pairs, and record them in the action history.
+            They are handed to the write-behind writer, waiting for a flush while its buffer is full.
+
+            Raises:
+                Exception: "Service change writer full" if no flush makes room in time.
+        '''
+        await ServiceChangeWriter()._put(uid, self._build_status_fields(changes), self._build_action_history(uid, changes))
+
+    def _build_status_fields(self, changes: list) -> dict:
+        '''
+            `services_status` fields set by the changes, later changes win. "system" sets every service.
+        '''
+        fields = {}
+        for service_type, value in changes:
+            if service_type == "system":
+                fields.update(AppService()._build_toggle_all_service_fields(value == "on"))
+            elif (service_type in (ServicesStatusDocument.ALL_VALUE_FIELDS.value)):
+                fields[service_type] = int(value)
+            else:
+                fields[service_type] = value
+        return fields
+
+    def _build_action_history(self, uid: str, changes: list) -> list:
+        # Ids are assigned here so pending actions can be told apart from stored ones and paged
+        timestamp = datetime.now()
+        return [
             {
-                "$set": {
-                    service_type: value
-                }
-            },
-            session=session
-        )
-
-    def write_action_history(self, uid: str, service_type: str, value: str, session):
-        action = {
-            ActionHistoryDocument.FIELD_UID.value: uid,
-            ActionHistoryDocument.FIELD_SERVICE_TYPE.value: service_type,
-            ActionHistoryDocument.FIELD_DESCRIPTION.value: f"{service_type} set to {value}",
-            ActionHistoryDocument.FIELD_TIMESTAMP.value: datetime.now().isoformat()
-        }
-
-        Database()._instance.get_action_history_collection().insert_one(
-            document=action,
-            session=session
-        )
\ No newline at end of file
+                "_id": ObjectId(),
+                ActionHistoryDocument.FIELD_UID.value: uid,
+                ActionHistoryDocument.FIELD_SERVICE_TYPE.value: service_type,
+                ActionHistoryDocument.FIELD_DESCRIPTION.value: f"{service_type} set to {value}",
+                ActionHistoryDocument.FIELD_TIMESTAMP.value: timestamp
+            }
+            for service_type, value in changes
+        ]
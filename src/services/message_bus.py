@@ -0,0 +1,343 @@
+from utils.custom_logger import CustomLogger
+
+import abc
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from services.redis_client import RedisClient
+
+Handler = Callable[[dict], Awaitable[None]]
+StreamEntries = List[Tuple[str, List[Tuple[str, dict]]]]  # [(stream, [(entry_id, fields)])]
+
+class MessageBus(abc.ABC):
+    '''
+        Shared state and messaging between the server workers, selected with MESSAGE_BUS_MODE:
+
+        - "redis" (default): keys, pub/sub channels and streams in Redis, shared by every worker and node.
+        - "local": in-process stand-in with the same interface, for a single worker and for tests.
+
+        Messages are JSON-serializable dicts. Handlers run in their own task, so a slow handler
+        does not hold up the delivery of other messages.
+    '''
+    MODE_REDIS = "redis"
+    MODE_LOCAL = "local"
+
+    _instance = None
+
+    def __new__(cls):
+        if not MessageBus._instance:
+            mode = os.getenv("MESSAGE_BUS_MODE", cls.MODE_REDIS)
+            if mode == cls.MODE_LOCAL:
+                implementation = LocalMessageBus
+            elif mode == cls.MODE_REDIS:
+                implementation = RedisMessageBus
+            else:
+                raise Exception(f"Invalid MESSAGE_BUS_MODE \"{mode}\"")
+
+            MessageBus._instance = super(MessageBus, cls).__new__(implementation)
+            MessageBus._instance._init_instance()
+        return MessageBus._instance
+
+    def _init_instance(self):
+        # Unique per process, also across restarts of the same pid
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._handlers: Dict[str, Handler] = {}
+        self._handler_tasks: set = set()
+
+    def _dispatch(self, channel: str, data: str):
+        handler = self._handlers.get(channel)
+        if handler is None:
+            return
+
+        try:
+            message = json.loads(data)
+        except ValueError:
+            CustomLogger()._get_logger().warning(f"Message bus error: invalid message on \"{channel}\"")
+            return
+
+        task = asyncio.create_task(self.__run_handler(channel, handler, message))
+        self._handler_tasks.add(task)
+        task.add_done_callback(self._handler_tasks.discard)
+
+    async def __run_handler(self, channel: str, handler: Handler, message: dict):
+        try:
+            await handler(message)
+        except Exception as e:
+            CustomLogger()._get_logger().error(f"Message bus error: handler of \"{channel}\" failed {e}")
+
+    @abc.abstractmethod
+    async def _set(self, key: str, value: str, ttl: float, only_if_absent: bool = False) -> bool:
+        '''
+            Set `key` for `ttl` seconds.
+
+            Returns:
+                bool: False if `only_if_absent` and the key already exists.
+        '''
+
+    @abc.abstractmethod
+    async def _set_many(self, mapping: Dict[str, str], ttl: float) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def _get(self, key: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    async def _delete(self, key: str, if_value: str = None) -> bool:
+        '''
+            Delete `key`, only if it still holds `if_value` when given.
+        '''
+
+    @abc.abstractmethod
+    async def _publish(self, channel: str, message: dict) -> int:
+        '''
+            Returns:
+                int: number of subscribers the message was delivered to.
+        '''
+
+    @abc.abstractmethod
+    async def _subscribe(self, channel: str, handler: Handler) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def _unsubscribe(self, channel: str) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def _append(self, stream: str, fields: Dict[str, str], maxlen: int, ttl: float) -> str:
+        '''
+            Append an entry to `stream`, keeping about the newest `maxlen` entries. The stream expires
+            `ttl` seconds after its last append.
+
+            Returns:
+                str: id of the entry, ids increase within a stream.
+        '''
+
+    @abc.abstractmethod
+    async def _read(self, streams: Dict[str, str], block: float, count: int = 100) -> StreamEntries:
+        '''
+            Entries appended after the given id of each stream, waiting up to `block` seconds for one.
+        '''
+
+    @abc.abstractmethod
+    async def _last_id(self, stream: str) -> str:
+        '''
+            Id of the newest entry of `stream`, to read only the entries appended from now on.
+        '''
+
+    @abc.abstractmethod
+    async def _range(self, stream: str, after_id: str, count: int = 100) -> List[Tuple[str, dict]]:
+        '''
+            Entries of `stream` still retained after `after_id`, oldest first, without waiting.
+        '''
+
+    async def _stop(self) -> None:
+        for task in list(self._handler_tasks):
+            task.cancel()
+
+class RedisMessageBus(MessageBus):
+    # Deletes KEYS[1] only if it holds ARGV[1]
+    __COMPARE_AND_DELETE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def _init_instance(self):
+        super()._init_instance()
+        self.__redis = RedisClient()._get_client()
+        self.__compare_and_delete_script = self.__redis.register_script(RedisMessageBus.__COMPARE_AND_DELETE_SCRIPT)
+
+        self.__pubsub = None
+        self.__listener_task: asyncio.Task = None
+        self.__subscribed = asyncio.Event()
+        # Held while the channels of the pub/sub connection change, so a channel added while the
+        # listener (re)subscribes is not left out
+        self.__subscribe_lock = asyncio.Lock()
+
+    async def _set(self, key: str, value: str, ttl: float, only_if_absent: bool = False) -> bool:
+        return bool(await self.__redis.set(key, value, px=int(ttl * 1000), nx=only_if_absent))
+
+    async def _set_many(self, mapping: Dict[str, str], ttl: float) -> None:
+        if not mapping:
+            return
+        async with self.__redis.pipeline(transaction=False) as pipe:
+            for key, value in mapping.items():
+                pipe.set(key, value, px=int(ttl * 1000))
+            await pipe.execute()
+
+    async def _get(self, key: str) -> Optional[str]:
+        return await self.__redis.get(key)
+
+    async def _delete(self, key: str, if_value: str = None) -> bool:
+        if if_value is None:
+            return bool(await self.__redis.delete(key))
+        return bool(await self.__compare_and_delete_script(keys=[key], args=[if_value]))
+
+    async def _publish(self, channel: str, message: dict) -> int:
+        return await self.__redis.publish(channel, json.dumps(message))
+
+    async def _append(self, stream: str, fields: Dict[str, str], maxlen: int, ttl: float) -> str:
+        async with self.__redis.pipeline(transaction=False) as pipe:
+            pipe.xadd(stream, fields, maxlen=maxlen, approximate=True)
+            pipe.expire(stream, int(ttl))
+            entry_id, _ = await pipe.execute()
+        return entry_id
+
+    async def _read(self, streams: Dict[str, str], block: float, count: int = 100) -> StreamEntries:
+        result = await self.__redis.xread(streams, count=count, block=int(block * 1000))
+        return [(stream, entries) for stream, entries in result or []]
+
+    async def _last_id(self, stream: str) -> str:
+        entries = await self.__redis.xrevrange(stream, count=1)
+        return entries[0][0] if entries else "0-0"
+
+    async def _range(self, stream: str, after_id: str, count: int = 100) -> List[Tuple[str, dict]]:
+        return await self.__redis.xrange(stream, min=f"({after_id}", max="+", count=count)
+
+    async def _subscribe(self, channel: str, handler: Handler) -> None:
+        async with self.__subscribe_lock:
+            self._handlers[channel] = handler
+
+            if self.__listener_task is None:
+                self.__listener_task = asyncio.create_task(self.__listen())
+            elif self.__pubsub is not None and self.__subscribed.is_set():
+                await self.__pubsub.subscribe(channel)
+
+    async def _unsubscribe(self, channel: str) -> None:
+        async with self.__subscribe_lock:
+            if self._handlers.pop(channel, None) is not None and self.__pubsub is not None and self.__subscribed.is_set():
+                await self.__pubsub.unsubscribe(channel)
+
+    async def _stop(self) -> None:
+        if self.__listener_task is not None:
+            self.__listener_task.cancel()
+            try:
+                await self.__listener_task
+            except asyncio.CancelledError:
+                pass
+            self.__listener_task = None
+        await super()._stop()
+
+    async def __listen(self):
+        # One pub/sub connection per worker, (re)subscribed to every channel with a handler
+        while True:
+            self.__pubsub = self.__redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                async with self.__subscribe_lock:
+                    if self._handlers:
+                        await self.__pubsub.subscribe(*self._handlers.keys())
+                    self.__subscribed.set()
+
+                while True:
+                    message = await self.__pubsub.get_message(timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self._dispatch(message["channel"], message["data"])
+
+            except Exception as e:
+                CustomLogger()._get_logger().warning(f"Message bus subscription lost: {e}")
+
+            finally:
+                self.__subscribed.clear()
+                await self.__pubsub.aclose()
+                self.__pubsub = None
+
+            await asyncio.sleep(1)
+
+class LocalMessageBus(MessageBus):
+    def _init_instance(self):
+        super()._init_instance()
+        self.__keys: Dict[str, tuple] = {}  # key -> (value, expires_at)
+
+        self.__streams: Dict[str, deque] = {}  # stream -> (sequence, fields), oldest first
+        self.__sequence = 0
+        self.__appended = asyncio.Condition()
+
+    def __get_live(self, key: str) -> Optional[str]:
+        entry = self.__keys.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= time.monotonic():
+            del self.__keys[key]
+            return None
+        return entry[0]
+
+    async def _set(self, key: str, value: str, ttl: float, only_if_absent: bool = False) -> bool:
+        if only_if_absent and self.__get_live(key) is not None:
+            return False
+        self.__keys[key] = (value, time.monotonic() + ttl)
+        return True
+
+    async def _set_many(self, mapping: Dict[str, str], ttl: float) -> None:
+        for key, value in mapping.items():
+            await self._set(key, value, ttl)
+
+    async def _get(self, key: str) -> Optional[str]:
+        return self.__get_live(key)
+
+    async def _delete(self, key: str, if_value: str = None) -> bool:
+        value = self.__get_live(key)
+        if value is None or (if_value is not None and value != if_value):
+            return False
+        del self.__keys[key]
+        return True
+
+    async def _append(self, stream: str, fields: Dict[str, str], maxlen: int, ttl: float) -> str:
+        self.__sequence += 1
+        entries = self.__streams.get(stream)
+        if entries is None or entries.maxlen != maxlen:
+            entries = self.__streams[stream] = deque(entries or [], maxlen=maxlen)
+        entries.append((self.__sequence, dict(fields)))
+
+        async with self.__appended:
+            self.__appended.notify_all()
+        return f"{self.__sequence}-0"
+
+    def __collect(self, streams: Dict[str, str], count: int) -> StreamEntries:
+        result = []
+        for stream, last_id in streams.items():
+            after = int(last_id.split("-")[0])
+            entries = [(f"{sequence}-0", fields) for sequence, fields in self.__streams.get(stream, ()) if sequence > after]
+            if entries:
+                result.append((stream, entries[:count]))
+        return result
+
+    async def _read(self, streams: Dict[str, str], block: float, count: int = 100) -> StreamEntries:
+        result = self.__collect(streams, count)
+        if result:
+            return result
+
+        async with self.__appended:
+            try:
+                await asyncio.wait_for(self.__appended.wait(), timeout=block)
+            except asyncio.TimeoutError:
+                return []
+        return self.__collect(streams, count)
+
+    async def _last_id(self, stream: str) -> str:
+        entries = self.__streams.get(stream)
+        return f"{entries[-1][0]}-0" if entries else "0-0"
+
+    async def _range(self, stream: str, after_id: str, count: int = 100) -> List[Tuple[str, dict]]:
+        result = self.__collect({stream: after_id}, count)
+        return result[0][1] if result else []
+
+    async def _publish(self, channel: str, message: dict) -> int:
+        if channel not in self._handlers:
+            return 0
+        self._dispatch(channel, json.dumps(message))
+        return 1
+
+    async def _subscribe(self, channel: str, handler: Handler) -> None:
+        self._handlers[channel] = handler
+
+    async def _unsubscribe(self, channel: str) -> None:
+        self._handlers.pop(channel, None)
@@ -0,0 +1,128 @@
+from utils.custom_logger import CustomLogger
+from utils.rate_limiter import RateLimit
+from utils.ttl_cache import TTLCache
+
+import math
+import os
+import time
+from typing import Tuple
+
+from services.redis_client import RedisClient
+
+class RateLimitService:
+    '''
+        Token buckets shared by every worker through Redis.
+
+        A bucket holds `count` tokens and refills at `count / period` tokens per second. Each worker
+        keeps a local copy of the buckets it saw: a request the local bucket already rejects could
+        not pass the shared one either, so it is rejected without a Redis round trip. If Redis is
+        unreachable the local buckets alone are enforced.
+
+        Redis keys expire once their bucket would be full again and the local buckets are a bounded
+        LRU, so idle clients do not keep memory.
+    '''
+    _instance = None
+
+    KEY_PREFIX = "ratelimit"
+
+    # KEYS[1]: bucket, ARGV: capacity, refill tokens per ms.
+    # Returns {allowed, retry_after_ms}; uses the Redis clock so every worker shares one time base.
+    __TOKEN_BUCKET_SCRIPT = """
+        local capacity = tonumber(ARGV[1])
+        local rate = tonumber(ARGV[2])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+        local tokens = tonumber(bucket[1]) or capacity
+        local ts = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+
+        local allowed = 0
+        local retry_after = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+            allowed = 1
+        else
+            retry_after = math.ceil((1 - tokens) / rate)
+        end
+
+        redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+        redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate) + 1000)
+        return {allowed, retry_after}
+    """
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(RateLimitService, cls).__new__(cls)
+            cls._instance.__init_instance()
+        return cls._instance
+
+    def __init_instance(self):
+        self.__redis = RedisClient()._get_client()
+        self.__token_bucket_script = self.__redis.register_script(RateLimitService.__TOKEN_BUCKET_SCRIPT)
+
+        # key -> [tokens, updated_at]
+        self.__local_buckets = TTLCache(
+            max_size=int(os.getenv("RATE_LIMIT_LOCAL_SIZE", 100000)),
+            ttl=float(os.getenv("RATE_LIMIT_LOCAL_TTL", 3600))
+        )
+
+        self.__stats = {
+            "allowed": 0,
+            "rejected_local": 0,
+            "rejected_shared": 0,
+            "redis_errors": 0,
+        }
+
+    async def _hit(self, key: str, limit: RateLimit) -> Tuple[bool, float]:
+        '''
+            Take one token of the bucket `key`.
+
+            Returns:
+                Tuple[bool, float]: Whether the request is allowed, and the seconds to wait before retrying if not.
+        '''
+        rate = limit.count / limit.period  # tokens per second
+        allowed, retry_after = self.__take_local(key, limit, rate)
+        if not allowed:
+            self.__stats["rejected_local"] += 1
+            return False, retry_after
+
+        try:
+            allowed, retry_after_ms = await self.__token_bucket_script(
+                keys=[f"{self.KEY_PREFIX}:{key}"],
+                args=[limit.count, rate / 1000]
+            )
+        except Exception as e:
+            self.__stats["redis_errors"] += 1
+            CustomLogger()._get_logger().warning(f"Rate limit check FAIL, local bucket only: {e}")
+            self.__stats["allowed"] += 1
+            return True, 0
+
+        if not allowed:
+            # Mirror the shared bucket so the next requests are rejected locally
+            self.__local_buckets.set(key, [0.0, time.monotonic()], ttl=limit.period)
+            self.__stats["rejected_shared"] += 1
+            return False, retry_after_ms / 1000
+
+        self.__stats["allowed"] += 1
+        return True, 0
+
+    def __take_local(self, key: str, limit: RateLimit, rate: float) -> Tuple[bool, float]:
+        now = time.monotonic()
+        bucket = self.__local_buckets.get(key)
+        if bucket is None:
+            bucket = [float(limit.count), now]
+        else:
+            bucket[0] = min(limit.count, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False, math.ceil((1 - bucket[0]) / rate * 1000) / 1000
+
+        bucket[0] -= 1
+        self.__local_buckets.set(key, bucket, ttl=limit.period)
+        return True, 0
+
+    def _get_stats(self) -> dict:
+        return {**self.__stats, "local_buckets": len(self.__local_buckets)}
@@ -0,0 +1,56 @@
+from utils.custom_logger import CustomLogger
+
+import os
+import redis.asyncio as redis
+
+class RedisClient:
+    '''
+        Shared asyncio Redis client on an explicit, bounded connection pool.
+
+        Callers wait up to REDIS_POOL_TIMEOUT seconds for a free connection once
+        REDIS_MAX_CONNECTIONS are in use, instead of opening new ones without limit.
+    '''
+    _instance = None
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(RedisClient, cls).__new__(cls)
+            cls._instance._init_instance()
+        return cls._instance
+
+    def _init_instance(self):
+        self.pool = redis.BlockingConnectionPool(
+            host=os.getenv("REDIS_HOST"),
+            port=int(os.getenv("REDIS_PORT", 6379)),
+            username="default",
+            password=os.getenv("REDIS_PASSWORD"),
+            decode_responses=True,
+            max_connections=int(os.getenv("REDIS_MAX_CONNECTIONS", 50)),
+            timeout=float(os.getenv("REDIS_POOL_TIMEOUT", 5)),
+            socket_timeout=float(os.getenv("REDIS_SOCKET_TIMEOUT", 5)),
+            health_check_interval=30
+        )
+        self.client = redis.Redis(connection_pool=self.pool)
+
+    def _get_client(self) -> redis.Redis:
+        return self.client
+
+    def _get_pool_stats(self) -> dict:
+        '''
+            Connections of the pool, reported by `/health`. redis-py has no public API for them: they
+            are counted from the private `_in_use_connections` and `_available_connections` of its
+            connection pool (redis-py 5.x), and read as 0 if a redis-py upgrade renames them.
+        '''
+        in_use = len(getattr(self.pool, "_in_use_connections", ()))
+        idle = len(getattr(self.pool, "_available_connections", ()))
+        return {
+            "max_connections": self.pool.max_connections,
+            "in_use": in_use,
+            "idle": idle,
+            "created": in_use + idle,
+        }
+
+    async def _close(self):
+        CustomLogger()._get_logger().info(f"Closing Redis pool: {self._get_pool_stats()}")
+        await self.client.aclose()
+        await self.pool.disconnect()
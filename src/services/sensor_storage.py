@@ -0,0 +1,221 @@
+import os
+from datetime import datetime
+
+from pymongo.errors import BulkWriteError
+
+from services.database import Database
+
+from models.mongo_doc import EnvironmentSensorDocument, MigrationDocument
+
+class SensorStorage:
+    '''
+        Layout of the environment sensor readings, selected with SENSOR_STORAGE_MODE:
+
+        - "document" (default): one document per reading in `environment_sensor`.
+        - "timeseries": `environment_sensor_ts` time-series collection, MongoDB buckets the readings
+          per (uid, sensor_type) meta value and time window, with native datetime timestamps.
+
+        Readers and writers go through this class so the layout stays transparent to them.
+    '''
+    MODE_DOCUMENT = "document"
+    MODE_TIMESERIES = "timeseries"
+
+    _instance = None
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(SensorStorage, cls).__new__(cls)
+            cls._instance._init_instance()
+        return cls._instance
+
+    def _init_instance(self):
+        self.mode = os.getenv("SENSOR_STORAGE_MODE", self.MODE_DOCUMENT)
+        if self.mode not in (self.MODE_DOCUMENT, self.MODE_TIMESERIES):
+            raise Exception(f"Invalid SENSOR_STORAGE_MODE \"{self.mode}\"")
+
+    def _is_timeseries(self) -> bool:
+        return self.mode == self.MODE_TIMESERIES
+
+    def _get_collection_name(self) -> str:
+        if self._is_timeseries():
+            return Database.FIELD_ENV_SENSOR_TS_COLLECTION
+        return Database.FIELD_ENV_SENSOR_COLLECTION
+
+    def _get_collection(self):
+        if self._is_timeseries():
+            return Database()._instance.get_env_sensor_ts_collection()
+        return Database()._instance.get_env_sensor_collection()
+
+    def _field(self, field: EnvironmentSensorDocument) -> str:
+        '''
+            Path of a reading field in the active layout, e.g. "meta.uid" for the uid of a time-series reading.
+        '''
+        if self._is_timeseries() and field in (EnvironmentSensorDocument.FIELD_UID, EnvironmentSensorDocument.FIELD_SENSOR_TYPE):
+            return f"{EnvironmentSensorDocument.FIELD_META.value}.{field.value}"
+        return field.value
+
+    def _get_flatten_stages(self) -> list:
+        '''
+            Aggregation stages turning stored readings back into flat {uid, sensor_type, value, timestamp} documents.
+        '''
+        if not self._is_timeseries():
+            return []
+
+        return [
+            {
+                "$addFields": {
+                    EnvironmentSensorDocument.FIELD_UID.value: f"${self._field(EnvironmentSensorDocument.FIELD_UID)}",
+                    EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: f"${self._field(EnvironmentSensorDocument.FIELD_SENSOR_TYPE)}"
+                }
+            },
+            {"$project": {EnvironmentSensorDocument.FIELD_META.value: 0}}
+        ]
+
+    def _flatten(self, doc: dict) -> dict:
+        '''
+            Same as `_get_flatten_stages` for a document read with find.
+        '''
+        if doc and EnvironmentSensorDocument.FIELD_META.value in doc:
+            meta = doc.pop(EnvironmentSensorDocument.FIELD_META.value)
+            doc[EnvironmentSensorDocument.FIELD_UID.value] = meta.get(EnvironmentSensorDocument.FIELD_UID.value)
+            doc[EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value] = meta.get(EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value)
+        return doc
+
+    def _to_document(self, uid: str, sensor_type: str, value, timestamp, timeseries: bool = None) -> dict:
+        '''
+            Build the stored document of a reading; ISO string timestamps become native datetimes.
+
+            Readings are stored with naive server local timestamps, like the ones the server sets and
+            the history windows are computed in: a timezone-aware timestamp, e.g. sent by a device, is
+            converted to local time, pymongo would otherwise store it converted to UTC.
+        '''
+        if isinstance(timestamp, str):
+            timestamp = datetime.fromisoformat(timestamp)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone().replace(tzinfo=None)
+
+        if timeseries is None:
+            timeseries = self._is_timeseries()
+
+        if timeseries:
+            return {
+                EnvironmentSensorDocument.FIELD_META.value: {
+                    EnvironmentSensorDocument.FIELD_UID.value: uid,
+                    EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: sensor_type
+                },
+                EnvironmentSensorDocument.FIELD_VALUE.value: value,
+                EnvironmentSensorDocument.FIELD_TIMESTAMP.value: timestamp
+            }
+
+        return {
+            EnvironmentSensorDocument.FIELD_UID.value: uid,
+            EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value: sensor_type,
+            EnvironmentSensorDocument.FIELD_VALUE.value: value,
+            EnvironmentSensorDocument.FIELD_TIMESTAMP.value: timestamp
+        }
+
+    def _migrate_to_timeseries(self, batch_size: int = 10000, log=None) -> int:
+        '''
+            Copy `environment_sensor` documents into the time-series collection in _id order. Progress is
+            checkpointed in the migration collection after every batch, so an interrupted run resumes
+            where it stopped. Blocking, run it through `Database().run`.
+
+            Copies keep the _id of their source document. Time-series collections have no unique
+            index, so the first batch of a run, the only one an interrupted run may have inserted
+            without checkpointing it, skips the readings already copied. Readings that can not be
+            converted, e.g. without a timestamp, and those the insert rejects are skipped and logged.
+
+            Returns:
+                int: number of readings copied by this run.
+        '''
+        Database()._instance.ensure_timeseries_collection(Database.FIELD_ENV_SENSOR_TS_COLLECTION)
+
+        source = Database()._instance.get_env_sensor_collection()
+        target = Database()._instance.get_env_sensor_ts_collection()
+        migrations = Database()._instance.get_migration_collection()
+        migration_name = "environment_sensor_timeseries"
+
+        checkpoint = migrations.find_one({MigrationDocument.FIELD_NAME.value: migration_name}) or {}
+        last_id = checkpoint.get(MigrationDocument.FIELD_LAST_ID.value)
+
+        copied = 0
+        first_batch = True
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            batch = list(source.find(query, sort=[("_id", 1)], limit=batch_size))
+            if not batch:
+                break
+
+            documents = []
+            skipped = 0
+            for doc in batch:
+                try:
+                    document = self._to_document(
+                        doc.get(EnvironmentSensorDocument.FIELD_UID.value),
+                        doc.get(EnvironmentSensorDocument.FIELD_SENSOR_TYPE.value),
+                        doc.get(EnvironmentSensorDocument.FIELD_VALUE.value),
+                        doc.get(EnvironmentSensorDocument.FIELD_TIMESTAMP.value),
+                        timeseries=True
+                    )
+                except (AttributeError, TypeError, ValueError) as e:
+                    skipped += 1
+                    if log:
+                        log(f"Skipped reading {doc['_id']}: invalid timestamp {doc.get(EnvironmentSensorDocument.FIELD_TIMESTAMP.value)!r} {e}")
+                    continue
+                document["_id"] = doc["_id"]
+                documents.append(document)
+
+            copied_before = 0
+            if first_batch and documents:
+                remaining = self.__skip_copied(target, documents)
+                copied_before = len(documents) - len(remaining)
+                documents = remaining
+                first_batch = False
+
+            inserted = len(documents)
+            if documents:
+                try:
+                    target.insert_many(documents, ordered=False)
+                except BulkWriteError as e:
+                    errors = e.details.get("writeErrors", [])
+                    inserted -= len(errors)
+                    skipped += len(errors)
+                    if log:
+                        for error in errors:
+                            log(f"Skipped reading {documents[error['index']]['_id']}: {error.get('errmsg')}")
+
+            last_id = batch[-1]["_id"]
+            copied += inserted
+            migrations.update_one(
+                {MigrationDocument.FIELD_NAME.value: migration_name},
+                {
+                    "$set": {
+                        MigrationDocument.FIELD_LAST_ID.value: last_id,
+                        MigrationDocument.FIELD_UPDATED_AT.value: datetime.now()
+                    },
+                    "$inc": {
+                        MigrationDocument.FIELD_MIGRATED.value: inserted + copied_before,
+                        MigrationDocument.FIELD_SKIPPED.value: skipped
+                    }
+                },
+                upsert=True
+            )
+            if log:
+                log(f"Migrated {copied} readings, last _id {last_id}" + (f", {skipped} skipped" if skipped else ""))
+
+        return copied
+
+    def __skip_copied(self, target, documents: list) -> list:
+        # Bounded by the batch's time range, so only its buckets are read
+        timestamp_field = EnvironmentSensorDocument.FIELD_TIMESTAMP.value
+        timestamps = [document[timestamp_field] for document in documents]
+        copied_ids = {
+            doc["_id"] for doc in target.find(
+                {
+                    timestamp_field: {"$gte": min(timestamps), "$lte": max(timestamps)},
+                    "_id": {"$in": [document["_id"] for document in documents]}
+                },
+                {"_id": 1}
+            )
+        }
+        return [document for document in documents if document["_id"] not in copied_ids]
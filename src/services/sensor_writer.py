@@ -0,0 +1,113 @@
+from utils.custom_logger import CustomLogger
+
+import asyncio
+import os
+
+from pymongo.errors import BulkWriteError
+
+from services.database import Database
+from services.sensor_storage import SensorStorage
+
+class SensorWriter:
+    '''
+        Write-behind buffer for sensor readings received over the device WebSockets.
+
+        Readings are buffered in memory and written with one unordered `insert_many` whenever
+        `batch_size` readings are pending or `flush_interval` seconds have passed. At most
+        `max_pending` readings are buffered, further readings are dropped and counted.
+    '''
+    _instance = None
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(SensorWriter, cls).__new__(cls)
+            cls._instance._init_instance()
+        return cls._instance
+
+    def _init_instance(self):
+        self.batch_size = int(os.getenv("SENSOR_WRITER_BATCH_SIZE", 500))
+        self.flush_interval = float(os.getenv("SENSOR_WRITER_FLUSH_INTERVAL", 0.5))  # seconds
+        self.max_pending = int(os.getenv("SENSOR_WRITER_MAX_PENDING", 20000))
+
+        self._buffer: list = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task = None
+
+        self._stats = {
+            "accepted": 0,
+            "dropped": 0,
+            "written": 0,
+            "failed": 0,
+            "flushes": 0,
+        }
+
+    def _enqueue(self, documents: list) -> bool:
+        '''
+            Buffer reading documents (already in the storage layout) for the next flush.
+
+            Returns:
+                bool: False if the buffer is full and the readings were dropped.
+        '''
+        if len(self._buffer) + len(documents) > self.max_pending:
+            self._stats["dropped"] += len(documents)
+            return False
+
+        self._buffer.extend(documents)
+        self._stats["accepted"] += len(documents)
+
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def _start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            CustomLogger()._get_logger().info(f"Sensor writer started: {{ batch_size: {self.batch_size}, flush_interval: {self.flush_interval} }}")
+
+    async def _stop(self):
+        '''
+            Stop the flush loop and write whatever is still buffered.
+        '''
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        await self._flush()
+        CustomLogger()._get_logger().info(f"Sensor writer stopped: {self._get_stats()}")
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            await self._flush()
+
+    async def _flush(self):
+        while self._buffer:
+            batch = self._buffer[:self.batch_size]
+            del self._buffer[:self.batch_size]
+
+            self._stats["flushes"] += 1
+            try:
+                await Database()._instance.run(SensorStorage()._get_collection().insert_many, batch, ordered=False)
+                self._stats["written"] += len(batch)
+
+            except BulkWriteError as e:
+                inserted = e.details.get("nInserted", 0)
+                self._stats["written"] += inserted
+                self._stats["failed"] += len(batch) - inserted
+                CustomLogger()._get_logger().error(f"Sensor writer error: {len(batch) - inserted} of {len(batch)} readings not written {e.details.get('writeErrors', [])[:1]}")
+
+            except Exception as e:
+                self._stats["failed"] += len(batch)
+                CustomLogger()._get_logger().error(f"Sensor writer error: {len(batch)} readings not written {e}")
+
+    def _get_stats(self) -> dict:
+        return {**self._stats, "pending": len(self._buffer)}
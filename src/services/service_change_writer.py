@@ -0,0 +1,285 @@
+from utils.custom_logger import CustomLogger
+
+import asyncio
+import os
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from services.database import Database
+from services.services_status_storage import ServicesStatusStorage
+from models.mongo_doc import ActionHistoryDocument, ServicesStatusDocument
+
+class ServiceChangeWriter:
+    '''
+        Write-behind buffer for service changes: `services_status` updates and their `action_history`
+        entries.
+
+        Status updates are coalesced per uid, the newest value of each field wins, and written with
+        one unordered `bulk_write`; history entries are written with one unordered `insert_many` per
+        `batch_size` entries. A flush runs once `batch_size` entries are pending, every
+        `flush_interval` seconds and on stop. At most `max_pending` entries are buffered, a further
+        change waits up to `put_timeout` seconds for a flush to make room. Changes are never written
+        around the buffer, a buffered older value would overwrite them once flushed.
+
+        Status updates of a failed flush are kept for the next one, they are idempotent. History
+        entries that failed to insert are retried by the next flushes, at most `max_retries` times;
+        their `_id` is set when built, so one inserted by an attempt whose reply was lost is not
+        inserted twice. In the "embedded" services status mode, the history entries of a user are
+        pushed with its status update and archived to `action_history` only once that update is
+        written. Until written, pending changes are overlaid on the status and history reads of
+        their user.
+    '''
+    _instance = None
+
+    DUPLICATE_KEY_ERROR = 11000
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(ServiceChangeWriter, cls).__new__(cls)
+            cls._instance._init_instance()
+        return cls._instance
+
+    def _init_instance(self):
+        self.batch_size = int(os.getenv("SERVICE_WRITER_BATCH_SIZE", 500))
+        self.flush_interval = float(os.getenv("SERVICE_WRITER_FLUSH_INTERVAL", 0.2))  # seconds
+        self.max_pending = int(os.getenv("SERVICE_WRITER_MAX_PENDING", 10000))
+        self.put_timeout = float(os.getenv("SERVICE_WRITER_PUT_TIMEOUT", 5))  # seconds
+        self.max_retries = int(os.getenv("SERVICE_WRITER_MAX_RETRIES", 10))
+
+        self._status: dict = {}         # uid -> {field: value}
+        self._actions: list = []        # action history documents, oldest first
+        self._flushing_status: dict = {}
+        self._flushing_actions: list = []
+
+        self._archive: list = []        # "embedded": actions in the status history, not in action_history yet
+        self._attempts: dict = {}       # _id -> failed inserts of an action
+        self._stopping = False
+
+        self._wakeup = asyncio.Event()
+        self._room = asyncio.Event()    # set after every flush
+        self._task: asyncio.Task = None
+
+        self._stats = {
+            "accepted": 0,
+            "waited": 0,
+            "refused": 0,
+            "coalesced": 0,
+            "status_written": 0,
+            "actions_written": 0,
+            "failed": 0,
+            "flushes": 0,
+        }
+
+    def _enqueue(self, uid: str, status_fields: dict, actions: list) -> bool:
+        '''
+            Buffer a change: the `services_status` fields to set for `uid` and the action history
+            documents recording it.
+
+            Returns:
+                bool: False if the buffer is full and the change was not taken.
+        '''
+        pending = len(self._status) + len(self._actions) + len(self._archive)
+        if pending + 1 + len(actions) > self.max_pending:
+            return False
+
+        fields = self._status.setdefault(uid, {})
+        self._stats["coalesced"] += sum(1 for field in status_fields if field in fields)
+        fields.update(status_fields)
+        self._actions.extend(actions)
+        self._stats["accepted"] += 1
+
+        if len(self._status) + len(self._actions) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    async def _put(self, uid: str, status_fields: dict, actions: list):
+        '''
+            Buffer a change like `_enqueue`, waiting for flushes to make room while the buffer is full.
+
+            Raises:
+                Exception: "Service change writer full" if there is still no room after `put_timeout`.
+        '''
+        if self._enqueue(uid, status_fields, actions):
+            return
+
+        self._stats["waited"] += 1
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.put_timeout
+        while True:
+            if self._task is None:
+                # Not started, e.g. from a script: flush here, once
+                await self._flush()
+                deadline = loop.time()
+            else:
+                self._room.clear()
+                self._wakeup.set()
+                try:
+                    await asyncio.wait_for(self._room.wait(), timeout=max(deadline - loop.time(), 0))
+                except asyncio.TimeoutError:
+                    pass
+
+            if self._enqueue(uid, status_fields, actions):
+                return
+            if loop.time() >= deadline:
+                self._stats["refused"] += 1
+                raise Exception("Service change writer full")
+
+    def _get_pending_status(self, uid: str) -> dict:
+        '''Status fields of `uid` not written yet, newest values.'''
+        return {**self._flushing_status.get(uid, {}), **self._status.get(uid, {})}
+
+    def _get_pending_actions(self, uid: str) -> list:
+        '''Action history documents of `uid` not written yet, oldest first.'''
+        uid_field = ActionHistoryDocument.FIELD_UID.value
+        return [action for action in self._flushing_actions + self._actions if action[uid_field] == uid]
+
+    async def _start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            CustomLogger()._get_logger().info(f"Service change writer started: {{ batch_size: {self.batch_size}, flush_interval: {self.flush_interval} }}")
+
+    async def _stop(self):
+        '''
+            Stop the flush loop once its flush in progress is done, and write whatever is still buffered.
+        '''
+        if self._task is not None:
+            # Not cancelled, a cancellation could cut a flush short between its status and history writes
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+            self._stopping = False
+
+        await self._flush()
+        CustomLogger()._get_logger().info(f"Service change writer stopped: {self._get_stats()}")
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            await self._flush()
+
+    async def _flush(self):
+        if not self._status and not self._actions and not self._archive:
+            return
+
+        self._flushing_status, self._status = self._status, {}
+        self._flushing_actions, self._actions = self._actions, []
+        archive, self._archive = self._archive, []
+        self._stats["flushes"] += 1
+        try:
+            written = await self.__write_status(self._flushing_status, self._flushing_actions)
+            if not ServicesStatusStorage()._is_embedded():
+                await self.__write_actions(self._flushing_actions)
+            elif written:
+                # Already read from the embedded history, the archive is not overlaid
+                archive.extend(self._flushing_actions)
+                self._flushing_actions = []
+                await self.__write_actions(archive)
+            # Otherwise pushed to the embedded history with the retried status updates, then archived
+        finally:
+            # Whatever a cancellation left unwritten goes to the next flush
+            self._actions[:0] = self._flushing_actions
+            self._archive[:0] = archive
+            self._flushing_status = {}
+            self._flushing_actions = []
+            self._room.set()
+
+    async def __write_status(self, status: dict, actions: list) -> bool:
+        if not status:
+            return True
+
+        storage = ServicesStatusStorage()
+        actions_by_uid = {}
+        if storage._is_embedded():
+            for action in actions:
+                actions_by_uid.setdefault(action[ActionHistoryDocument.FIELD_UID.value], []).append(action)
+
+        requests = [
+            UpdateOne({ServicesStatusDocument.FIELD_UID.value: uid}, storage._build_update(fields, actions_by_uid.get(uid)))
+            for uid, fields in status.items()
+        ]
+        written = False
+        try:
+            await Database()._instance.run(Database()._instance.get_services_status_collection().bulk_write, requests, ordered=False)
+            self._stats["status_written"] += len(requests)
+            written = True
+
+        except Exception as e:
+            CustomLogger()._get_logger().error(f"Service change writer error: {len(requests)} status updates not written, retrying {e}")
+
+        finally:
+            if not written:
+                # Retried with the next flush, values set meanwhile win
+                for uid, fields in status.items():
+                    pending = self._status.setdefault(uid, {})
+                    for field, value in fields.items():
+                        pending.setdefault(field, value)
+        return written
+
+    async def __write_actions(self, actions: list):
+        '''
+            Insert `actions` batch by batch, removing each batch from the list once handled so only
+            the unwritten ones remain if this is cut short. Entries that failed are put back at the
+            end of the list for the next flush, at most `max_retries` times.
+        '''
+        retries = []
+        try:
+            while actions:
+                batch = actions[:self.batch_size]
+                failed = []
+                try:
+                    await Database()._instance.run(Database()._instance.get_action_history_collection().insert_many, batch, ordered=False)
+
+                except BulkWriteError as e:
+                    # A duplicate _id was inserted by an earlier attempt whose reply was lost
+                    failed = [
+                        batch[error["index"]] for error in e.details.get("writeErrors", [])
+                        if error.get("code") != self.DUPLICATE_KEY_ERROR
+                    ]
+                    CustomLogger()._get_logger().error(f"Service change writer error: {len(failed)} of {len(batch)} actions not written, retrying {e.details.get('writeErrors', [])[:1]}")
+
+                except Exception as e:
+                    failed = batch
+                    CustomLogger()._get_logger().error(f"Service change writer error: {len(batch)} actions not written, retrying {e}")
+
+                self._stats["actions_written"] += len(batch) - len(failed)
+                if self._attempts:
+                    failed_ids = {action["_id"] for action in failed}
+                    for action in batch:
+                        if action["_id"] not in failed_ids:
+                            self._attempts.pop(action["_id"], None)
+                del actions[:len(batch)]
+                retries.extend(self.__get_retries(failed))
+        finally:
+            actions.extend(retries)
+
+    def __get_retries(self, failed: list) -> list:
+        '''Failed actions to insert again, those past `max_retries` attempts are dropped.'''
+        retries = []
+        for action in failed:
+            attempts = self._attempts.get(action["_id"], 0) + 1
+            if attempts > self.max_retries:
+                self._attempts.pop(action["_id"], None)
+                continue
+            self._attempts[action["_id"]] = attempts
+            retries.append(action)
+
+        dropped = len(failed) - len(retries)
+        if dropped:
+            self._stats["failed"] += dropped
+            CustomLogger()._get_logger().error(f"Service change writer error: {dropped} actions dropped after {self.max_retries} retries")
+        return retries
+
+    def _get_stats(self) -> dict:
+        return {
+            **self._stats,
+            "pending_status": len(self._status),
+            "pending_actions": len(self._actions),
+            "pending_archive": len(self._archive)
+        }
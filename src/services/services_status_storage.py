@@ -0,0 +1,134 @@
+import os
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+from services.database import Database
+
+from models.mongo_doc import ActionHistoryDocument, ServicesStatusDocument
+
+class ServicesStatusStorage:
+    '''
+        Layout of the services status and its action history, selected with SERVICES_STATUS_MODE:
+
+        - "separate" (default): the status document in `services_status`, every change in `action_history`.
+          A change is applied and recorded with two writes.
+        - "embedded": the newest `history_size` changes are also kept in the status document's
+          `history` array, pushed with `$slice`. One `update_one` applies and records a change, one
+          `find_one` reads the status and its recent history; `action_history` becomes the archive
+          of every change and is written asynchronously.
+
+        Writers and readers go through this class so the layout stays transparent to them.
+    '''
+    MODE_SEPARATE = "separate"
+    MODE_EMBEDDED = "embedded"
+
+    _instance = None
+
+    def __new__(cls):
+        if not cls._instance:
+            cls._instance = super(ServicesStatusStorage, cls).__new__(cls)
+            cls._instance._init_instance()
+        return cls._instance
+
+    def _init_instance(self):
+        self.mode = os.getenv("SERVICES_STATUS_MODE", self.MODE_SEPARATE)
+        if self.mode not in (self.MODE_SEPARATE, self.MODE_EMBEDDED):
+            raise Exception(f"Invalid SERVICES_STATUS_MODE \"{self.mode}\"")
+
+        self.history_size = int(os.getenv("SERVICES_HISTORY_SIZE", 15))
+
+    def _is_embedded(self) -> bool:
+        return self.mode == self.MODE_EMBEDDED
+
+    def _build_update(self, status_fields: dict, actions: list) -> dict:
+        '''
+            Update of a status document setting `status_fields`, and in "embedded" mode recording
+            `actions` (action history documents, oldest first) in its history.
+        '''
+        update = {"$set": status_fields}
+        if self._is_embedded() and actions:
+            update["$push"] = {
+                ServicesStatusDocument.FIELD_HISTORY.value: {
+                    "$each": [self._to_history_entry(action) for action in actions],
+                    "$slice": -self.history_size
+                }
+            }
+        return update
+
+    def _to_history_entry(self, action: dict) -> dict:
+        # The uid is the status document's own, the _id is the archived action's
+        return {
+            field: action[field]
+            for field in ["_id"] + ActionHistoryDocument.ALL_BASIC_FIELDS.value
+            if field in action
+        }
+
+    def _get_history(self, services_status: dict) -> list:
+        '''
+            Embedded history of a status document, newest first.
+        '''
+        return list(reversed(services_status.get(ServicesStatusDocument.FIELD_HISTORY.value) or []))
+
+    def __parse_timestamp(self, timestamp):
+        # None if it is not an ISO string
+        try:
+            return datetime.fromisoformat(timestamp)
+        except (TypeError, ValueError):
+            return None
+
+    def _migrate_history_timestamps(self, batch_size: int = 10000, log=None) -> int:
+        '''
+            Convert the ISO string timestamps of the action history into native datetimes, in
+            `action_history` and in the embedded histories. Only string timestamps are selected, so an
+            interrupted run is resumed by running it again; unparseable ones are left as they are.
+            The (uid, timestamp) index the keyset pagination index replaced is dropped at the end.
+            Blocking, run it through `Database().run`.
+
+            Returns:
+                int: number of actions converted by this run.
+        '''
+        timestamp_field = ActionHistoryDocument.FIELD_TIMESTAMP.value
+        actions = Database()._instance.get_action_history_collection()
+
+        converted = 0
+        last_id = None
+        while True:
+            query = {timestamp_field: {"$type": "string"}}
+            if last_id is not None:
+                query["_id"] = {"$gt": last_id}
+            batch = list(actions.find(query, {timestamp_field: 1}, sort=[("_id", 1)], limit=batch_size))
+            if not batch:
+                break
+
+            requests = []
+            for action in batch:
+                timestamp = self.__parse_timestamp(action[timestamp_field])
+                if timestamp is not None:
+                    requests.append(UpdateOne({"_id": action["_id"], timestamp_field: action[timestamp_field]}, {"$set": {timestamp_field: timestamp}}))
+            if requests:
+                converted += actions.bulk_write(requests, ordered=False).modified_count
+
+            last_id = batch[-1]["_id"]
+            if log:
+                log(f"Migrated {converted} action timestamps, last _id {last_id}")
+
+        # Embedded histories are replaced only if no action was pushed meanwhile, a later run picks them up
+        history_field = ServicesStatusDocument.FIELD_HISTORY.value
+        statuses = Database()._instance.get_services_status_collection()
+        for services_status in statuses.find({f"{history_field}.{timestamp_field}": {"$type": "string"}}, {history_field: 1}):
+            history = services_status[history_field]
+            migrated = []
+            for entry in history:
+                timestamp = self.__parse_timestamp(entry.get(timestamp_field)) if isinstance(entry.get(timestamp_field), str) else None
+                migrated.append({**entry, timestamp_field: timestamp} if timestamp is not None else entry)
+
+            result = statuses.update_one({"_id": services_status["_id"], history_field: history}, {"$set": {history_field: migrated}})
+            if result.modified_count:
+                converted += sum(1 for before, after in zip(history, migrated) if before is not after)
+
+        dropped = Database()._instance.drop_superseded_indexes(Database.FIELD_ACTION_HISTORY_COLLECTION)
+        if log and dropped:
+            log(f"Dropped superseded indexes {dropped} of \"{Database.FIELD_ACTION_HISTORY_COLLECTION}\"")
+
+        return converted
@@ -1,12 +1,31 @@
+from utils.custom_logger import CustomLogger
+
+import os
+
 from bson import ObjectId
 
 from services.database import Database
+from services.sensor_storage import SensorStorage
 
 from models.request import UserInfoRequest
 from models.mongo_doc import EnvironmentSensorDocument, ServicesStatusDocument, UserDocument
 from gridfs import GridOut
+from starlette.datastructures import Headers, UploadFile
+from starlette.formparsers import MultiPartException, MultiPartParser
 
 class UserService:
+    AVATAR_MAX_SIZE = int(os.getenv("AVATAR_MAX_SIZE", 5 * 1024 * 1024))  # bytes
+    AVATAR_CHUNK_SIZE = 255 * 1024  # bytes, the GridFS default chunk size
+    AVATAR_FORM_OVERHEAD = 16 * 1024  # bytes, multipart boundaries and part headers around the file
+
+    # Leading bytes of the accepted avatar formats (WebP is checked apart)
+    AVATAR_SIGNATURES = [
+        (b"\x89PNG\r\n\x1a\n", "image/png"),
+        (b"\xff\xd8\xff", "image/jpeg"),
+        (b"GIF87a", "image/gif"),
+        (b"GIF89a", "image/gif"),
+    ]
+
     def _get_object_id(self, uid: str = None) -> ObjectId:
         '''
             Convert a user id string into an ObjectId for querying the database.
@@ -30,13 +49,16 @@ class UserService:
 
         return init_user_data
     
-    def _check_user_exist(self, uid: str = None) -> bool:
+    async def _check_user_exist(self, uid: str = None) -> bool:
         '''
             Check if a user exists in the database by user id string.
         '''
-        return Database()._instance.get_user_collection().find_one({'_id': self._get_object_id(uid)})
+        return await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
+            {'_id': self._get_object_id(uid)}
+        )
 
-    def _get_user_info(self, uid: str = None) -> dict:
+    async def _get_user_info(self, uid: str = None) -> dict:
         '''
             Get user info from the database by user id string.
 
@@ -46,7 +68,10 @@ class UserService:
             Returns:
                 dict: A dictionary containing the user's basic info.
         '''
-        user = Database()._instance.get_user_collection().find_one({'_id': self._get_object_id(uid)})
+        user = await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
+            {'_id': self._get_object_id(uid)}
+        )
 
         if not user:
             raise Exception("User not found")
@@ -58,7 +83,7 @@ class UserService:
 
         return data
     
-    def _update_user_info(self, uid: str = None, user_info_request: UserInfoRequest = None):
+    async def _update_user_info(self, uid: str = None, user_info_request: UserInfoRequest = None):
         '''
             Update user info in the database by user id string and UserInfoRequest object.
         '''
@@ -67,27 +92,41 @@ class UserService:
         if update_data == {}:
             raise Exception("No data to update")
         
-        result = Database()._instance.get_user_collection().update_one(
+        result = await Database()._instance.run(
+            Database()._instance.get_user_collection().update_one,
             {'_id': self._get_object_id(uid)},
             {'$set': update_data}
         )
         if result.modified_count == 0:
             raise Exception("No user info updated")
 
-    def _get_user_info_by_session_token(self, session_token: str = None):
+    async def _get_user_info_by_session_token(self, session_token: str = None):
         '''
             Get user info from the database by current user's session, included '_id' field.
         '''
         if not session_token:
             return None
         
-        user = Database()._instance.get_user_collection().find_one({'session_token': session_token})
+        user = await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
+            {'session_token': session_token}
+        )
         return user
 
-    def _delete_user_account(self, uid: str = None):
+    async def _delete_user_account(self, uid: str = None):
         '''
             Delete all user info from the database by user id string. 
         '''
+        await Database()._instance.run(self.__delete_user_documents, uid)
+
+        if SensorStorage()._is_timeseries():
+            # Time-series collections can not be written inside a transaction
+            await Database()._instance.run(
+                SensorStorage()._get_collection().delete_many,
+                { SensorStorage()._field(EnvironmentSensorDocument.FIELD_UID): uid }
+            )
+
+    def __delete_user_documents(self, uid: str = None):
         session = Database()._instance.client.start_session()
         try:
             with session.start_transaction():
@@ -109,11 +148,12 @@ class UserService:
         finally:
             session.end_session()
 
-    def _get_avatar(self, uid: str = None) -> GridOut:
+    async def _get_avatar(self, uid: str = None) -> GridOut:
         '''
             Get user avatar from the database by user id string.
         '''
-        user = Database()._instance.get_user_collection().find_one(
+        user = await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
             { '_id': self._get_object_id(uid) }
         )
         if not user:
@@ -122,54 +162,159 @@ class UserService:
         if not user[UserDocument.FIELD_AVATAR.value] or user[UserDocument.FIELD_AVATAR.value] == "":
             raise Exception("No avatar found")
         
-        file = Database()._instance.fs.get(ObjectId(user[UserDocument.FIELD_AVATAR.value]))
+        file = await Database()._instance.run(
+            Database()._instance.fs.get,
+            ObjectId(user[UserDocument.FIELD_AVATAR.value])
+        )
 
         if not file:
             raise Exception("Can not get file")
         
         return file
 
+    def __sniff_content_type(self, head: bytes):
+        '''
+            Image type of an upload from its leading bytes, None if it is not an accepted format.
+        '''
+        for signature, content_type in self.AVATAR_SIGNATURES:
+            if head.startswith(signature):
+                return content_type
+        if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+            return "image/webp"
+        return None
+
+    async def _read_avatar_upload(self, headers: Headers, stream) -> UploadFile:
+        '''
+            Parse the multipart body of an avatar upload from the request stream, its "file" part.
+
+            At most AVATAR_MAX_SIZE plus the form overhead is read from the client: a larger
+            Content-Length is refused before reading, a larger body without one once it goes past.
+
+            Raises:
+                Exception: "Avatar too large", or "Invalid avatar form" if the body is not a multipart
+                    form with one "file" part.
+        '''
+        limit = self.AVATAR_MAX_SIZE + self.AVATAR_FORM_OVERHEAD
+        content_length = headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > limit:
+            raise Exception("Avatar too large")
+
+        if not headers.get("content-type", "").startswith("multipart/form-data"):
+            raise Exception("Invalid avatar form")
+
+        async def capped_stream():
+            received = 0
+            async for chunk in stream:
+                received += len(chunk)
+                if received > limit:
+                    raise Exception("Avatar too large")
+                yield chunk
+
+        try:
+            form = await MultiPartParser(headers, capped_stream(), max_files=1, max_fields=1).parse()
+        except (MultiPartException, KeyError) as e:
+            # KeyError: no boundary in the Content-Type
+            raise Exception("Invalid avatar form") from e
+
+        file = form.get("file")
+        if not isinstance(file, UploadFile):
+            await form.close()
+            raise Exception("Invalid avatar form")
+        return file
+
     async def _update_avatar(self, uid: str = None, file: any = None) -> dict:
         '''
             Update user avatar in the database by user id string and avatar file.
+
+            The upload is streamed into GridFS chunk by chunk, each GridFS call runs off the event loop.
+            The user's avatar is switched to the new file only once it is fully written, the previous
+            file is deleted after that.
+
+            Raises:
+                Exception: "Avatar too large" past AVATAR_MAX_SIZE bytes, "Unsupported avatar type" if
+                    the content is not a PNG, JPEG, GIF or WebP image.
         '''
-        user = Database()._instance.get_user_collection().find_one(
-            { '_id': self._get_object_id(uid) }
+        user_id = self._get_object_id(uid)
+        user = await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
+            { '_id': user_id },
+            { UserDocument.FIELD_AVATAR.value: 1 }
         )
 
         if not user:
             raise Exception("User not find")
-        
-        if user[UserDocument.FIELD_AVATAR.value] and user[UserDocument.FIELD_AVATAR.value] != "":
-            Database()._instance.fs.delete(ObjectId(user[UserDocument.FIELD_AVATAR.value]))
 
-        contents = await file.read()
-        file_id = Database()._instance.fs.put(
-            contents,
+        if file.size is not None and file.size > self.AVATAR_MAX_SIZE:
+            raise Exception("Avatar too large")
+
+        chunk = await file.read(self.AVATAR_CHUNK_SIZE)
+        content_type = self.__sniff_content_type(chunk)
+        if content_type is None:
+            raise Exception("Unsupported avatar type")
+
+        grid_in = await Database()._instance.run(
+            Database()._instance.fs.new_file,
             filename=file.filename,
-            content_type=file.content_type
+            content_type=content_type,
+            chunk_size=self.AVATAR_CHUNK_SIZE
         )
+        size = 0
+        try:
+            while chunk:
+                size += len(chunk)
+                if size > self.AVATAR_MAX_SIZE:
+                    raise Exception("Avatar too large")
 
-        Database()._instance.get_user_collection().update_one(
-            { '_id': self._get_object_id(uid) },
-            { ' $set': 
-                { 'avatar': file_id }
-            }
-        )
+                await Database()._instance.run(grid_in.write, chunk)
+                chunk = await file.read(self.AVATAR_CHUNK_SIZE)
+
+            await Database()._instance.run(grid_in.close)
+
+        except BaseException:
+            # Drop the chunks written so far, the current avatar stays
+            await Database()._instance.run(grid_in.abort)
+            raise
+
+        file_id = grid_in._id
+        try:
+            previous = await Database()._instance.run(
+                Database()._instance.get_user_collection().find_one_and_update,
+                { '_id': user_id },
+                { '$set':
+                    { UserDocument.FIELD_AVATAR.value: file_id }
+                },
+                projection={ UserDocument.FIELD_AVATAR.value: 1 }
+            )
+        except Exception:
+            await Database()._instance.run(Database()._instance.fs.delete, file_id)
+            raise
+
+        if not previous:
+            await Database()._instance.run(Database()._instance.fs.delete, file_id)
+            raise Exception("User not find")
+
+        if previous.get(UserDocument.FIELD_AVATAR.value):
+            try:
+                await Database()._instance.run(
+                    Database()._instance.fs.delete,
+                    ObjectId(previous[UserDocument.FIELD_AVATAR.value])
+                )
+            except Exception as e:
+                CustomLogger()._get_logger().warning(f"Previous avatar not deleted: {{ userId: \"{uid}\" }} {e}")
 
         return {
             "file_id": str(file_id),
             "file_name": file.filename,
-            "file_type": file.content_type,
-            "file_size": len(contents)
+            "file_type": content_type,
+            "file_size": size
         }
-    
 
-    def _delete_avatar(self, uid: str = None):
+    async def _delete_avatar(self, uid: str = None):
         '''
             Delete user avatar from the database by user id string.
         '''
-        user = Database()._instance.get_user_collection().find_one(
+        user = await Database()._instance.run(
+            Database()._instance.get_user_collection().find_one,
             { '_id': self._get_object_id(uid) }
         )
 
@@ -179,9 +324,13 @@ class UserService:
         if not user[UserDocument.FIELD_AVATAR.value] or user[UserDocument.FIELD_AVATAR.value] == "":
             raise Exception("No avatar found")
         
-        Database()._instance.fs.delete(ObjectId(user[UserDocument.FIELD_AVATAR.value]))
+        await Database()._instance.run(
+            Database()._instance.fs.delete,
+            ObjectId(user[UserDocument.FIELD_AVATAR.value])
+        )
 
-        Database()._instance.get_user_collection().update_one(
+        await Database()._instance.run(
+            Database()._instance.get_user_collection().update_one,
             { '_id': self._get_object_id(uid) },
             { '$set': 
                 { 'avatar': "" }
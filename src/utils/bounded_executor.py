@@ -0,0 +1,115 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+class BoundedExecutor:
+    '''
+        Thread pool that runs blocking calls off the event loop.
+
+        At most `max_workers` calls run at once and at most `max_queue` more wait for a
+        worker; further callers wait on the event loop (or are rejected after `queue_timeout`
+        seconds) instead of piling up inside the pool.
+    '''
+    def __init__(self, name: str, max_workers: int, max_queue: int, queue_timeout: float = None):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._slots = asyncio.Semaphore(max_workers + max_queue)
+
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "in_flight": 0,
+            "wait_ms_total": 0.0,
+            "wait_ms_max": 0.0,
+            "run_ms_total": 0.0,
+        }
+
+    async def run(self, fn, *args, **kwargs):
+        '''
+            Run `fn(*args, **kwargs)` in the pool and return its result.
+
+            Raises:
+                Exception: "Server busy" if no slot frees up within `queue_timeout`.
+        '''
+        submitted_at = time.perf_counter()
+        self._stats["submitted"] += 1
+
+        if self.queue_timeout is None:
+            await self._slots.acquire()
+        else:
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self._stats["rejected"] += 1
+                raise Exception("Server busy")
+
+        loop = asyncio.get_running_loop()
+        timing = {}
+        def call():
+            timing["started"] = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timing["finished"] = time.perf_counter()
+
+        try:
+            future = self._executor.submit(call)
+        except Exception:
+            self._stats["failed"] += 1
+            self._slots.release()
+            raise
+
+        # The slot is freed when the call ends: a cancelled caller stops waiting, not the thread
+        self._stats["in_flight"] += 1
+        def on_done(future):
+            try:
+                loop.call_soon_threadsafe(self.__finish, future, submitted_at, timing)
+            except RuntimeError:
+                pass  # Event loop already closed
+        future.add_done_callback(on_done)
+
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def __finish(self, future, submitted_at: float, timing: dict):
+        self._stats["in_flight"] -= 1
+        self._slots.release()
+
+        if future.cancelled():
+            # Never started
+            self._stats["cancelled"] += 1
+            return
+        if future.exception() is None:
+            self._stats["completed"] += 1
+        else:
+            self._stats["failed"] += 1
+
+        finished_at = timing.get("finished", time.perf_counter())
+        started_at = timing.get("started", finished_at)
+        wait_ms = (started_at - submitted_at) * 1000
+        self._stats["wait_ms_total"] += wait_ms
+        self._stats["wait_ms_max"] = max(self._stats["wait_ms_max"], wait_ms)
+        self._stats["run_ms_total"] += (finished_at - started_at) * 1000
+
+    def stats(self) -> dict:
+        '''
+            Snapshot of the pool counters, with average wait and run time per finished call.
+        '''
+        finished = self._stats["completed"] + self._stats["failed"]
+        return {
+            "name": self.name,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            **self._stats,
+            "wait_ms_avg": self._stats["wait_ms_total"] / finished if finished else 0.0,
+            "run_ms_avg": self._stats["run_ms_total"] / finished if finished else 0.0,
+        }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
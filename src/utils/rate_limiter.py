@@ -0,0 +1,46 @@
+from typing import NamedTuple
+
+RATE_LIMIT_ATTRIBUTE = "__rate_limit__"
+
+PERIODS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+}
+
+class RateLimit(NamedTuple):
+    count: int
+    period: float  # seconds
+
+    def __str__(self):
+        return f"{self.count} per {self.period:g} seconds"
+
+def parse_rate_limit(limit: str) -> RateLimit:
+    '''
+        Parse "20/minute" or "100/5 minutes" into a RateLimit.
+    '''
+    try:
+        count, period = limit.split("/")
+        parts = period.strip().split()
+        amount = float(parts[0]) if len(parts) == 2 else 1
+        unit = parts[-1].lower().rstrip("s")
+        return RateLimit(int(count), amount * PERIODS[unit])
+    except (ValueError, KeyError, IndexError):
+        raise ValueError(f"Invalid rate limit \"{limit}\"")
+
+def rate_limit(limit: str):
+    '''
+        Declare the rate limit of an endpoint, e.g. `@rate_limit("20/minute")` under the route decorator.
+        It is enforced by PipelineMiddleware, per user for authenticated routes and per client IP otherwise.
+    '''
+    parsed = parse_rate_limit(limit)
+
+    def decorator(endpoint):
+        setattr(endpoint, RATE_LIMIT_ATTRIBUTE, parsed)
+        return endpoint
+
+    return decorator
+
+def get_rate_limit(endpoint) -> RateLimit:
+    return getattr(endpoint, RATE_LIMIT_ATTRIBUTE, None)
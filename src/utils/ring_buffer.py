@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import deque
+
+class RingBuffer:
+    '''
+        Bounded log of items read by any number of asyncio consumers, each at its own cursor.
+
+        Every item gets the next sequence number; a consumer reads the first item after the
+        sequence number it last read, items are not removed by reading. Once `max_size` items are
+        kept, a new item either drops the oldest one ("drop_oldest"), or with "coalesce" first
+        replaces the kept item with the same key, if any. Consumers lagging behind a dropped item
+        skip it.
+
+        A `volatile` item is superseded by the next one anyway: the oldest volatile item is dropped
+        first to make room, and a volatile item is not kept if every kept item is non-volatile.
+
+        `last_activity` is the monotonic time of the last put or read, for idle eviction.
+        `wake` lets waiting consumers return early without an item, e.g. to send a keep-alive.
+    '''
+    POLICY_DROP_OLDEST = "drop_oldest"
+    POLICY_COALESCE = "coalesce"
+
+    PUT_OK = "ok"
+    PUT_DROPPED = "dropped"      # the oldest item was dropped to make room
+    PUT_COALESCED = "coalesced"  # an item with the same key was replaced
+
+    def __init__(self, max_size: int, policy: str = POLICY_DROP_OLDEST):
+        if policy not in (self.POLICY_DROP_OLDEST, self.POLICY_COALESCE):
+            raise ValueError(f"Invalid overflow policy \"{policy}\"")
+
+        self.max_size = max_size
+        self.policy = policy
+        self.last_activity = time.monotonic()
+        self.last_seq = 0
+        self.wakeups = 0
+
+        self._items: deque = deque()  # (seq, key, item, volatile), by increasing seq
+        self._changed = asyncio.Event()
+
+    def put(self, item, key=None, volatile: bool = False) -> str:
+        self.last_activity = time.monotonic()
+
+        result = self.PUT_OK
+        if self.policy == self.POLICY_COALESCE and key is not None:
+            for index, (_, buffered_key, _, _) in enumerate(self._items):
+                if buffered_key == key:
+                    del self._items[index]
+                    result = self.PUT_COALESCED
+                    break
+
+        if len(self._items) >= self.max_size:
+            index = next((index for index, entry in enumerate(self._items) if entry[3]), None)
+            if index is not None:
+                del self._items[index]
+            elif volatile:
+                return self.PUT_DROPPED
+            else:
+                self._items.popleft()
+            result = self.PUT_DROPPED
+
+        self.last_seq += 1
+        self._items.append((self.last_seq, key, item, volatile))
+        self.__notify()
+        return result
+
+    def wake(self):
+        self.wakeups += 1
+        self.__notify()
+
+    def __notify(self):
+        # A fresh event per change, so one consumer never consumes another one's wakeup
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def __find_after(self, cursor: int):
+        if not self._items or self._items[-1][0] <= cursor:
+            return None
+        if self._items[0][0] > cursor:
+            return self._items[0]
+
+        # Consumers usually trail the newest items, search from the end
+        index = len(self._items) - 1
+        while self._items[index - 1][0] > cursor:
+            index -= 1
+        return self._items[index]
+
+    async def read(self, cursor: int, timeout: float = None, wakeups_seen: int = None):
+        '''
+            The first item after sequence number `cursor`, as (seq, item). Returns None instead if
+            there is none and the buffer was woken up since the consumer saw `wakeups_seen`.
+
+            Raises:
+                asyncio.TimeoutError: If no item arrives within `timeout` seconds.
+        '''
+        while True:
+            entry = self.__find_after(cursor)
+            if entry is not None:
+                self.last_activity = time.monotonic()
+                return entry[0], entry[2]
+
+            if wakeups_seen is not None and wakeups_seen != self.wakeups:
+                return None
+            await asyncio.wait_for(self._changed.wait(), timeout)
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,107 @@
+from typing import Iterable
+
+class _Node:
+    __slots__ = ("static", "param", "tail", "end", "value")
+
+    def __init__(self):
+        self.static: dict = {}      # segment -> _Node
+        self.param: _Node = None    # "{name}" segment, matches any non-empty segment
+        self.tail = False           # "{name:path}" segment, matches the rest of the path
+        self.end = False
+        self.value = None           # set by `add`, e.g. the routes of the path per method
+
+class RouteMatcher:
+    '''
+        Prefix trie over the "/"-separated segments of route paths, e.g. "/iot/ws/{device_id}".
+        A lookup walks the path once, static segments are preferred over parameter segments.
+
+        Paths are matched exactly, a trailing slash is a segment of its own. Each path may carry a
+        value, returned by `get`.
+    '''
+    def __init__(self, paths: Iterable[str] = ()):
+        self._root = _Node()
+        self._size = 0
+        for path in paths:
+            self.add(path)
+
+    @classmethod
+    def from_routes(cls, routes: Iterable, extra_paths: Iterable[str] = ()) -> "RouteMatcher":
+        '''
+            Build the matcher from a Starlette route table (`app.routes`). The value of a path is a
+            dict of its routes per HTTP method (None for WebSocket routes).
+        '''
+        matcher = cls(extra_paths)
+        for route in routes:
+            path = getattr(route, "path", None)
+            if path:
+                routes_by_method = matcher.add(path, {})
+                for method in getattr(route, "methods", None) or [None]:
+                    routes_by_method.setdefault(method, route)
+        return matcher
+
+    def add(self, path: str, value=None):
+        '''
+            Add a path, keeping the value of an already added path if it has one.
+
+            Returns:
+                The value stored for the path.
+        '''
+        node = self._root
+        for segment in path.split("/")[1:]:
+            if segment.startswith("{") and segment.endswith("}"):
+                if segment.endswith(":path}"):
+                    self._size += not node.tail
+                    node.tail = True
+                    break
+                if node.param is None:
+                    node.param = _Node()
+                node = node.param
+            else:
+                node = node.static.setdefault(segment, _Node())
+        else:
+            self._size += not node.end
+            node.end = True
+
+        if node.value is None:
+            node.value = value
+        return node.value
+
+    def match(self, path: str) -> bool:
+        return self.__find(path) is not None
+
+    def get(self, path: str, default=None):
+        node = self.__find(path)
+        if node is None or node.value is None:
+            return default
+        return node.value
+
+    def __find(self, path: str) -> _Node:
+        if not path.startswith("/"):
+            return None
+        return self.__match(self._root, path.split("/"), 1)
+
+    def __match(self, node: _Node, segments: list, index: int) -> _Node:
+        while True:
+            if node.tail:
+                return node
+            if index == len(segments):
+                return node if node.end else None
+
+            segment = segments[index]
+            child = node.static.get(segment)
+            if child is None:
+                if node.param is None or not segment:
+                    return None
+                node = node.param
+            elif node.param is not None and segment:
+                # Both a static and a parameter segment fit, backtrack only when needed
+                return self.__match(child, segments, index + 1) or self.__match(node.param, segments, index + 1)
+            else:
+                node = child
+            index += 1
+
+    def __contains__(self, path: str) -> bool:
+        return self.match(path)
+
+    def __len__(self):
+        return self._size
@@ -0,0 +1,55 @@
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    '''
+        Bounded LRU mapping whose entries expire `ttl` seconds after being set (or earlier, per entry).
+        The least recently used entry is evicted once `max_size` entries are stored.
+    '''
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # key -> (value, expires_at)
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+        }
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return default
+
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self._stats["misses"] += 1
+            return default
+
+        self._data.move_to_end(key)
+        self._stats["hits"] += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def delete(self, key) -> bool:
+        return self._data.pop(key, None) is not None
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {**self._stats, "size": len(self._data), "max_size": self.max_size}
@@ -0,0 +1,97 @@
+'''
+Benchmark device handshakes and commands at increasing load: handshakes serialized process-wide
+(as under the former IOTService global lock) against IOTService's concurrent handshakes.
+
+Usage:
+    python test/bench_device_connect.py [max_devices] [handshake_ms]
+
+Every simulated device takes `handshake_ms` to accept its WebSocket and answers commands at once.
+The message bus runs in process and the database write of a command is skipped, so only the
+connection and command routing work is measured.
+'''
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+MAX_DEVICES = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+HANDSHAKE = (float(sys.argv[2]) if len(sys.argv) > 2 else 5.0) / 1000
+os.environ["MESSAGE_BUS_MODE"] = "local"
+os.environ.setdefault("MONGODB_EXECUTOR_QUEUE", str(MAX_DEVICES))
+
+from utils.custom_logger import CustomLogger
+from services.iot_service import IOTService
+
+class BenchDeviceSocket:
+    '''Device WebSocket with a handshake latency, answering every command with success.'''
+    def __init__(self, device_id: str, handshake_lock: asyncio.Lock = None):
+        self.device_id = device_id
+        self.handshake_lock = handshake_lock
+        self.frames = asyncio.Queue()
+
+    async def accept(self):
+        if self.handshake_lock is None:
+            await asyncio.sleep(HANDSHAKE)
+            return
+        async with self.handshake_lock:
+            await asyncio.sleep(HANDSHAKE)
+
+    async def receive_json(self):
+        return await self.frames.get()
+
+    async def send_json(self, data):
+        if "command_id" in data:
+            self.frames.put_nowait({"device_id": self.device_id, "command_id": data["command_id"], "status": "success", "message": "ok"})
+
+    async def close(self, code=None, reason=None):
+        pass
+
+async def skip_record(uid: str, changes: list):
+    # Service changes are not handed to the ServiceChangeWriter
+    pass
+
+async def skip_twin_load(device_id: str):
+    # Twins are not loaded from the database
+    pass
+
+async def measure(name: str, devices: int, serialized: bool):
+    service = object.__new__(IOTService)
+    service._init_instance()
+    service._record_service_changes = skip_record
+    service._IOTService__load_twin = skip_twin_load
+
+    handshake_lock = asyncio.Lock() if serialized else None
+    sockets = [BenchDeviceSocket(f"bench-{i}", handshake_lock) for i in range(devices)]
+
+    start = time.perf_counter()
+    connections = [asyncio.create_task(service._establish_connection(socket.device_id, socket)) for socket in sockets]
+    while len(service.connected_iot_systems) < devices:
+        await asyncio.sleep(0.001)
+    connect_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(service._control_iot_system(socket.device_id, "headlight_service", "on") for socket in sockets))
+    command_elapsed = time.perf_counter() - start
+
+    for connection in connections:
+        connection.cancel()
+    await asyncio.gather(*connections, return_exceptions=True)
+
+    print(f"{name:12} {devices:6} devices | {devices / connect_elapsed:9.1f} handshakes/s | {devices / command_elapsed:9.1f} commands/s")
+
+async def main():
+    CustomLogger()._get_logger().setLevel(logging.ERROR)
+
+    loads = [load for load in (100, 1_000, 10_000) if load < MAX_DEVICES] + [MAX_DEVICES]
+    print(f"handshake latency {HANDSHAKE * 1000:.1f} ms")
+    for devices in loads:
+        # Serialized handshakes flatten at 1 / latency, no need to wait for the largest loads
+        if devices <= 1_000:
+            await measure("serialized", devices, serialized=True)
+        await measure("concurrent", devices, serialized=False)
+
+if __name__ == '__main__':
+    asyncio.run(main())
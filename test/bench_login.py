@@ -0,0 +1,63 @@
+'''
+Benchmark password verification under concurrent logins: bcrypt on the event loop against
+AuthService's bounded password pool. Also reports the worst event loop stall seen by a 10 ms
+ticker, i.e. how long device connections would have been frozen.
+
+Usage:
+    python test/bench_login.py [concurrent_logins] [rounds]
+
+Only the password check is measured, no MongoDB or Redis round trip is made.
+'''
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+os.environ.setdefault("BCRYPT_ROUNDS", sys.argv[2] if len(sys.argv) > 2 else "12")
+os.environ.setdefault("BCRYPT_QUEUE", str(CONCURRENCY))
+os.environ.setdefault("BCRYPT_QUEUE_TIMEOUT", "60")
+
+from passlib.context import CryptContext
+
+from services.auth_service import AuthService
+
+PASSWORD = "bench-password"
+
+async def ticker(stop: asyncio.Event, stalls: list):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.01)
+        stalls.append((time.perf_counter() - start) * 1000 - 10)
+
+async def measure(name: str, verify, hashed_pw: str):
+    stop = asyncio.Event()
+    stalls = []
+    tick = asyncio.create_task(ticker(stop, stalls))
+    await asyncio.sleep(0.05)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(verify(hashed_pw, PASSWORD) for _ in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await tick
+    assert all(results)
+    print(f"{name:20} {CONCURRENCY / elapsed:7.1f} logins/s | total {elapsed * 1000:8.1f} ms | max loop stall {max(stalls):8.1f} ms")
+
+async def main():
+    context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=int(os.environ["BCRYPT_ROUNDS"]))
+    hashed_pw = context.hash(PASSWORD)
+
+    async def on_event_loop(hashed_pw: str, password: str) -> bool:
+        return context.verify(password, hashed_pw)
+
+    print(f"{CONCURRENCY} concurrent logins, cost {os.environ['BCRYPT_ROUNDS']}, {os.cpu_count()} CPUs")
+    await measure("on event loop", on_event_loop, hashed_pw)
+    await measure("password pool", AuthService()._verify_pw, hashed_pw)
+    print(f"pool stats: {AuthService()._get_password_executor_stats()}")
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+'''
+Benchmark the per-request middleware overhead: the former BaseHTTPMiddleware stack
+(logger, not found, security headers, auth, CORSMiddleware) against PipelineMiddleware.
+
+Usage:
+    python test/bench_middleware.py [requests]
+
+Requests are driven straight through the ASGI interface, sessions are validated by an in-memory
+stand-in so only the middleware work is measured.
+'''
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from utils.custom_logger import CustomLogger
+
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response
+
+from middlewares.pipeline_middleware import PipelineMiddleware
+
+from conftest import FakeAuthService
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+SESSIONS = {"bench-token": "bench-user"}
+ROUTES = {"/", "/auth/login", "/app/services_status"}
+
+# Replica of the former middleware stack
+class LegacyAuthMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app):
+        super().__init__(app)
+        self.whitelist = ["/auth/register", "/auth/login", "/auth/refresh"]
+        self.auth_service = FakeAuthService(SESSIONS)
+
+    async def dispatch(self, request: Request, call_next):
+        if request.url.path in self.whitelist:
+            return await call_next(request)
+        session_token = request.cookies.get("session_token")
+        if not session_token:
+            return JSONResponse(content={"message": "Unauthorized", "detail": "Missing session token"}, status_code=401)
+        user_id = await self.auth_service._validate_session(session_token)
+        if not user_id:
+            return JSONResponse(content={"message": "Unauthorized", "detail": "Invalid or expired session token"}, status_code=401)
+        request.state.user_id = str(user_id)
+        return await call_next(request)
+
+class LegacySecurityHeadersMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        cors_headers = {
+            "Access-Control-Allow-Origin": os.getenv("ALLOWED_ORIGINS", "*"),
+            "Access-Control-Allow-Credentials": "true",
+            "Access-Control-Allow-Methods": "GET, POST, PUT, PATCH, DELETE, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type, Authorization, X-Requested-With, Accept",
+            "Access-Control-Expose-Headers": "Set-Cookie"
+        }
+        if request.method == "OPTIONS":
+            return Response(status_code=204, headers=cors_headers)
+        response = await call_next(request)
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers["Content-Security-Policy"] = "default-src 'self'"
+        for k, v in cors_headers.items():
+            response.headers[k] = v
+        return response
+
+class LegacyNotFoundMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, routes):
+        super().__init__(app)
+        self.routes = routes
+
+    async def dispatch(self, request, call_next):
+        if request.url.path not in self.routes:
+            return JSONResponse(content={"message": "Not Found", "detail": "The requested resource was not found."}, status_code=404)
+        return await call_next(request)
+
+class LegacyLoggerMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        start_time = time.time()
+        response = await call_next(request)
+        process_time = (time.time() - start_time) * 1000
+        CustomLogger()._get_logger().info(f"{response.status_code} | {request.method} {request.url.path} +{int(process_time)}ms")
+        return response
+
+def build_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/app/services_status")
+    async def services_status(request: Request):
+        return {"uid": request.state.user_id, "system": "on"}
+
+    @app.post("/auth/login")
+    async def login():
+        return {"message": "Login successful"}
+
+    return app
+
+def legacy_app() -> FastAPI:
+    app = build_app()
+    app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+    app.add_middleware(LegacyAuthMiddleware)
+    app.add_middleware(LegacySecurityHeadersMiddleware)
+    app.add_middleware(LegacyNotFoundMiddleware, routes=list(ROUTES))
+    app.add_middleware(LegacyLoggerMiddleware)
+    return app
+
+def pipeline_app() -> FastAPI:
+    app = build_app()
+    app.add_middleware(PipelineMiddleware, routes=ROUTES, auth_service=FakeAuthService(SESSIONS))
+    return app
+
+def make_scope(method: str, path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [
+            (b"host", b"localhost"),
+            (b"origin", b"http://localhost:3000"),
+            (b"cookie", b"session_token=bench-token"),
+        ],
+        "client": ("127.0.0.1", 50000),
+        "server": ("localhost", 12798),
+    }
+
+async def call(app, method: str, path: str) -> int:
+    status = None
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(make_scope(method, path), receive, send)
+    return status
+
+async def measure(name: str, app):
+    requests = [("GET", "/app/services_status"), ("POST", "/auth/login"), ("GET", "/unknown")]
+
+    # Warm up (route compilation, lazily built middleware stack)
+    for method, path in requests:
+        await call(app, method, path)
+
+    timings = []
+    for i in range(REQUESTS):
+        method, path = requests[i % len(requests)]
+        start = time.perf_counter()
+        await call(app, method, path)
+        timings.append((time.perf_counter() - start) * 1_000_000)
+
+    timings.sort()
+    print(f"{name:20} avg {sum(timings) / len(timings):8.1f} us | p50 {timings[len(timings) // 2]:8.1f} us | p95 {timings[int(len(timings) * 0.95)]:8.1f} us")
+
+async def main():
+    CustomLogger()._get_logger().setLevel(logging.ERROR)
+
+    await measure("BaseHTTPMiddleware", legacy_app())
+    await measure("PipelineMiddleware", pipeline_app())
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,67 @@
+'''
+Benchmark the known-path check of PipelineMiddleware: the former linear scan over a list of
+route paths against the RouteMatcher trie.
+
+Usage:
+    python test/bench_route_matcher.py [routes] [lookups]
+'''
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from utils.route_matcher import RouteMatcher
+
+ROUTES = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+LOOKUPS = int(sys.argv[2]) if len(sys.argv) > 2 else 200_000
+
+def build_routes() -> list:
+    routes = ["/", "/iot/ws/{device_id}"]
+    for i in range(ROUTES - len(routes)):
+        prefix = random.choice(["/auth", "/user", "/iot", "/app"])
+        if i % 4 == 0:
+            routes.append(f"{prefix}/resource_{i}/{{item_id}}")
+        else:
+            routes.append(f"{prefix}/resource_{i}")
+    return routes
+
+def build_paths(routes: list) -> list:
+    paths = []
+    for _ in range(LOOKUPS):
+        route = random.choice(routes)
+        kind = random.random()
+        if kind < 0.1:
+            paths.append(f"/unknown/{random.randint(0, 1000)}")
+        else:
+            paths.append(route.replace("{item_id}", str(random.randint(0, 1000))).replace("{device_id}", "device-1"))
+    return paths
+
+def measure(name: str, contains, paths: list) -> list:
+    start = time.perf_counter()
+    results = [contains(path) for path in paths]
+    elapsed = time.perf_counter() - start
+    print(f"{name:20} {elapsed * 1_000_000_000 / len(paths):8.1f} ns/lookup | {sum(results)} of {len(paths)} known")
+    return results
+
+def main():
+    random.seed(42)
+    routes = build_routes()
+    paths = build_paths(routes)
+
+    route_list = list(routes)
+    matcher = RouteMatcher(routes)
+
+    print(f"{len(routes)} routes, {len(paths)} lookups")
+    scanned = measure("list scan", lambda path: path in route_list, paths)
+    matched = measure("route matcher", matcher.match, paths)
+
+    # The list scan can only see static paths, the matcher must agree with it there
+    static = [path for path in paths if "{" not in path and path in route_list]
+    assert all(matcher.match(path) for path in static)
+    assert matcher.match("/iot/ws/device-1") and not matcher.match("/iot/ws/") and not matcher.match("/iot/ws/a/b")
+    print(f"parameterized paths only seen by the matcher: {sum(matched) - sum(scanned)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+Benchmark the newest-reading lookup: one find_one per sensor type against the single aggregation.
+
+Usage:
+    MONGODB_URL=... python test/bench_sensor_data.py [readings] [rounds]
+
+Runs against the BENCH_DB_NAME database (default "sdas_bench") and seeds it with `readings`
+documents (default 2,000,000) spread over 100 users on the first run.
+'''
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ["MONGODB_DB_NAME"] = os.getenv("BENCH_DB_NAME", "sdas_bench")
+
+from services.database import Database
+from services.app_service import AppService
+from models.request import SensorDataRequest
+from models.common import SensorTypes
+
+READINGS = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+USERS = [f"bench-user-{i}" for i in range(100)]
+SENSOR_TYPES = [sensor_type.value for sensor_type in SensorTypes]
+
+def seed():
+    collection = Database()._instance.get_env_sensor_collection()
+    collection.create_index([("uid", 1), ("sensor_type", 1), ("timestamp", -1)])
+
+    existing = collection.estimated_document_count()
+    if existing >= READINGS:
+        print(f"Using {existing} existing readings")
+        return
+
+    print(f"Seeding {READINGS - existing} readings...")
+    start = datetime.now() - timedelta(days=30)
+    batch = []
+    for i in range(existing, READINGS):
+        batch.append({
+            "uid": random.choice(USERS),
+            "sensor_type": random.choice(SENSOR_TYPES),
+            "value": round(random.uniform(0, 100), 2),
+            "timestamp": (start + timedelta(seconds=i)).isoformat()
+        })
+        if len(batch) == 10_000:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+async def loop_per_type(uid: str):
+    return [await AppService()._get_newest_sensor_data(uid, sensor_type) for sensor_type in SENSOR_TYPES]
+
+async def single_aggregation(uid: str):
+    return await AppService()._get_sensors_data(uid, SensorDataRequest(sensor_types=SENSOR_TYPES))
+
+async def measure(name: str, fn):
+    timings = []
+    for _ in range(ROUNDS):
+        uid = random.choice(USERS)
+        start = time.perf_counter()
+        await fn(uid)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    print(f"{name:20} avg {sum(timings) / len(timings):7.2f} ms | p50 {timings[len(timings) // 2]:7.2f} ms | p95 {timings[int(len(timings) * 0.95)]:7.2f} ms")
+
+async def main():
+    await Database()._instance.run(seed)
+    await measure("find_one per type", loop_per_type)
+    await measure("single aggregation", single_aggregation)
+
+if __name__ == '__main__':
+    asyncio.run(main())
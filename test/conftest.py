@@ -0,0 +1,353 @@
+import asyncio
+import math
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ.setdefault("MESSAGE_BUS_MODE", "local")
+
+import pytest
+from bson import ObjectId
+
+from services.database import Database
+from services.redis_client import RedisClient
+from services.message_bus import MessageBus
+from services.auth_service import AuthService
+from services.rate_limit_service import RateLimitService
+
+class FakeRedis:
+    '''
+        In-process stand-in for the Redis commands the services use, keys live in `data`. While
+        `script_gate` is set, the session script answers only once it is released, with the value
+        read when it was called.
+
+        The rate limit buckets run on `now_ms`, a clock moved by hand; `calls` counts the token
+        bucket calls. While `down`, they fail like a lost connection. While `subscribe_gate` is set,
+        SUBSCRIBE answers only once it is released.
+    '''
+    def __init__(self):
+        self.data = {}
+        self.pubsubs = []
+        self.script_gate: asyncio.Event = None
+        self.subscribe_gate: asyncio.Event = None
+        self.buckets = {}
+        self.now_ms = 0
+        self.calls = 0
+        self.down = False
+
+    def register_script(self, script):
+        if script == AuthService._AuthService__VALIDATE_SESSION_SCRIPT:
+            return self.__validate_session
+        if script == RateLimitService._RateLimitService__TOKEN_BUCKET_SCRIPT:
+            return self.__take_token
+        return None
+
+    async def __validate_session(self, keys, args):
+        uid = self.data.get(keys[0])
+        if self.script_gate is not None:
+            await self.script_gate.wait()
+        return [uid, 3600] if uid else []
+
+    async def __take_token(self, keys, args):
+        self.calls += 1
+        if self.down:
+            raise ConnectionError("connection refused")
+
+        capacity, rate = float(args[0]), float(args[1])
+        tokens, ts = self.buckets.get(keys[0], (capacity, self.now_ms))
+        tokens = min(capacity, tokens + max(0, self.now_ms - ts) * rate)
+        result = [0, math.ceil((1 - tokens) / rate)]
+        if tokens >= 1:
+            tokens -= 1
+            result = [1, 0]
+        self.buckets[keys[0]] = (tokens, self.now_ms)
+        return result
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        pubsub = FakePubSub(self)
+        self.pubsubs.append(pubsub)
+        return pubsub
+
+    async def publish(self, channel, message):
+        return self._deliver(channel, message)
+
+    def _deliver(self, channel, message) -> int:
+        receivers = [pubsub for pubsub in self.pubsubs if channel in pubsub.channels]
+        for pubsub in receivers:
+            pubsub.messages.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(receivers)
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    def setex(self, key, ttl, value):
+        self.commands.append(lambda: self.redis.data.__setitem__(key, value) or True)
+
+    def delete(self, key):
+        self.commands.append(lambda: int(self.redis.data.pop(key, None) is not None))
+
+    def publish(self, channel, message):
+        self.commands.append(lambda: self.redis._deliver(channel, message))
+
+    async def execute(self):
+        return [command() for command in self.commands]
+
+class FakePubSub:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.channels = set()
+        self.messages = asyncio.Queue()
+
+    async def subscribe(self, *channels):
+        if self.redis.subscribe_gate is not None:
+            await self.redis.subscribe_gate.wait()
+        self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+    async def get_message(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def listen(self):
+        while True:
+            yield await self.messages.get()
+
+    async def aclose(self):
+        self.redis.pubsubs.remove(self)
+
+class FakeAuthService:
+    '''Validates the session tokens of `sessions`, token -> user id.'''
+    def __init__(self, sessions: dict = None):
+        self.sessions = sessions if sessions is not None else {"token-a": "user-a", "token-b": "user-b"}
+
+    async def _validate_session(self, session_token: str):
+        return self.sessions.get(session_token)
+
+class FakeCollection:
+    '''
+        Documents found by equality on every filter field. `reads` counts the `find_one` calls,
+        `updates` records the filter of each update.
+    '''
+    def __init__(self, documents: list):
+        self.documents = documents
+        self.reads = 0
+        self.updates = []
+
+    def find_one(self, filter, projection=None):
+        self.reads += 1
+        document = self._find(filter)
+        return dict(document) if document is not None else None
+
+    def update_one(self, filter, update):
+        self.updates.append(filter)
+        document = self._find(filter)
+        if document is not None:
+            document.update(update["$set"])
+
+    def find_one_and_update(self, filter, update, projection=None):
+        self.updates.append(filter)
+        document = self._find(filter)
+        if document is None:
+            return None
+        previous = dict(document)
+        document.update(update["$set"])
+        return previous
+
+    def _find(self, filter) -> dict:
+        for document in self.documents:
+            if all(document.get(field) == value for field, value in filter.items()):
+                return document
+        return None
+
+class FakeGridIn:
+    def __init__(self, fs, **kwargs):
+        self.fs = fs
+        self._id = ObjectId()
+        self.data = b""
+
+    def write(self, chunk):
+        self.data += chunk
+
+    def close(self):
+        self.fs.files[self._id] = self.data
+
+    def abort(self):
+        self.fs.aborted.append(self._id)
+
+class FakeGridFS:
+    '''Stored files by id, `aborted` records the ids of the uploads dropped before closing.'''
+    def __init__(self):
+        self.files = {}
+        self.aborted = []
+
+    def new_file(self, **kwargs):
+        return FakeGridIn(self, **kwargs)
+
+    def delete(self, file_id):
+        self.files.pop(file_id, None)
+
+def make_explain(stage: str) -> dict:
+    # A rejected collection scan must not count against the winning plan
+    return {
+        "queryPlanner": {
+            "winningPlan": {"stage": "LIMIT", "inputStage": {"stage": "FETCH", "inputStage": {"stage": stage}}},
+            "rejectedPlans": [{"stage": "COLLSCAN"}]
+        }
+    }
+
+class FakeCursor:
+    '''No documents, explained with `stage` as the winning plan.'''
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __iter__(self):
+        return iter([])
+
+    def explain(self):
+        return make_explain(self.stage)
+
+class FakeIndexedCollection:
+    '''
+        Keeps index names only. Queries find nothing and are explained with `stage`; index creation
+        raises `error` if set.
+    '''
+    def __init__(self, index_names: list = (), stage: str = "IXSCAN", error: str = None):
+        self.index_names = set(index_names)
+        self.index_info = {}
+        self.stage = stage
+        self.error = error
+        self.finds = []
+
+    def create_indexes(self, indexes):
+        if self.error:
+            raise Exception(self.error)
+        names = [index.document["name"] for index in indexes]
+        self.index_names.update(names)
+        for index in indexes:
+            self.index_info[index.document["name"]] = {
+                "key": list(index.document["key"].items()),
+                "unique": index.document.get("unique", False)
+            }
+        return names
+
+    def index_information(self):
+        return {name: self.index_info.get(name, {}) for name in self.index_names}
+
+    def drop_index(self, name):
+        self.index_names.remove(name)
+        self.index_info.pop(name, None)
+
+    def find(self, filter=None, projection=None, sort=None, limit=0):
+        self.finds.append((filter, sort, limit))
+        return FakeCursor(self.stage)
+
+class FakeDatabase:
+    '''Stands in for `Database()._instance.db`, unknown collections are created empty.'''
+    def __init__(self, collections: dict):
+        self.collections = collections
+        self.aggregates = []
+
+    def get_collection(self, name):
+        return self.collections.setdefault(name, FakeIndexedCollection())
+
+    def list_collection_names(self, filter=None):
+        return list(self.collections)
+
+    def create_collection(self, name, **options):
+        self.collections.setdefault(name, FakeIndexedCollection())
+
+    def command(self, name, collection_name, pipeline=None, explain=False):
+        self.aggregates.append((collection_name, pipeline))
+        stage = self.get_collection(collection_name).stage
+        return {"stages": [{"$cursor": make_explain(stage)}, {"$group": {}}]}
+
+class DatabasePatch:
+    '''
+        Replaces parts of the Database singleton for one test, through `monkeypatch` so every change
+        is undone after it.
+    '''
+    def __init__(self, monkeypatch):
+        self.monkeypatch = monkeypatch
+        self.database = Database()._instance
+
+    def use_collection(self, getter: str, collection):
+        '''Answer `Database()._instance.<getter>()` with `collection`.'''
+        self.monkeypatch.setattr(self.database, getter, lambda: collection)
+        return collection
+
+    def set(self, name: str, value):
+        '''Replace an attribute of `Database()._instance`, e.g. `db`, `fs` or a method.'''
+        self.monkeypatch.setattr(self.database, name, value, raising=False)
+        return value
+
+@pytest.fixture
+def database(monkeypatch) -> DatabasePatch:
+    return DatabasePatch(monkeypatch)
+
+@pytest.fixture
+def use_db(database):
+    '''Returns a function replacing `Database()._instance.db` with a FakeDatabase of the given collections.'''
+    def use(collections: dict) -> FakeDatabase:
+        return database.set("db", FakeDatabase(collections))
+    return use
+
+@pytest.fixture
+def fake_fs(database) -> FakeGridFS:
+    return database.set("fs", FakeGridFS())
+
+@pytest.fixture
+def use_users(database):
+    '''Returns a function answering `get_user_collection()` with a FakeCollection of the given documents.'''
+    def use(documents: list) -> FakeCollection:
+        return database.use_collection("get_user_collection", FakeCollection(documents))
+    return use
+
+@pytest.fixture
+def use_services_status(database):
+    '''Returns a function answering `get_services_status_collection()` with a FakeCollection of the given documents.'''
+    def use(documents: list) -> FakeCollection:
+        return database.use_collection("get_services_status_collection", FakeCollection(documents))
+    return use
+
+@pytest.fixture
+def use_redis(monkeypatch):
+    '''Returns a function putting a Redis stand-in behind the RedisClient singleton for one test.'''
+    def use(client):
+        redis_client = object.__new__(RedisClient)
+        redis_client.client = client
+        monkeypatch.setattr(RedisClient, "_instance", redis_client)
+        return client
+    return use
+
+@pytest.fixture
+def fake_redis(use_redis) -> FakeRedis:
+    return use_redis(FakeRedis())
+
+@pytest.fixture
+def fake_auth_service() -> FakeAuthService:
+    return FakeAuthService()
+
+@pytest.fixture
+def local_bus(monkeypatch):
+    '''
+        A fresh in-process message bus: its asyncio primitives belong to the event loop of the test
+        that first uses it.
+    '''
+    monkeypatch.setenv("MESSAGE_BUS_MODE", MessageBus.MODE_LOCAL)
+    monkeypatch.setattr(MessageBus, "_instance", None)
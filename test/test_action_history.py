@@ -0,0 +1,153 @@
+import asyncio
+import datetime
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ.setdefault("MESSAGE_BUS_MODE", "local")
+
+from bson import ObjectId
+
+from services.database import Database
+from services.app_service import AppService
+from services.service_change_writer import ServiceChangeWriter
+from services.services_status_storage import ServicesStatusStorage
+from models.request import ActionHistoryRequest
+
+from conftest import FakeIndexedCollection
+
+def matches(document: dict, query: dict) -> bool:
+    '''The subset of MongoDB filters the action history queries use: equality, $lt, $gte and $or.'''
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = document.get(field)
+            if "$lt" in condition and not value < condition["$lt"]:
+                return False
+            if "$gte" in condition and not value >= condition["$gte"]:
+                return False
+        elif document.get(field) != condition:
+            return False
+    return True
+
+class FakeActionHistoryCollection:
+    def __init__(self, documents: list = None):
+        self.documents = documents or []
+        self.queries = []
+
+    def find(self, filter, sort, limit):
+        self.queries.append(filter)
+        found = [dict(document) for document in self.documents if matches(document, filter)]
+        found.sort(key=lambda document: (document["timestamp"], document["_id"]), reverse=True)
+        return found[:limit]
+
+def make_action(uid: str, service_type: str, timestamp: datetime.datetime) -> dict:
+    return {
+        "_id": ObjectId(),
+        "uid": uid,
+        "service_type": service_type,
+        "description": f"{service_type} changed",
+        "timestamp": timestamp
+    }
+
+def test_embedded_history_completed_from_archive(database, use_services_status):
+    async def scenario():
+        storage = ServicesStatusStorage()
+        mode = storage.mode
+        storage.mode = storage.MODE_EMBEDDED
+        try:
+            uid = "pre-embedded-user"
+            start = datetime.datetime(2025, 5, 1, 8, 0)
+            archived = [make_action(uid, "headlight_service", start + datetime.timedelta(minutes=i)) for i in range(20)]
+            # Written before the switch: no history array
+            status = use_services_status([{"uid": uid, "headlight_service": "on"}])
+            history = database.use_collection("get_action_history_collection", FakeActionHistoryCollection(archived))
+
+            data, next_cursor = await AppService()._get_all_action_history(uid, ActionHistoryRequest(page_size=10))
+            assert len(data) == 10
+            assert data[0]["timestamp"] == archived[-1]["timestamp"].isoformat()
+            assert next_cursor is not None
+            assert len(history.queries) == 1
+
+            # One change since the switch, pushed to the embedded history and not archived yet
+            newest = make_action(uid, "air_cond_service", start + datetime.timedelta(hours=1))
+            status.documents[0]["history"] = [storage._to_history_entry(newest)]
+
+            data, _ = await AppService()._get_all_action_history(uid, ActionHistoryRequest(page_size=10))
+            assert [action["service_type"] for action in data[:2]] == ["air_cond_service", "headlight_service"]
+            assert len(data) == 10
+
+            # A full embedded history is enough, the archive is not read
+            status.documents[0]["history"] = [
+                storage._to_history_entry(action) for action in archived[-15:]
+            ]
+            data, next_cursor = await AppService()._get_all_action_history(uid, ActionHistoryRequest(page_size=10))
+            assert len(data) == 10
+            assert next_cursor is not None
+            assert len(history.queries) == 2
+        finally:
+            storage.mode = mode
+
+    asyncio.run(scenario())
+
+def test_keyset_pages_cover_history_once(database):
+    async def scenario():
+        uid = "paged-user"
+        start = datetime.datetime(2025, 5, 1, 8, 0)
+        # Three actions per timestamp: pages must split ties on _id
+        stored = [make_action(uid, "headlight_service", start + datetime.timedelta(minutes=i // 3)) for i in range(25)]
+        for i, action in enumerate(stored):
+            action["description"] = f"stored {i}"
+        database.use_collection("get_action_history_collection", FakeActionHistoryCollection(stored))
+
+        # Still in the write-behind buffer, oldest first; the last one was flushed meanwhile
+        pending = [make_action(uid, "air_cond_service", start + datetime.timedelta(hours=1, minutes=i)) for i in range(2)]
+        for i, action in enumerate(pending):
+            action["description"] = f"pending {i}"
+        writer = ServiceChangeWriter()
+        writer._get_pending_actions = lambda pending_uid: pending + [stored[-1]] if pending_uid == uid else []
+        try:
+            pages, cursor = [], None
+            while True:
+                data, cursor = await AppService()._get_all_action_history(uid, ActionHistoryRequest(page_size=10, cursor=cursor))
+                pages.append([action["description"] for action in data])
+                if cursor is None:
+                    break
+                # The cursor names the last action of the page
+                timestamp, action_id = AppService()._decode_action_history_cursor(cursor)
+                assert timestamp.isoformat() == data[-1]["timestamp"]
+                assert AppService()._encode_action_history_cursor({"timestamp": timestamp, "_id": action_id}) == cursor
+        finally:
+            del writer._get_pending_actions
+
+        newest_first = sorted(stored, key=lambda action: (action["timestamp"], action["_id"]), reverse=True)
+        assert pages[0][:2] == ["pending 1", "pending 0"]
+        assert [description for page in pages for description in page] == \
+            ["pending 1", "pending 0"] + [action["description"] for action in newest_first]
+        assert [len(page) for page in pages] == [10, 10, 7]
+
+        # A cursor from a client that altered it is refused
+        try:
+            await AppService()._get_all_action_history(uid, ActionHistoryRequest(cursor="not-a-cursor"))
+            assert False, "invalid cursor accepted"
+        except ValueError:
+            pass
+
+    asyncio.run(scenario())
+
+def test_timestamp_migration_drops_superseded_index(database, use_db):
+    history = database.use_collection("get_action_history_collection", FakeIndexedCollection(["_id_", "uid_timestamp"]))
+    database.use_collection("get_services_status_collection", FakeIndexedCollection(["_id_"]))
+    use_db({Database.FIELD_ACTION_HISTORY_COLLECTION: history})
+
+    logged = []
+    assert ServicesStatusStorage()._migrate_history_timestamps(log=logged.append) == 0
+    assert history.index_names == {"_id_", "uid_timestamp_id", "uid_service_type_timestamp_id"}
+    assert len(logged) == 1
+
+    # Already dropped: nothing left to do on a rerun
+    ServicesStatusStorage()._migrate_history_timestamps(log=logged.append)
+    assert len(logged) == 1
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import sys
+import time
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ.setdefault("MESSAGE_BUS_MODE", "local")
+
+from services.database import Database
+from services.iot_service import IOTService
+from services.app_service import AppService
+from utils.bounded_executor import BoundedExecutor
+
+class FakeDeviceSocket:
+    '''Stands in for the device WebSocket, frames are fed through `frames`.'''
+    def __init__(self):
+        self.frames = asyncio.Queue()
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def receive_json(self):
+        return await self.frames.get()
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=None, reason=None):
+        pass
+
+def test_device_frames_handled_while_slow_query_runs(local_bus):
+    async def scenario():
+        device_id = "test-device"
+        websocket = FakeDeviceSocket()
+
+        # The user's app listens on /app/events
+        frames = []
+        response = await AppService()._get_notification_stream(device_id)
+        async def listen():
+            async for frame in response.body_iterator:
+                frames.append(frame)
+        app_stream = asyncio.create_task(listen())
+        await asyncio.sleep(0.05)
+
+        connection = asyncio.create_task(IOTService()._establish_connection(device_id, websocket))
+
+        # Simulates a Mongo query that takes one second
+        slow_query = asyncio.create_task(Database()._instance.run(time.sleep, 1.0))
+        await asyncio.sleep(0.05)
+
+        for i in range(5):
+            await websocket.frames.put({
+                "device_id": device_id,
+                "service_type": "drowsiness_service",
+                "description": f"frame {i}",
+                "timestamp": "2025-05-07T22:15:22"
+            })
+
+        started = time.perf_counter()
+        while len(frames) < 5:
+            assert time.perf_counter() - started < 0.5, "device frames were not handled during the slow query"
+            await asyncio.sleep(0.01)
+
+        assert not slow_query.done()
+        await slow_query
+
+        stats = Database()._instance.get_executor_stats()
+        assert stats["completed"] >= 1
+        assert stats["in_flight"] == 0
+
+        for task in (connection, app_stream):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    asyncio.run(scenario())
+
+def test_cancelled_call_keeps_its_slot():
+    async def scenario():
+        executor = BoundedExecutor(name="test", max_workers=1, max_queue=0, queue_timeout=0.1)
+
+        # The caller gives up, the thread still runs the call
+        slow_call = asyncio.create_task(executor.run(time.sleep, 0.3))
+        await asyncio.sleep(0.05)
+        slow_call.cancel()
+        try:
+            await slow_call
+        except asyncio.CancelledError:
+            pass
+        assert executor.stats()["in_flight"] == 1
+
+        try:
+            await executor.run(time.sleep, 0)
+            assert False, "call admitted while the pool was busy"
+        except Exception as e:
+            assert e.args[0] == "Server busy"
+
+        # Freed once the thread is done
+        await asyncio.sleep(0.35)
+        assert executor.stats()["in_flight"] == 0
+        assert executor.stats()["completed"] == 1
+        await executor.run(time.sleep, 0)
+        assert executor.stats()["completed"] == 2
+
+        executor.shutdown()
+
+    asyncio.run(scenario())
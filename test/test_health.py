@@ -0,0 +1,40 @@
+import asyncio
+import json
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ.setdefault("MESSAGE_BUS_MODE", "local")
+
+from services.redis_client import RedisClient
+from routes.health_routes import health
+
+def test_redis_pool_stats_read_from_the_pool():
+    client = object.__new__(RedisClient)
+    client._init_instance()
+
+    # Counted from redis-py internals: fail here after an upgrade rather than report 0 connections
+    assert hasattr(client.pool, "_in_use_connections")
+    assert hasattr(client.pool, "_available_connections")
+    assert client._get_pool_stats() == {"max_connections": client.pool.max_connections, "in_use": 0, "idle": 0, "created": 0}
+
+def test_health_stats_only_when_enabled():
+    async def scenario():
+        health_stats = os.environ.pop("HEALTH_STATS", None)
+        try:
+            content = json.loads((await health(None)).body)
+            assert content["status"] == "ok"
+            assert "stats" not in content
+
+            os.environ["HEALTH_STATS"] = "True"
+            content = json.loads((await health(None)).body)
+            assert content["stats"]["redis_pool"]["in_use"] == 0
+            assert content["stats"]["mongo_executor"]["name"] == "mongo"
+            assert "pending_actions" in content["stats"]["service_change_writer"]
+        finally:
+            os.environ.pop("HEALTH_STATS", None)
+            if health_stats is not None:
+                os.environ["HEALTH_STATS"] = health_stats
+
+    asyncio.run(scenario())
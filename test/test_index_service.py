@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from services.database import Database
+from services.index_service import IndexService
+from services.sensor_storage import SensorStorage
+
+from conftest import FakeDatabase, FakeIndexedCollection
+
+def run_with_database(use_db, monkeypatch, collections: dict, scenario):
+    storage = SensorStorage()
+    monkeypatch.setattr(storage, "mode", storage.MODE_DOCUMENT)
+    asyncio.run(scenario(use_db(collections)))
+
+def test_ensure_indexes_applies_registry(use_db, monkeypatch):
+    async def scenario(fake: FakeDatabase):
+        result = await IndexService()._ensure_indexes()
+
+        # The time-series collection is left alone until it is used
+        assert Database.FIELD_ENV_SENSOR_TS_COLLECTION not in result
+        assert result[Database.FIELD_USER_COLLECTION] == ["username_unique"]
+        assert result[Database.FIELD_ACTION_HISTORY_COLLECTION] == ["uid_timestamp_id", "uid_service_type_timestamp_id"]
+        assert fake.collections[Database.FIELD_ENV_SENSOR_COLLECTION].index_names == {"uid_sensor_type_timestamp"}
+
+        # A failing collection is reported, the others are still created
+        assert result[Database.FIELD_SERVICES_STATUS_COLLECTION] == "not authorized"
+
+    run_with_database(use_db, monkeypatch, {Database.FIELD_SERVICES_STATUS_COLLECTION: FakeIndexedCollection(error="not authorized")}, scenario)
+
+def test_verify_indexes_reports_winning_plans(use_db, monkeypatch):
+    async def scenario(fake: FakeDatabase):
+        report = await IndexService()._verify_indexes()
+
+        assert set(report) == set(IndexService()._get_hot_queries())
+        assert report["user.find_by_username"] == {"LIMIT", "FETCH", "IXSCAN"}
+        assert report["environment_sensor.newest_per_type"] == {"LIMIT", "FETCH", "IXSCAN"}
+        assert [collection_name for collection_name, _ in fake.aggregates] == [Database.FIELD_ENV_SENSOR_COLLECTION]
+
+        # The history queries are explained with the sort and limit the service uses
+        _, sort, limit = fake.collections[Database.FIELD_ACTION_HISTORY_COLLECTION].finds[0]
+        assert sort and limit > 0
+
+    run_with_database(use_db, monkeypatch, {}, scenario)
+
+def test_verify_indexes_rejects_collection_scans(use_db, monkeypatch):
+    async def scenario(fake: FakeDatabase):
+        try:
+            await IndexService()._verify_indexes()
+            assert False, "collection scan accepted"
+        except Exception as e:
+            assert e.args[0] == "Queries not using an index: action_history.newest, action_history.page_by_service_type"
+
+    run_with_database(use_db, monkeypatch, {Database.FIELD_ACTION_HISTORY_COLLECTION: FakeIndexedCollection(stage="COLLSCAN")}, scenario)
+
+def test_startup_refused_without_unique_indexes(use_db, monkeypatch):
+    async def scenario(fake: FakeDatabase):
+        # A fresh database, the bootstrap turned off
+        try:
+            await IndexService()._verify_unique_indexes()
+            assert False, "started without the unique username index"
+        except Exception as e:
+            assert e.args[0] == f"Unique indexes missing: {Database.FIELD_USER_COLLECTION}.username_unique"
+
+        # A plain index on the username does not keep it unique
+        users = fake.get_collection(Database.FIELD_USER_COLLECTION)
+        users.index_names.add("username_1")
+        users.index_info["username_1"] = {"key": [("username", 1)]}
+        try:
+            await IndexService()._verify_unique_indexes()
+            assert False, "started without the unique username index"
+        except Exception:
+            pass
+
+        await IndexService()._ensure_indexes()
+        await IndexService()._verify_unique_indexes()
+
+    run_with_database(use_db, monkeypatch, {}, scenario)
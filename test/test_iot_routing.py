@@ -0,0 +1,240 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from services.message_bus import MessageBus
+from services.iot_service import IOTService
+from services.device_twin import DeviceTwins
+from models.mongo_doc import ServicesStatusDocument
+
+class AnsweringDeviceSocket:
+    '''Stands in for a device WebSocket that answers every command with `status`.'''
+    def __init__(self, device_id: str, status: str = "success"):
+        self.device_id = device_id
+        self.status = status
+        self.frames = asyncio.Queue()
+        self.commands = []
+        self.failing_targets = set()
+
+    async def accept(self):
+        pass
+
+    async def receive_json(self):
+        return await self.frames.get()
+
+    async def send_json(self, data):
+        if "commands" in data:
+            # Batch: every command succeeds unless its target is in `failing_targets`
+            self.commands.append(data)
+            results = [
+                {"command_id": command["command_id"], "status": "error" if command["target"] in self.failing_targets else "success", "message": "rejected"}
+                for command in data["commands"]
+            ]
+            await self.frames.put({"device_id": self.device_id, "command_id": data["command_id"], "status": self.status, "message": "rejected", "results": results})
+        elif "command_id" in data:
+            self.commands.append(data)
+            await self.frames.put({"device_id": self.device_id, "command_id": data["command_id"], "status": self.status, "message": "rejected"})
+
+    async def close(self, code=None, reason=None):
+        pass
+
+def make_services_status(uid: str, **fields) -> dict:
+    # Every service off and value 0, unless given
+    document = {"uid": uid}
+    document.update({field: "off" for field in ServicesStatusDocument.ALL_SERVICE_FIELDS.value})
+    document.update({field: 0 for field in ServicesStatusDocument.ALL_VALUE_FIELDS.value})
+    document.update(fields)
+    return document
+
+def make_worker(worker_id: str) -> IOTService:
+    # One IOTService per simulated worker, sharing the in-process message bus
+    worker = object.__new__(IOTService)
+    worker._init_instance()
+    worker.worker_id = worker_id
+    return worker
+
+def test_command_forwarded_to_owning_worker(local_bus):
+    async def scenario():
+        worker_a, worker_b = make_worker("worker-a"), make_worker("worker-b")
+        await worker_a._start()
+        await worker_b._start()
+
+        device_id = "routed-device"
+        websocket = AnsweringDeviceSocket(device_id)
+        connection = asyncio.create_task(worker_a._establish_connection(device_id, websocket))
+        await asyncio.sleep(0.05)
+
+        assert await MessageBus()._get(f"device:{device_id}") == "worker-a"
+
+        # The request lands on worker B, the socket lives on worker A
+        await worker_b._control_iot_system(device_id, "headlight_service", "on")
+        assert len(websocket.commands) == 1
+        assert websocket.commands[0]["command"] == {"target": "headlight_service", "value": "on"}
+        assert not worker_b.forwarded_commands
+
+        # A second worker can not take over a connected device
+        duplicate = AnsweringDeviceSocket(device_id)
+        assert not await worker_b._add_connected_iot_system(device_id, duplicate)
+
+        websocket.status = "error"
+        try:
+            await worker_b._control_iot_system(device_id, "headlight_service", "off")
+            assert False, "device error was not forwarded"
+        except Exception as e:
+            assert e.args[0] == "rejected"
+
+        connection.cancel()
+        try:
+            await connection
+        except asyncio.CancelledError:
+            pass
+        await worker_a._stop()
+        await worker_b._stop()
+
+        assert await MessageBus()._get(f"device:{device_id}") is None
+        try:
+            await worker_b._control_iot_system(device_id, "headlight_service", "on")
+            assert False, "command sent to a disconnected device"
+        except Exception as e:
+            assert e.args[0] == "Device not connected"
+
+    asyncio.run(scenario())
+
+def test_batch_sent_in_one_frame(local_bus):
+    async def scenario():
+        worker_a, worker_b = make_worker("worker-a"), make_worker("worker-b")
+        await worker_a._start()
+        await worker_b._start()
+
+        device_id = "batched-device"
+        websocket = AnsweringDeviceSocket(device_id)
+        websocket.failing_targets = {"headlight_service"}
+        connection = asyncio.create_task(worker_a._establish_connection(device_id, websocket))
+        await asyncio.sleep(0.05)
+
+        commands = [("air_cond_service", "24"), ("headlight_service", "80"), ("distance_threshold", "50")]
+        for worker in (worker_a, worker_b):
+            results = await worker._control_iot_services(device_id, commands)
+            assert [result["service_type"] for result in results] == [target for target, _ in commands]
+            assert [result["status"] for result in results] == ["success", "error", "success"]
+
+        # One frame per batch, local or forwarded, without the commands the device already confirmed
+        assert len(websocket.commands) == 2
+        assert [(command["target"], command["value"]) for command in websocket.commands[0]["commands"]] == commands
+        assert [(command["target"], command["value"]) for command in websocket.commands[1]["commands"]] == [commands[1]]
+
+        websocket.status = "error"
+        try:
+            await worker_b._control_iot_services(device_id, commands)
+            assert False, "rejected batch was not reported"
+        except Exception as e:
+            assert e.args[0] == "rejected"
+
+        connection.cancel()
+        try:
+            await connection
+        except asyncio.CancelledError:
+            pass
+        await worker_a._stop()
+        await worker_b._stop()
+
+    asyncio.run(scenario())
+
+def test_twin_skips_unchanged_commands(local_bus, use_services_status):
+    async def scenario():
+        worker_a, worker_b = make_worker("worker-a"), make_worker("worker-b")
+        await worker_a._start()
+        await worker_b._start()
+
+        device_id = "twin-device"
+        use_services_status([make_services_status(device_id, headlight_service="off", headlight_brightness=50)])
+        websocket = AnsweringDeviceSocket(device_id)
+        connection = asyncio.create_task(worker_a._establish_connection(device_id, websocket))
+        await asyncio.sleep(0.05)
+
+        twin = DeviceTwins()._get(device_id)
+        assert twin.loaded
+
+        await worker_b._control_iot_system(device_id, "headlight_service", "on")
+        assert twin.reported["headlight_service"] == "on"
+        assert twin.version == 1
+
+        # Already on: answered by the twin, nothing reaches the device
+        await worker_b._control_iot_system(device_id, "headlight_service", "on")
+        results = await worker_a._control_iot_services(device_id, [("headlight_service", "on"), ("headlight_service", "50")])
+        assert [result.get("unchanged", False) for result in results] == [True, False]
+        assert len(websocket.commands) == 2
+
+        results = await worker_a._control_iot_services(device_id, [("headlight_service", "on"), ("headlight_service", "50")])
+        assert all(result["unchanged"] for result in results)
+        assert len(websocket.commands) == 2
+
+        websocket.status = "error"
+        try:
+            await worker_a._control_iot_system(device_id, "headlight_service", "off")
+            assert False, "device error was not reported"
+        except Exception:
+            pass
+        assert twin.reported["headlight_service"] == "on"
+        assert twin.desired["headlight_service"] == "on"
+
+        connection.cancel()
+        try:
+            await connection
+        except asyncio.CancelledError:
+            pass
+        await worker_a._stop()
+        await worker_b._stop()
+
+        assert DeviceTwins()._get(device_id) is None
+
+    asyncio.run(scenario())
+
+def test_twin_loaded_on_connect(local_bus, use_services_status):
+    async def scenario():
+        worker = make_worker("worker-a")
+        await worker._start()
+
+        device_id = "reconnected-device"
+        services_status = use_services_status([make_services_status(device_id, air_cond_service="on", air_cond_temp=24)])
+        websocket = AnsweringDeviceSocket(device_id)
+        connection = asyncio.create_task(worker._establish_connection(device_id, websocket))
+        await asyncio.sleep(0.05)
+        assert services_status.reads == 1
+
+        # Served from the twin loaded at connect, without another read
+        twin = DeviceTwins()._get(device_id)
+        assert twin.loaded
+        assert twin.get_status()["air_cond_service"] == "on"
+
+        # The device may have rebooted to its defaults: the stored state does not skip commands
+        await worker._control_iot_system(device_id, "air_cond_service", "on")
+        await worker._control_iot_system(device_id, "air_cond_service", "24")
+        assert len(websocket.commands) == 2
+
+        # Confirmed on this connection now
+        await worker._control_iot_system(device_id, "air_cond_service", "on")
+        await worker._control_iot_system(device_id, "air_cond_service", "24")
+        assert len(websocket.commands) == 2
+
+        # A rejected command falls back to the stored state
+        websocket.status = "error"
+        try:
+            await worker._control_iot_system(device_id, "air_cond_service", "28")
+            assert False, "device error was not reported"
+        except Exception:
+            pass
+        assert twin.desired["air_cond_temp"] == 24
+        assert services_status.reads == 1
+
+        connection.cancel()
+        try:
+            await connection
+        except asyncio.CancelledError:
+            pass
+        await worker._stop()
+
+    asyncio.run(scenario())
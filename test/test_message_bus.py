@@ -0,0 +1,55 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from services.message_bus import MessageBus, RedisMessageBus
+
+def make_bus() -> RedisMessageBus:
+    bus = object.__new__(RedisMessageBus)
+    bus._init_instance()
+    return bus
+
+def test_channel_subscribed_while_listener_subscribes(fake_redis):
+    async def scenario():
+        redis = fake_redis
+        bus = make_bus()
+        received = []
+        async def handler(message):
+            received.append(message)
+
+        # The listener's first SUBSCRIBE is slow to answer
+        redis.subscribe_gate = asyncio.Event()
+        await bus._subscribe("channel-a", handler)
+        await asyncio.sleep(0.01)
+
+        subscription = asyncio.create_task(bus._subscribe("channel-b", handler))
+        await asyncio.sleep(0.01)
+        redis.subscribe_gate.set()
+        await subscription
+        await asyncio.sleep(0.01)
+
+        assert redis.pubsubs[0].channels == {"channel-a", "channel-b"}
+        assert await bus._publish("channel-b", {"value": 1}) == 1
+        await asyncio.sleep(0.01)
+        assert received == [{"value": 1}]
+
+        await bus._unsubscribe("channel-b")
+        assert await bus._publish("channel-b", {"value": 2}) == 0
+
+        await bus._stop()
+
+    asyncio.run(scenario())
+
+def test_message_bus_requires_every_method():
+    class PartialMessageBus(MessageBus):
+        async def _get(self, key):
+            return None
+
+    try:
+        object.__new__(PartialMessageBus)
+        assert False, "incomplete message bus created"
+    except TypeError:
+        pass
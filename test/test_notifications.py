@@ -0,0 +1,239 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ.setdefault("MESSAGE_BUS_MODE", "local")
+
+from services.app_service import AppService
+from services.message_bus import MessageBus
+from utils.ring_buffer import RingBuffer
+
+def test_every_stream_of_a_user_gets_every_notification(local_bus):
+    async def scenario():
+        client_id = "multi-device-user"
+        service = AppService()
+
+        # The user's phone and tablet both listen on /app/events
+        received = [[], []]
+        async def listen(response, frames):
+            async for frame in response.body_iterator:
+                frames.append(frame)
+
+        streams = []
+        for frames in received:
+            response = await service._get_notification_stream(client_id)
+            streams.append(asyncio.create_task(listen(response, frames)))
+        await asyncio.sleep(0.05)
+
+        for i in range(3):
+            await service._add_notification(client_id, {"service_type": f"service_{i}", "description": f"notification {i}"})
+
+        for _ in range(100):
+            if all(len(frames) == 3 for frames in received):
+                break
+            await asyncio.sleep(0.02)
+
+        assert len(received[0]) == 3
+        assert received[0] == received[1]
+        assert all(frame.startswith(b"id: ") for frame in received[0])
+        assert service._get_buffer_stats()["subscribers"] == 2
+
+        for task in streams:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        assert service._get_buffer_stats()["subscribers"] == 0
+        await service._stop()
+
+    asyncio.run(scenario())
+
+def test_readings_published_only_while_streamed(local_bus):
+    async def scenario():
+        client_id = "unwatched-device"
+        service = object.__new__(AppService)
+        service._init_instance()
+
+        published = []
+        bus = MessageBus()
+        publish = bus._publish
+        async def counting_publish(channel, message):
+            published.append(channel)
+            return await publish(channel, message)
+        bus._publish = counting_publish
+
+        reading = [{"sensor_type": "temp", "value": 25, "timestamp": "2025-05-07T22:15:22"}]
+        try:
+            # Nobody streams live: one probe, then no bus round trip per frame
+            for _ in range(5):
+                await service._add_readings(client_id, reading)
+            assert len(published) == 1
+            assert service._get_buffer_stats()["readings_skipped"] == 4
+
+            frames = []
+            response = await service._get_notification_stream(client_id, ["temp"])
+            async def listen():
+                async for frame in response.body_iterator:
+                    frames.append(frame)
+            stream = asyncio.create_task(listen())
+            await asyncio.sleep(0.05)
+
+            # A live stream on this worker gets the next frame at once
+            await service._add_readings(client_id, reading)
+            for _ in range(50):
+                if frames:
+                    break
+                await asyncio.sleep(0.02)
+            assert len(published) == 2
+            assert frames and b"event: reading" in frames[0]
+
+            stream.cancel()
+            try:
+                await stream
+            except asyncio.CancelledError:
+                pass
+        finally:
+            bus._publish = publish
+            await service._stop()
+
+    asyncio.run(scenario())
+
+def test_readings_never_evict_notifications():
+    async def scenario():
+        buffer = RingBuffer(3, RingBuffer.POLICY_DROP_OLDEST)
+        buffer.put(("notification", "1-0", b"first"))
+        buffer.put(("reading", None, ["reading 1"]), volatile=True)
+        buffer.put(("notification", "2-0", b"second"))
+
+        # Full: the reading makes room for the notification, not the older notification
+        assert buffer.put(("notification", "3-0", b"third")) == RingBuffer.PUT_DROPPED
+        # Full of notifications: a new reading is not kept
+        assert buffer.put(("reading", None, ["reading 2"]), volatile=True) == RingBuffer.PUT_DROPPED
+
+        kinds, cursor = [], 0
+        for _ in range(len(buffer)):
+            cursor, (kind, event_id, _) = await buffer.read(cursor)
+            kinds.append((kind, event_id))
+        assert kinds == [("notification", "1-0"), ("notification", "2-0"), ("notification", "3-0")]
+
+        # Without a reading to drop, notifications drop the oldest one as before
+        buffer.put(("notification", "4-0", b"fourth"))
+        assert (await buffer.read(0))[1][1] == "2-0"
+
+    asyncio.run(scenario())
+
+async def collect(response, frames: list):
+    async for frame in response.body_iterator:
+        frames.append(frame)
+
+async def close(task: asyncio.Task):
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+def test_buffer_bounded_and_evicted_when_idle(local_bus):
+    async def scenario():
+        client_id = "bounded-buffer-user"
+        service = object.__new__(AppService)
+        service._init_instance()
+        service.SSE_BUFFER_SIZE = 3
+        service.SSE_BUFFER_POLICY = RingBuffer.POLICY_COALESCE
+        service.SSE_BUFFER_TTL = 0.2
+
+        frames = []
+        stream = asyncio.create_task(collect(await service._get_notification_stream(client_id), frames))
+        await asyncio.sleep(0.05)
+
+        for service_type in ("headlight_service", "air_cond_service", "headlight_service", "distance_service", "drowsiness_service"):
+            await service._add_notification(client_id, {"service_type": service_type, "description": f"{service_type} changed"})
+            await asyncio.sleep(0.02)
+
+        # Every notification was streamed, the buffer kept only the newest ones
+        assert len(frames) == 5
+        stats = service._get_buffer_stats()
+        assert stats["buffered_events"] == 3
+        assert stats["coalesced"] == 1
+        assert stats["dropped"] == 1
+
+        # Kept for a reconnect, then evicted once idle for SSE_BUFFER_TTL
+        await close(stream)
+        assert service._get_buffer_stats()["buffers"] == 1
+        await asyncio.sleep(1.2)
+        stats = service._get_buffer_stats()
+        assert stats["buffers"] == 0
+        assert stats["evicted_buffers"] == 1
+        assert stats["evicted_events"] == 3
+
+        await service._stop()
+
+    asyncio.run(scenario())
+
+def test_stream_resumed_from_last_event_id(local_bus):
+    async def scenario():
+        client_id = "reconnecting-user"
+        service = object.__new__(AppService)
+        service._init_instance()
+
+        # Sent while the client was disconnected
+        for i in range(3):
+            await service._add_notification(client_id, {"service_type": "system", "description": f"missed {i}"})
+        entries = await MessageBus()._range(f"events:{client_id}", "0-0")
+        assert len(entries) == 3
+
+        frames = []
+        response = await service._get_notification_stream(client_id, last_event_id=entries[0][0])
+        stream = asyncio.create_task(collect(response, frames))
+        await asyncio.sleep(0.05)
+
+        await service._add_notification(client_id, {"service_type": "system", "description": "live"})
+        for _ in range(50):
+            if len(frames) == 3:
+                break
+            await asyncio.sleep(0.02)
+
+        # The notifications after the last one seen, then the live ones, each once and with its id
+        assert [frame.split(b"\n")[0] for frame in frames[:2]] == [f"id: {entry_id}".encode() for entry_id, _ in entries[1:]]
+        assert [b"missed 1" in frames[0], b"missed 2" in frames[1], b"live" in frames[2]] == [True, True, True]
+        assert len(frames) == 3
+
+        # A malformed id is not replayed from
+        other = []
+        response = await service._get_notification_stream(client_id, last_event_id="not-an-id")
+        other_stream = asyncio.create_task(collect(response, other))
+        await asyncio.sleep(0.05)
+        assert other == []
+
+        await close(stream)
+        await close(other_stream)
+        await service._stop()
+
+    asyncio.run(scenario())
+
+def test_idle_stream_gets_heartbeats(local_bus):
+    async def scenario():
+        client_id = "idle-user"
+        service = object.__new__(AppService)
+        service._init_instance()
+        service.SSE_HEARTBEAT_INTERVAL = 0.05
+
+        frames = []
+        stream = asyncio.create_task(collect(await service._get_notification_stream(client_id), frames))
+        await asyncio.sleep(0.18)
+        assert len(frames) >= 2
+        assert set(frames) == {AppService.HEARTBEAT_FRAME}
+
+        # A notification is not delayed by the heartbeats
+        await service._add_notification(client_id, {"service_type": "system", "description": "awake"})
+        await asyncio.sleep(0.03)
+        assert any(b"awake" in frame for frame in frames)
+
+        await close(stream)
+        await service._stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import sys
+import threading
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from bson import ObjectId
+from passlib.hash import bcrypt
+
+from services.auth_service import AuthService
+from models.request import UserRequest
+
+def make_auth_service(monkeypatch, **settings) -> AuthService:
+    '''A fresh AuthService built with the given environment settings.'''
+    for name, value in settings.items():
+        monkeypatch.setenv(name, value)
+    service = object.__new__(AuthService)
+    service._AuthService__init_instance()
+    return service
+
+def test_hash_and_verify_in_pool(fake_redis, monkeypatch):
+    async def scenario():
+        service = make_auth_service(monkeypatch, BCRYPT_ROUNDS="4")
+
+        hashed = await service._hash_pw("secret-pw")
+        assert bcrypt.from_string(hashed).rounds == 4
+        assert await service._verify_pw(hashed, "secret-pw")
+        assert not await service._verify_pw(hashed, "wrong-pw")
+        assert not await service._verify_pw(None, "secret-pw")
+        assert await service._hash_pw("") is None
+
+        stats = service._get_password_executor_stats()
+        assert stats["completed"] == 3
+        assert stats["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+def test_login_rehashes_other_cost(fake_redis, use_users, monkeypatch):
+    async def scenario():
+        old_hash = bcrypt.using(rounds=5).hash("secret-pw")
+        user = {"_id": ObjectId(), "username": "rehash_user", "password": old_hash}
+        users = use_users([user])
+        service = make_auth_service(monkeypatch, BCRYPT_ROUNDS="4")
+
+        uid, (session_token, refresh_token) = await service._authenticate(UserRequest(username="rehash_user", password="secret-pw"))
+        assert uid == str(user["_id"])
+        assert session_token and refresh_token
+
+        # Replaced only where the verified hash is still stored
+        assert users.updates == [{"_id": user["_id"], "password": old_hash}]
+        assert bcrypt.from_string(user["password"]).rounds == 4
+        assert await service._verify_pw(user["password"], "secret-pw")
+
+        # Already at the configured cost: not rehashed again
+        await service._authenticate(UserRequest(username="rehash_user", password="secret-pw"))
+        assert len(users.updates) == 1
+
+        try:
+            await service._authenticate(UserRequest(username="rehash_user", password="wrong-pw"))
+            assert False, "wrong password accepted"
+        except Exception as e:
+            assert e.args[0] == "Invalid credentials"
+
+    asyncio.run(scenario())
+
+def test_login_rejected_while_pool_saturated(fake_redis, use_users, monkeypatch):
+    async def scenario():
+        use_users([{"_id": ObjectId(), "username": "busy_user", "password": bcrypt.using(rounds=4).hash("secret-pw")}])
+        service = make_auth_service(monkeypatch, BCRYPT_ROUNDS="4", BCRYPT_WORKERS="1", BCRYPT_QUEUE="0", BCRYPT_QUEUE_TIMEOUT="0.05")
+        executor = service._AuthService__password_executor
+
+        # The only worker is busy
+        release = threading.Event()
+        blocker = asyncio.create_task(executor.run(release.wait))
+        await asyncio.sleep(0.01)
+        try:
+            try:
+                await service._authenticate(UserRequest(username="busy_user", password="secret-pw"))
+                assert False, "login accepted with a saturated pool"
+            except Exception as e:
+                assert e.args[0] == "Server busy"
+            assert service._get_password_executor_stats()["rejected"] == 1
+        finally:
+            release.set()
+            await blocker
+
+        # Served again once the worker is free
+        uid, _ = await service._authenticate(UserRequest(username="busy_user", password="secret-pw"))
+        assert uid
+
+    asyncio.run(scenario())
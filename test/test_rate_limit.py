@@ -0,0 +1,121 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import httpx
+from fastapi import FastAPI, Request
+
+from middlewares.pipeline_middleware import PipelineMiddleware
+from services.rate_limit_service import RateLimitService
+from utils.rate_limiter import RateLimit, parse_rate_limit, rate_limit
+
+def make_worker() -> RateLimitService:
+    # One RateLimitService per simulated worker, sharing the Redis buckets
+    worker = object.__new__(RateLimitService)
+    worker._RateLimitService__init_instance()
+    return worker
+
+def test_parse_rate_limit():
+    assert parse_rate_limit("20/minute") == RateLimit(20, 60)
+    assert parse_rate_limit("100/5 minutes") == RateLimit(100, 300)
+    for limit in ("20", "20/fortnight", "many/minute"):
+        try:
+            parse_rate_limit(limit)
+            assert False, f"invalid limit \"{limit}\" accepted"
+        except ValueError:
+            pass
+
+def test_bucket_shared_between_workers(fake_redis):
+    async def scenario():
+        redis = fake_redis
+        worker_a, worker_b = make_worker(), make_worker()
+        limit = parse_rate_limit("3/minute")
+
+        assert await worker_a._hit("uid:user-a", limit) == (True, 0)
+        assert await worker_a._hit("uid:user-a", limit) == (True, 0)
+        assert await worker_b._hit("uid:user-a", limit) == (True, 0)
+
+        # Worker B still has local tokens, the shared bucket is empty: one token refills in 20 s
+        allowed, retry_after = await worker_b._hit("uid:user-a", limit)
+        assert not allowed
+        assert retry_after == 20
+        assert worker_b._get_stats()["rejected_shared"] == 1
+
+        # Now known locally: rejected without a Redis round trip
+        calls = redis.calls
+        allowed, retry_after = await worker_b._hit("uid:user-a", limit)
+        assert not allowed and retry_after > 0
+        assert redis.calls == calls
+        assert worker_b._get_stats()["rejected_local"] == 1
+
+        # Other users have their own bucket
+        assert await worker_b._hit("uid:user-b", limit) == (True, 0)
+
+        # Refilled in the shared bucket, taken by the worker that has not seen the rejection
+        redis.now_ms += 20000
+        assert await worker_a._hit("uid:user-a", limit) == (True, 0)
+        assert not (await worker_a._hit("uid:user-a", limit))[0]
+
+    asyncio.run(scenario())
+
+def test_local_bucket_enforced_while_redis_down(fake_redis):
+    async def scenario():
+        redis = fake_redis
+        worker = make_worker()
+        limit = parse_rate_limit("2/minute")
+
+        redis.down = True
+        assert await worker._hit("ip:10.0.0.1", limit) == (True, 0)
+        assert await worker._hit("ip:10.0.0.1", limit) == (True, 0)
+        allowed, retry_after = await worker._hit("ip:10.0.0.1", limit)
+        assert not allowed
+        assert 0 < retry_after <= 30
+
+        stats = worker._get_stats()
+        assert stats["redis_errors"] == 2
+        assert stats["rejected_local"] == 1
+        assert redis.calls == 2
+
+    asyncio.run(scenario())
+
+def test_middleware_limits_per_user_and_per_ip(fake_redis, fake_auth_service):
+    async def scenario():
+        app = FastAPI()
+
+        @app.get("/app/limited")
+        @rate_limit("2/minute")
+        async def limited(request: Request):
+            return {"user_id": request.state.user_id}
+
+        @app.post("/auth/login")
+        @rate_limit("1/minute")
+        async def login(request: Request):
+            return {}
+
+        @app.get("/app/unlimited")
+        async def unlimited(request: Request):
+            return {}
+
+        app.add_middleware(PipelineMiddleware, auth_service=fake_auth_service, rate_limit_service=make_worker())
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            statuses = [(await client.get("/app/limited", cookies={"session_token": "token-a"})).status_code for _ in range(3)]
+            assert statuses == [200, 200, 429]
+
+            response = await client.get("/app/limited", cookies={"session_token": "token-a"})
+            assert response.status_code == 429
+            assert int(response.headers["retry-after"]) >= 1
+            assert response.json()["message"] == "Too Many Requests"
+
+            # Counted per user, and only on endpoints with a limit
+            assert (await client.get("/app/limited", cookies={"session_token": "token-b"})).status_code == 200
+            assert (await client.get("/app/unlimited", cookies={"session_token": "token-a"})).status_code == 200
+
+            # Whitelisted paths are counted per client IP, without a session
+            assert (await client.post("/auth/login")).status_code == 200
+            assert (await client.post("/auth/login")).status_code == 429
+
+    asyncio.run(scenario())
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+import httpx
+from fastapi import FastAPI, WebSocket
+
+from middlewares.pipeline_middleware import PipelineMiddleware
+from utils.route_matcher import RouteMatcher
+
+def test_static_segments_preferred_over_parameters():
+    matcher = RouteMatcher()
+    matcher.add("/app/user/{uid}", "user")
+    matcher.add("/app/user/avatar", "avatar")
+    matcher.add("/app/{section}/stats/daily", "daily")
+    matcher.add("/app/user/avatar/{size}", "avatar size")
+
+    assert matcher.get("/app/user/avatar") == "avatar"
+    assert matcher.get("/app/user/42") == "user"
+    assert matcher.get("/app/user/avatar/small") == "avatar size"
+
+    # The static "user" segment leads nowhere, the parameter segment does
+    assert matcher.get("/app/user/stats/daily") == "daily"
+    assert matcher.get("/app/sensor/stats/daily") == "daily"
+    assert "/app/user/stats/weekly" not in matcher
+
+    # An empty segment never fills a parameter
+    assert "/app/user/" not in matcher
+    assert "/app//stats/daily" not in matcher
+    assert len(matcher) == 4
+
+def test_exact_paths_and_tail_segments():
+    matcher = RouteMatcher(["/", "/health", "/docs/"])
+    matcher.add("/static/{file:path}", "static")
+
+    assert "/" in matcher
+    assert "/health" in matcher
+    # A trailing slash is a segment of its own
+    assert "/health/" not in matcher
+    assert "/docs/" in matcher and "/docs" not in matcher
+
+    assert matcher.get("/static/css/app.css") == "static"
+    assert matcher.get("/static/app.js") == "static"
+
+    assert "" not in matcher
+    assert "health" not in matcher
+    assert "/unknown" not in matcher
+    assert matcher.get("/unknown", "default") == "default"
+
+    # Added twice: counted once, the first value is kept
+    assert matcher.add("/static/{other:path}", "other") == "static"
+    assert len(matcher) == 4
+
+def test_from_routes_keeps_routes_per_method():
+    app = FastAPI()
+
+    @app.get("/app/items/{item_id}")
+    async def get_item(item_id: str):
+        return {}
+
+    @app.delete("/app/items/{item_id}")
+    async def delete_item(item_id: str):
+        return {}
+
+    @app.websocket("/iot/ws/{device_id}")
+    async def device(websocket: WebSocket, device_id: str):
+        pass
+
+    matcher = RouteMatcher.from_routes(app.routes, extra_paths=["/"])
+    routes = matcher.get("/app/items/7")
+    assert set(routes) == {"GET", "DELETE"}
+    assert routes["GET"].endpoint is get_item
+    assert routes["DELETE"].endpoint is delete_item
+    assert list(matcher.get("/iot/ws/device-1")) == [None]
+    assert "/" in matcher
+
+def test_middleware_answers_unknown_paths(fake_auth_service):
+    async def scenario():
+        app = FastAPI()
+
+        @app.get("/app/items/{item_id}")
+        async def get_item(item_id: str):
+            return {"item_id": item_id}
+
+        app.add_middleware(PipelineMiddleware, auth_service=fake_auth_service)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            response = await client.get("/app/items/7", cookies={"session_token": "token-a"})
+            assert response.status_code == 200
+            assert response.json() == {"item_id": "7"}
+
+            # Unknown paths are answered before the session check
+            for path in ("/app/unknown", "/app/items/7/extra", "/app/items/"):
+                response = await client.get(path)
+                assert response.status_code == 404
+                assert response.json()["message"] == "Not Found"
+
+            # Known path without a session
+            assert (await client.get("/app/items/7")).status_code == 401
+            assert (await client.get("/")).status_code == 200
+
+            # FastAPI's documentation routes are not part of the API
+            for path in ("/docs", "/docs/oauth2-redirect", "/redoc", "/openapi.json"):
+                response = await client.get(path, cookies={"session_token": "token-a"})
+                assert response.status_code == 404
+
+    asyncio.run(scenario())
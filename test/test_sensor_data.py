@@ -0,0 +1,235 @@
+import asyncio
+import datetime
+import math
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from bson import ObjectId
+
+from services.app_service import AppService
+from services.sensor_storage import SensorStorage
+from models.request import SensorDataRequest, SensorHistoryRequest
+
+def get_path(document: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(document, dict):
+            return None
+        document = document.get(part)
+    return document
+
+def evaluate(expression, document: dict):
+    '''The aggregation expressions the sensor pipelines use.'''
+    if expression == "$$ROOT":
+        return document
+    if isinstance(expression, str) and expression.startswith("$"):
+        return get_path(document, expression[1:])
+    if not (isinstance(expression, dict) and len(expression) == 1 and next(iter(expression)).startswith("$")):
+        return expression
+
+    (operator, arguments), = expression.items()
+    if operator == "$toDate":
+        value = evaluate(arguments, document)
+        return datetime.datetime.fromisoformat(value) if isinstance(value, str) else value
+    if operator == "$floor":
+        return math.floor(evaluate(arguments, document))
+
+    a, b = (evaluate(argument, document) for argument in arguments)
+    if operator == "$subtract":
+        # Dates subtract to milliseconds
+        difference = a - b
+        return difference / datetime.timedelta(milliseconds=1) if isinstance(difference, datetime.timedelta) else difference
+    if operator == "$divide":
+        return a / b
+    raise NotImplementedError(operator)
+
+def sort_key(value):
+    # BSON order across types: numbers, strings, then dates
+    rank = 3 if isinstance(value, datetime.datetime) else 2 if isinstance(value, str) else 1
+    return rank, value
+
+def matches(document: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(document, branch) for branch in condition):
+                return False
+            continue
+
+        value = get_path(document, field)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if operator == "$in" and value not in operand:
+                return False
+            if operator == "$ne" and value == operand:
+                return False
+            # A range only matches values of its own type
+            if operator == "$gte" and (value is None or sort_key(value)[0] != sort_key(operand)[0] or value < operand):
+                return False
+    return True
+
+ACCUMULATORS = {
+    "$first": lambda values: values[0],
+    "$avg": lambda values: sum(values) / len(values),
+    "$min": min,
+    "$max": max,
+}
+
+def accumulate(output: dict, documents: list) -> dict:
+    result = {}
+    for field, accumulator in output.items():
+        (operator, expression), = accumulator.items()
+        result[field] = ACCUMULATORS[operator]([evaluate(expression, document) for document in documents])
+    return result
+
+def project(document: dict, projection: dict) -> dict:
+    if all(value == 0 for value in projection.values()):
+        return {field: value for field, value in document.items() if field not in projection}
+
+    result = {} if projection.get("_id", 1) == 0 else {"_id": document.get("_id")}
+    for field, value in projection.items():
+        if field == "_id":
+            continue
+        if value == 1:
+            if field in document:
+                result[field] = document[field]
+        else:
+            result[field] = evaluate(value, document)
+    return result
+
+def bucket(documents: list, spec: dict) -> list:
+    boundaries, default = spec["boundaries"], spec["default"]
+    groups = {}
+    for document in documents:
+        key = evaluate(spec["groupBy"], document)
+        bound = next((low for low, high in zip(boundaries, boundaries[1:]) if low <= key < high), default)
+        groups.setdefault(bound, []).append(document)
+
+    bounds = sorted(bound for bound in groups if bound != default) + ([default] if default in groups else [])
+    return [{"_id": bound, **accumulate(spec["output"], groups[bound])} for bound in bounds]
+
+def aggregate(documents: list, pipeline: list) -> list:
+    '''In-memory run of the aggregation stages the sensor pipelines use.'''
+    for stage in pipeline:
+        (name, spec), = stage.items()
+        if name == "$match":
+            documents = [document for document in documents if matches(document, spec)]
+        elif name == "$sort":
+            for field, direction in reversed(list(spec.items())):
+                documents = sorted(documents, key=lambda document: sort_key(get_path(document, field)), reverse=direction == -1)
+        elif name == "$group":
+            groups = {}
+            for document in documents:
+                groups.setdefault(evaluate(spec["_id"], document), []).append(document)
+            output = {field: accumulator for field, accumulator in spec.items() if field != "_id"}
+            documents = [{"_id": key, **accumulate(output, grouped)} for key, grouped in groups.items()]
+        elif name == "$replaceRoot":
+            documents = [evaluate(spec["newRoot"], document) for document in documents]
+        elif name == "$addFields":
+            documents = [{**document, **{field: evaluate(value, document) for field, value in spec.items()}} for document in documents]
+        elif name == "$project":
+            documents = [project(document, spec) for document in documents]
+        elif name == "$facet":
+            documents = [{facet: aggregate(documents, branch) for facet, branch in spec.items()}]
+        elif name == "$bucket":
+            documents = bucket(documents, spec)
+        else:
+            raise NotImplementedError(name)
+    return documents
+
+class FakeSensorCollection:
+    def __init__(self, documents: list):
+        self.documents = documents
+        self.pipelines = []
+
+    def aggregate(self, pipeline):
+        self.pipelines.append(pipeline)
+        return iter(aggregate([dict(document) for document in self.documents], pipeline))
+
+def use_readings(database, documents: list, timeseries: bool = False) -> FakeSensorCollection:
+    getter = "get_env_sensor_ts_collection" if timeseries else "get_env_sensor_collection"
+    return database.use_collection(getter, FakeSensorCollection(documents))
+
+def make_reading(uid: str, sensor_type: str, value, timestamp) -> dict:
+    return {"uid": uid, "sensor_type": sensor_type, "value": value, "timestamp": timestamp}
+
+def test_newest_reading_per_sensor_type(database):
+    async def scenario():
+        uid = "newest-user"
+        start = datetime.datetime(2025, 5, 7, 8, 0)
+        readings = [
+            make_reading(uid, "temp", 20.0, start),
+            make_reading(uid, "humid", 55.0, start + datetime.timedelta(minutes=1)),
+            make_reading(uid, "temp", 22.0, start + datetime.timedelta(minutes=2)),
+            make_reading(uid, "temp", 21.0, start + datetime.timedelta(minutes=1)),
+            make_reading("other-user", "temp", 99.0, start + datetime.timedelta(minutes=3)),
+        ]
+        storage = SensorStorage()
+        mode = storage.mode
+        try:
+            for timeseries in (False, True):
+                storage.mode = storage.MODE_TIMESERIES if timeseries else storage.MODE_DOCUMENT
+                documents = [{"_id": ObjectId(), **reading} for reading in readings]
+                if timeseries:
+                    documents = [
+                        {"_id": document["_id"], "meta": {"uid": document["uid"], "sensor_type": document["sensor_type"]}, "value": document["value"], "timestamp": document["timestamp"]}
+                        for document in documents
+                    ]
+                collection = use_readings(database, documents, timeseries)
+
+                # In the requested order, one round trip, sensors without readings left out
+                data = await AppService()._get_sensors_data(uid, SensorDataRequest(sensor_types=["humid", "temp", "lux"]))
+                assert len(collection.pipelines) == 1
+                assert [(reading["sensor_type"], reading["value"]) for reading in data] == [("humid", 55.0), ("temp", 22.0)]
+                assert data[1]["timestamp"] == (start + datetime.timedelta(minutes=2)).isoformat()
+                assert data[1]["uid"] == uid
+                assert data[1]["_id"] == str(documents[2]["_id"])
+                assert "meta" not in data[1]
+
+                data = await AppService()._get_sensors_data(uid, SensorDataRequest(sensor_types=["temp"], fields=["value"]))
+                assert data == [{"sensor_type": "temp", "value": 22.0}]
+        finally:
+            storage.mode = mode
+
+    asyncio.run(scenario())
+
+def test_sensor_history_downsampled(database):
+    async def scenario():
+        uid = "history-user"
+        now = datetime.datetime.now()
+        def ago(seconds: float) -> datetime.datetime:
+            return now - datetime.timedelta(seconds=seconds)
+
+        collection = use_readings(database, [
+            make_reading(uid, "temp", 25.0, ago(2)),
+            make_reading(uid, "temp", 24.0, ago(5)),
+            make_reading(uid, "temp", 23.0, ago(12)),
+            make_reading(uid, "temp", 21.0, ago(25).isoformat()),   # Stored before native timestamps
+            make_reading(uid, "temp", 10.0, ago(45)),               # Older than the requested points
+            make_reading(uid, "humid", 60.0, ago(3)),
+            make_reading("other-user", "temp", 99.0, ago(1)),
+        ])
+
+        # 3 points of 10 seconds, newest first, one round trip
+        result = await AppService()._get_all_sensor_data(uid, SensorHistoryRequest(interval=10, points=3))
+        assert len(collection.pipelines) == 1
+        assert result["temp"] == [
+            {"sensor_type": "temp", "value": 25.0, "timestamp": ago(2).isoformat()},
+            {"sensor_type": "temp", "value": 23.0, "timestamp": ago(12).isoformat()},
+            {"sensor_type": "temp", "value": 21.0, "timestamp": ago(25).isoformat()},
+        ]
+        assert result["humid"] == [{"sensor_type": "humid", "value": 60.0, "timestamp": ago(3).isoformat()}]
+        assert result["lux"] == result["dis"] == []
+
+        result = await AppService()._get_all_sensor_data(uid, SensorHistoryRequest(interval=10, points=3, aggregate="avg"))
+        assert [point["value"] for point in result["temp"]] == [24.5, 23.0, 21.0]
+
+        # One point over the whole range
+        result = await AppService()._get_all_sensor_data(uid, SensorHistoryRequest(interval=60, points=1, aggregate="min"))
+        assert [point["value"] for point in result["temp"]] == [10.0]
+
+    asyncio.run(scenario())
@@ -0,0 +1,118 @@
+import datetime
+import os
+import sys
+import time
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from services.sensor_storage import SensorStorage
+
+class FakeSourceCollection:
+    def __init__(self, documents: list):
+        self.documents = sorted(documents, key=lambda document: document["_id"])
+
+    def find(self, query, sort=None, limit=0):
+        after = query.get("_id", {}).get("$gt")
+        found = [document for document in self.documents if after is None or document["_id"] > after]
+        return [dict(document) for document in found[:limit]]
+
+class FakeTimeseriesCollection:
+    '''No unique index, like a time-series collection. `failures` holds what the next inserts raise.'''
+    def __init__(self):
+        self.documents = []
+        self.failures = []
+
+    def insert_many(self, documents, ordered=True):
+        failure = self.failures.pop(0) if self.failures else None
+        if isinstance(failure, Exception):
+            # Cut off halfway, e.g. by a lost connection
+            self.documents.extend(documents[:len(documents) // 2])
+            raise failure
+        rejected = failure or set()
+        self.documents.extend(document for index, document in enumerate(documents) if index not in rejected)
+        if rejected:
+            raise BulkWriteError({"writeErrors": [{"index": index, "errmsg": "rejected"} for index in sorted(rejected)]})
+
+    def find(self, query, projection=None):
+        ids = set(query["_id"]["$in"])
+        return [{"_id": document["_id"]} for document in self.documents if document["_id"] in ids]
+
+class FakeMigrationCollection:
+    def __init__(self):
+        self.document = None
+
+    def find_one(self, query):
+        return dict(self.document) if self.document else None
+
+    def update_one(self, query, update, upsert=False):
+        self.document = self.document or dict(query)
+        self.document.update(update["$set"])
+        for field, amount in update["$inc"].items():
+            self.document[field] = self.document.get(field, 0) + amount
+
+def test_timestamps_stored_in_server_local_time():
+    # A server not running in UTC
+    tz = os.environ.get("TZ")
+    os.environ["TZ"] = "Asia/Ho_Chi_Minh"
+    time.tzset()
+    try:
+        storage = SensorStorage()
+        local = datetime.datetime(2025, 5, 7, 8, 0)
+        timestamps = [
+            local,                                                                          # Set by the server
+            datetime.datetime(2025, 5, 7, 1, 0, tzinfo=datetime.timezone.utc),              # Sent by a device
+            "2025-05-07T03:00:00+02:00",
+            "2025-05-07T08:00:00",
+        ]
+        for timeseries in (False, True):
+            for timestamp in timestamps:
+                document = storage._to_document("device", "temp", 25.0, timestamp, timeseries=timeseries)
+                assert document["timestamp"] == local
+                assert document["timestamp"].tzinfo is None
+    finally:
+        if tz is None:
+            os.environ.pop("TZ")
+        else:
+            os.environ["TZ"] = tz
+        time.tzset()
+
+def test_timeseries_migration_resumes_without_duplicates(database):
+    source = FakeSourceCollection([
+        {"_id": ObjectId(), "uid": "device", "sensor_type": "temp", "value": float(i), "timestamp": datetime.datetime(2025, 5, 7, 8, i).isoformat()}
+        for i in range(10)
+    ])
+    source.documents[3]["timestamp"] = None
+    source.documents[7]["timestamp"] = "not a timestamp"
+    target, migrations = FakeTimeseriesCollection(), FakeMigrationCollection()
+
+    database.set("ensure_timeseries_collection", lambda name: None)
+    database.use_collection("get_env_sensor_collection", source)
+    database.use_collection("get_env_sensor_ts_collection", target)
+    database.use_collection("get_migration_collection", migrations)
+
+    # The second batch is cut off halfway, before its checkpoint
+    target.failures = [None, ConnectionError("connection reset")]
+    try:
+        SensorStorage()._migrate_to_timeseries(batch_size=4)
+        assert False, "interrupted insert not raised"
+    except ConnectionError:
+        pass
+    assert migrations.document["migrated"] == 3
+
+    # Resumed: the readings copied by the cut off batch are not copied twice, one is rejected
+    target.failures = [None, {0}]
+    logged = []
+    copied = SensorStorage()._migrate_to_timeseries(batch_size=4, log=logged.append)
+
+    copied_ids = [document["_id"] for document in target.documents]
+    assert len(copied_ids) == len(set(copied_ids))
+    assert copied == 3
+    assert len(copied_ids) == 7
+    assert migrations.document["migrated"] == 7
+    assert migrations.document["skipped"] == 3
+    assert migrations.document["last_id"] == source.documents[-1]["_id"]
+    assert sum("Skipped reading" in line for line in logged) == 2
@@ -0,0 +1,163 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+os.environ.setdefault("MESSAGE_BUS_MODE", "local")
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from services.service_change_writer import ServiceChangeWriter
+
+class FakeStatusCollection:
+    '''Records the `bulk_write` requests as (uid, update) pairs.'''
+    def __init__(self):
+        self.updates = []
+
+    def bulk_write(self, requests, ordered=True):
+        self.updates.extend((request._filter["uid"], request._doc) for request in requests)
+
+class FakeHistoryCollection:
+    '''
+        Stores inserted actions by _id. `failures` holds what the next inserts raise: an exception, or
+        a function of (documents, stored documents) returning one.
+    '''
+    def __init__(self):
+        self.documents = {}
+        self.failures = []
+        self.delay = 0
+        self.inserting = threading.Event()
+
+    def insert_many(self, documents, ordered=True):
+        self.inserting.set()
+        time.sleep(self.delay)
+        if self.failures:
+            failure = self.failures.pop(0)
+            raise failure if isinstance(failure, Exception) else failure(documents, self.documents)
+        for document in documents:
+            self.documents[document["_id"]] = document
+
+def make_writer(**settings) -> ServiceChangeWriter:
+    writer = object.__new__(ServiceChangeWriter)
+    writer._init_instance()
+    for name, value in settings.items():
+        setattr(writer, name, value)
+    return writer
+
+def use_collections(database) -> tuple:
+    status = database.use_collection("get_services_status_collection", FakeStatusCollection())
+    history = database.use_collection("get_action_history_collection", FakeHistoryCollection())
+    return status, history
+
+def make_action(uid: str, service_type: str) -> dict:
+    return {"_id": ObjectId(), "uid": uid, "service_type": service_type, "description": f"{service_type} changed"}
+
+def test_status_coalesced_and_history_batched(database):
+    async def scenario():
+        status, history = use_collections(database)
+        writer = make_writer(batch_size=2)
+
+        for value in ("on", "off", "on"):
+            assert writer._enqueue("user-a", {"headlight_service": value}, [make_action("user-a", "headlight_service")])
+        assert writer._enqueue("user-b", {"air_cond_temp": 24}, [make_action("user-b", "air_cond_temp")])
+        assert writer._get_pending_status("user-a") == {"headlight_service": "on"}
+
+        await writer._flush()
+
+        # One update per user with the newest values, every action inserted
+        assert status.updates == [("user-a", {"$set": {"headlight_service": "on"}}), ("user-b", {"$set": {"air_cond_temp": 24}})]
+        assert len(history.documents) == 4
+        stats = writer._get_stats()
+        assert stats["coalesced"] == 2
+        assert stats["actions_written"] == 4
+        assert stats["pending_status"] == stats["pending_actions"] == 0
+
+    asyncio.run(scenario())
+
+def test_full_buffer_waits_for_flush(database):
+    async def scenario():
+        status, history = use_collections(database)
+        writer = make_writer(max_pending=4, flush_interval=60, put_timeout=1)
+        await writer._start()
+
+        await writer._put("user-a", {"headlight_service": "on"}, [make_action("user-a", "headlight_service")])
+        await writer._put("user-a", {"headlight_service": "off"}, [make_action("user-a", "headlight_service")])
+        assert not status.updates
+
+        # Full: waits for a flush of the older value instead of writing around it
+        await writer._put("user-a", {"headlight_service": "on"}, [make_action("user-a", "headlight_service")])
+        assert status.updates == [("user-a", {"$set": {"headlight_service": "off"}})]
+        assert writer._get_stats()["waited"] == 1
+
+        await writer._stop()
+        assert status.updates[-1] == ("user-a", {"$set": {"headlight_service": "on"}})
+        assert len(history.documents) == 3
+
+    asyncio.run(scenario())
+
+def test_stop_finishes_flush_in_progress(database):
+    async def scenario():
+        status, history = use_collections(database)
+        history.delay = 0.2
+        writer = make_writer(flush_interval=0.01)
+        await writer._start()
+
+        for service_type in ("headlight_service", "air_cond_service"):
+            await writer._put("user-a", {service_type: "on"}, [make_action("user-a", service_type)])
+
+        # Stop while the history insert is running
+        while not history.inserting.is_set():
+            await asyncio.sleep(0.005)
+        await writer._stop()
+
+        assert len(history.documents) == 2
+        assert writer._get_stats()["pending_actions"] == 0
+
+    asyncio.run(scenario())
+
+def test_failed_history_insert_retried(database):
+    async def scenario():
+        status, history = use_collections(database)
+        writer = make_writer(max_retries=2)
+
+        actions = [make_action("user-a", "headlight_service"), make_action("user-a", "air_cond_service")]
+        writer._enqueue("user-a", {"headlight_service": "on", "air_cond_service": "on"}, actions)
+
+        # The first action is stored, the second fails
+        def partial_failure(documents, stored):
+            stored[documents[0]["_id"]] = documents[0]
+            return BulkWriteError({"nInserted": 1, "writeErrors": [{"index": 1, "code": 91, "errmsg": "shutting down"}]})
+        # Stored, but the reply is lost
+        def lost_reply(documents, stored):
+            stored.update((document["_id"], document) for document in documents)
+            return ConnectionError("connection reset")
+        def duplicate(documents, stored):
+            return BulkWriteError({"nInserted": 0, "writeErrors": [{"index": 0, "code": 11000, "errmsg": "duplicate key"}]})
+
+        history.failures = [partial_failure, lost_reply, duplicate]
+        await writer._flush()
+        assert writer._get_pending_actions("user-a") == [actions[1]]
+        await writer._flush()
+        assert writer._get_pending_actions("user-a") == [actions[1]]
+
+        # The duplicate key of the stored action is not an error
+        await writer._flush()
+        assert not writer._get_pending_actions("user-a")
+        assert set(history.documents) == {action["_id"] for action in actions}
+        assert writer._get_stats()["actions_written"] == 2
+        assert writer._get_stats()["failed"] == 0
+
+        # Dropped once past max_retries
+        writer._enqueue("user-a", {"headlight_service": "off"}, [make_action("user-a", "headlight_service")])
+        history.failures = [ConnectionError("connection reset")] * 3
+        for _ in range(3):
+            await writer._flush()
+        assert not writer._get_pending_actions("user-a")
+        assert writer._get_stats()["failed"] == 1
+        assert not writer._attempts
+
+    asyncio.run(scenario())
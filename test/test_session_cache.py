@@ -0,0 +1,47 @@
+import asyncio
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from services.auth_service import AuthService
+
+def make_auth_service() -> AuthService:
+    service = object.__new__(AuthService)
+    service._AuthService__init_instance()
+    return service
+
+def test_logged_out_session_not_cached(fake_redis):
+    async def scenario():
+        redis = fake_redis
+        service = make_auth_service()
+        await service._start()
+        await asyncio.sleep(0.01)
+        assert service._get_session_cache_stats()["enabled"]
+
+        redis.data["session:token-a"] = "user-a"
+        assert await service._validate_session("token-a") == "user-a"
+        assert service._get_session_cache_stats()["size"] == 1
+
+        # Logout then validate on the same worker
+        assert await service._delete_session("token-a", None)
+        assert await service._validate_session("token-a") is None
+
+        # Logout while the validation's script reply is in flight
+        redis.data["session:token-b"] = "user-b"
+        redis.script_gate = asyncio.Event()
+        validation = asyncio.create_task(service._validate_session("token-b"))
+        await asyncio.sleep(0.01)
+        assert await service._delete_session("token-b", None)
+        await asyncio.sleep(0.01)
+        redis.script_gate.set()
+        assert await validation == "user-b"
+
+        redis.script_gate = None
+        assert await service._validate_session("token-b") is None
+        assert service._get_session_cache_stats()["size"] == 0
+
+        await service._stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,114 @@
+import asyncio
+import io
+import os
+import sys
+
+# Add the src path to the sys.path to import the modules
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from bson import ObjectId
+from starlette.datastructures import Headers, UploadFile
+
+from services.user_service import UserService
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+BOUNDARY = "avatar-boundary"
+
+def use_avatar(use_users, fs) -> tuple:
+    old_avatar = ObjectId()
+    users = use_users([{"_id": ObjectId(), "avatar": old_avatar}])
+    fs.files[old_avatar] = PNG
+    return users.documents[0], old_avatar
+
+def build_form(content: bytes) -> bytes:
+    return (
+        f"--{BOUNDARY}\r\n"
+        f"Content-Disposition: form-data; name=\"file\"; filename=\"avatar.png\"\r\n"
+        f"Content-Type: image/png\r\n\r\n"
+    ).encode() + content + f"\r\n--{BOUNDARY}--\r\n".encode()
+
+class BodyStream:
+    '''Request body sent in 64 KiB chunks, counting what the server read.'''
+    def __init__(self, body: bytes):
+        self.body = body
+        self.read = 0
+
+    async def __aiter__(self):
+        for start in range(0, len(self.body), 64 * 1024):
+            chunk = self.body[start:start + 64 * 1024]
+            self.read += len(chunk)
+            yield chunk
+
+def form_headers(content_length: int = None) -> Headers:
+    headers = {"content-type": f"multipart/form-data; boundary={BOUNDARY}"}
+    if content_length is not None:
+        headers["content-length"] = str(content_length)
+    return Headers(headers)
+
+def test_oversized_upload_rejected_and_old_avatar_kept(use_users, fake_fs, monkeypatch):
+    async def scenario():
+        fs = fake_fs
+        user, old_avatar = use_avatar(use_users, fs)
+        service = UserService()
+        monkeypatch.setattr(service, "AVATAR_MAX_SIZE", 256 * 1024)
+        uid = str(user["_id"])
+        body = build_form(PNG + b"\x00" * (4 * 1024 * 1024))
+
+        # Refused on its Content-Length, before reading the body
+        stream = BodyStream(body)
+        try:
+            await service._read_avatar_upload(form_headers(len(body)), stream)
+            assert False, "oversized upload accepted"
+        except Exception as e:
+            assert e.args[0] == "Avatar too large"
+        assert stream.read == 0
+
+        # Without a Content-Length, reading stops past the limit
+        stream = BodyStream(body)
+        try:
+            await service._read_avatar_upload(form_headers(), stream)
+            assert False, "oversized upload accepted"
+        except Exception as e:
+            assert e.args[0] == "Avatar too large"
+        assert stream.read <= service.AVATAR_MAX_SIZE + service.AVATAR_FORM_OVERHEAD + 64 * 1024
+
+        # Past the limit while streaming into GridFS: the new file is dropped
+        file = UploadFile(io.BytesIO(PNG + b"\x00" * service.AVATAR_MAX_SIZE), filename="avatar.png")
+        try:
+            await service._update_avatar(uid, file)
+            assert False, "oversized upload accepted"
+        except Exception as e:
+            assert e.args[0] == "Avatar too large"
+        assert len(fs.aborted) == 1
+
+        assert user["avatar"] == old_avatar
+        assert list(fs.files) == [old_avatar]
+
+    asyncio.run(scenario())
+
+def test_upload_replaces_old_avatar(use_users, fake_fs):
+    async def scenario():
+        fs = fake_fs
+        user, old_avatar = use_avatar(use_users, fs)
+        service = UserService()
+        body = build_form(PNG)
+
+        file = await service._read_avatar_upload(form_headers(len(body)), BodyStream(body))
+        result = await service._update_avatar(str(user["_id"]), file)
+        await file.close()
+
+        assert result["file_type"] == "image/png"
+        assert result["file_size"] == len(PNG)
+        assert user["avatar"] == ObjectId(result["file_id"])
+        assert fs.files == {user["avatar"]: PNG}
+
+        # Not an image: the current avatar stays
+        file = UploadFile(io.BytesIO(b"<svg></svg>"), filename="avatar.svg")
+        try:
+            await service._update_avatar(str(user["_id"]), file)
+            assert False, "unsupported type accepted"
+        except Exception as e:
+            assert e.args[0] == "Unsupported avatar type"
+        assert fs.files == {user["avatar"]: PNG}
+
+    asyncio.run(scenario())